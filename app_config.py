@@ -6,3 +6,7 @@ class Config(object):
     DEBUG = True
     EXTRA_STUDENTS_SOURCE_PATH = '/Users/pzingg/Projects/_python/easybridge/source/extra-students.txt'
     EXTRA_STUDENTS_WORKING_PATH = '/Users/pzingg/Projects/_python/easybridge/source/extra-students.tsv'
+    EXTRA_STUDENTS_COMPACT_EVERY = 100
+    # Python 2 command for the easybridge job worker
+    EASYBRIDGE_WORKER = ['python2', '/Users/pzingg/Projects/_python/easybridge/worker.py', '--autosend',
+        '--source_dir', '/Users/pzingg/Projects/_python/easybridge/source']
@@ -0,0 +1,207 @@
+# Build and upload several districts in one run, one settings file per
+# district (see district.py):
+#
+#   python batch.py districts/*.json -t 2017-10-02
+#
+# Districts are built in a pool of worker processes, at most one per
+# core. Each zip file is uploaded as soon as its build finishes, by a
+# few upload threads sharing a pool of SFTP connections, so districts
+# on the same SFTP account reuse one login. The run ends with a summary
+# for each district and exits non-zero if any district failed. Each
+# upload is kept in the district's run archive (see runarchive), as
+# easybridge.py does.
+
+import argparse
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+import time
+
+import delta
+import district
+import easybridge
+import fingerprint
+import runarchive
+import sourcecache
+import transfer
+
+# DistrictResult.status values
+UNCHANGED = 'unchanged'
+BUILT = 'built'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+
+class DistrictResult(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.status = None
+        self.error = None
+        self.students = 0
+        self.sections = 0
+        self.enrollments = 0
+        self.build_seconds = 0.0
+        self.zip_path = None
+        self.zip_bytes = 0
+        self.compression = None
+        self.compress_level = None
+        self.inputs = None
+        self.upload = None
+
+    def fail(self, stage, e):
+        self.status = FAILED
+        self.error = '%s: %s' % (stage, str(e) or type(e).__name__)
+
+# Runs in a worker process; exceptions are caught so that one broken
+# district does not stop the others
+def _buildDistrict(args):
+    path, effective_date, dry_run, force = args
+    result = DistrictResult(path)
+    start = time.time()
+    try:
+        config = district.District.load(path)
+        result.name = config.name
+        uploader = easybridge.EasyBridgeUploader(autosend=config.autosend,
+            effective_date=effective_date, district_config=config,
+            cache=sourcecache.SourceCache(os.path.join(config.state_dir, 'cache')))
+        if not dry_run:
+            result.inputs = uploader.fingerprintInputs()
+            manifest = fingerprint.Manifest(os.path.join(uploader.state_dir, 'fingerprint.json'))
+            if manifest.matches(result.inputs) and not force:
+                result.status = UNCHANGED
+                return result
+        uploader.loadData()
+        uploader.buildZipFile()
+        result.students = sum(1 for student in uploader.students.itervalues() if student.enrolled)
+        result.sections = len(uploader.exported_sections)
+        result.enrollments = len(uploader.enrollments)
+        result.zip_path = os.path.join(uploader.output_dir, uploader.zip_file)
+        result.zip_bytes = os.path.getsize(result.zip_path)
+        result.compression = uploader.compression
+        result.compress_level = uploader.compress_level
+        result.status = BUILT
+    except Exception as e:
+        result.fail('build', e)
+    finally:
+        result.build_seconds = time.time() - start
+    return result
+
+class BatchRunner(object):
+    def __init__(self, paths, effective_date, jobs=0, uploads=transfer.POOL_SIZE,
+            dry_run=False, force=False, archive=True, keep_days=runarchive.DEFAULT_KEEP_DAYS,
+            keep_runs=runarchive.DEFAULT_KEEP_RUNS, **transfer_options):
+        self.paths = paths
+        self.effective_date = effective_date
+        cores = multiprocessing.cpu_count()
+        self.jobs = max(1, min(jobs or cores, cores, len(paths)))
+        self.uploads = uploads
+        self.dry_run = dry_run
+        self.force = force
+        self.archive = archive
+        self.keep_days = keep_days
+        self.keep_runs = keep_runs
+        self.sftp_pool = transfer.SftpPool(uploads, **transfer_options)
+
+    def uploadDistrict(self, result):
+        try:
+            config = district.District.load(result.path)
+            sftp = config.sftp
+            with self.sftp_pool.transfer(sftp['host'], sftp['username'], config.sftpPassword(),
+                    port=sftp['port'], known_hosts=sftp['known_hosts']) as sftp_transfer:
+                with open(result.zip_path, 'rb') as f:
+                    result.upload = sftp_transfer.upload(f, sftp['folder'], config.zip_file)
+            manifest = fingerprint.Manifest(os.path.join(config.state_dir, 'fingerprint.json'))
+            manifest.save(result.inputs, config.zip_file, fingerprint.hashFile(result.zip_path))
+            # For a later --delta run of this district
+            delta.Snapshot(os.path.join(config.state_dir, 'snapshot')).commitZip(result.zip_path,
+                easybridge.OUTPUT_FILES)
+            result.status = UPLOADED
+        except Exception as e:
+            result.fail('upload', e)
+            return result
+        if self.archive:
+            self.archiveDistrict(config, result)
+        return result
+
+    # An archive that cannot be written does not fail the upload
+    def archiveDistrict(self, config, result):
+        run_archive = runarchive.Archive(os.path.join(config.state_dir, 'archive'))
+        try:
+            run_archive.storeRun(config.source_dir, result.inputs, config.zip_file, result.zip_path,
+                result.compression, result.compress_level)
+            run_archive.collect(self.keep_days, self.keep_runs)
+        except (runarchive.ArchiveError, IOError, OSError) as e:
+            print "%s: can't archive run: %s" % (result.name, e)
+
+    # Returns the results in the order of the settings files
+    def run(self):
+        build_pool = multiprocessing.Pool(self.jobs)
+        upload_pool = multiprocessing.pool.ThreadPool(self.uploads)
+        results = { }
+        pending = [ ]
+        try:
+            work = [(path, self.effective_date, self.dry_run, self.force) for path in self.paths]
+            for result in build_pool.imap_unordered(_buildDistrict, work):
+                results[result.path] = result
+                print "%s: %s in %.1fs" % (result.name, result.error or result.status, result.build_seconds)
+                sys.stdout.flush()
+                if result.status == BUILT and not self.dry_run:
+                    pending.append(upload_pool.apply_async(self.uploadDistrict, (result, )))
+            build_pool.close()
+            for p in pending:
+                p.get()
+            upload_pool.close()
+        finally:
+            build_pool.terminate()
+            upload_pool.terminate()
+            self.sftp_pool.close()
+        return [results[path] for path in self.paths]
+
+def printSummary(results, wall_seconds):
+    print "%-16s %-10s %9s %9s %12s %8s %10s %8s %8s" % ('district', 'status', 'students',
+        'sections', 'enrollments', 'build_s', 'zip_kb', 'upload_s', 'MB/s')
+    for r in results:
+        upload_seconds = mb_per_second = ''
+        if r.upload is not None:
+            upload_seconds = '%.1f' % r.upload.seconds
+            if r.upload.bytes_per_second is not None:
+                mb_per_second = '%.2f' % (r.upload.bytes_per_second / transfer.MB)
+        print "%-16s %-10s %9d %9d %12d %8.1f %10d %8s %8s" % (r.name, r.status, r.students,
+            r.sections, r.enrollments, r.build_seconds, r.zip_bytes // 1024, upload_seconds, mb_per_second)
+        if r.error:
+            print "    %s" % r.error
+    failed = sum(1 for r in results if r.status == FAILED)
+    print "%d districts, %d failed, %.1fs wall time" % (len(results), failed, wall_seconds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and upload EasyBridge files for several districts.')
+    parser.add_argument('districts', nargs='+', help='district settings files')
+    parser.add_argument('-t', '--effective-date')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='build the zip files but do not upload them')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='upload even if the inputs match the last successful upload')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+        help='number of districts to build at once (0 = one per core, never more than the cores)')
+    parser.add_argument('--uploads', type=int, default=transfer.POOL_SIZE,
+        help='number of uploads at once')
+    parser.add_argument('--retries', type=int, default=transfer.DEFAULT_RETRIES)
+    parser.add_argument('--retry-wait', type=float, default=transfer.DEFAULT_RETRY_WAIT)
+    parser.add_argument('--verify', choices=[transfer.VERIFY_SIZE, transfer.VERIFY_CHECKSUM],
+        default=transfer.VERIFY_CHECKSUM)
+    parser.add_argument('--no-archive', action='store_true', help='do not archive uploaded runs')
+    parser.add_argument('--keep-days', type=int, default=runarchive.DEFAULT_KEEP_DAYS,
+        help='remove archived runs older than this (default: %(default)s)')
+    parser.add_argument('--keep-runs', type=int, default=runarchive.DEFAULT_KEEP_RUNS,
+        help='but always keep this many of the newest (default: %(default)s)')
+    args = parser.parse_args()
+
+    start = time.time()
+    effective_date = easybridge.parseDate(args.effective_date) if args.effective_date else None
+    runner = BatchRunner(args.districts, effective_date, jobs=args.jobs, uploads=args.uploads,
+        dry_run=args.dry_run, force=args.force, archive=not args.no_archive, keep_days=args.keep_days,
+        keep_runs=args.keep_runs, retries=args.retries, retry_wait=args.retry_wait,
+        verify=args.verify)
+    results = runner.run()
+    printSummary(results, time.time() - start)
+    sys.exit(1 if any(r.status == FAILED for r in results) else 0)
@@ -0,0 +1,68 @@
+# Benchmark the roster date handling in loadEnrollments and the section
+# writers: the old dateutil + timedelta + split path against the
+# memoized M/D/YYYY engine in easybridge.
+
+import argparse
+import datetime
+import random
+import timeit
+
+import dateutil.parser
+
+import easybridge
+
+def legacyParseDate(s):
+    return dateutil.parser.parse(s).date()
+
+def legacyFormatDate(s):
+    m, d, y = s.split('/')
+    return '-'.join((y, m, d))
+
+def makeRows(count, distinct):
+    random.seed(0)
+    first = datetime.date(2017, 8, 1)
+    dates = [(first + datetime.timedelta(days=i)).strftime('%m/%d/%Y') for i in range(distinct)]
+    return [(random.choice(dates), random.choice(dates)) for i in range(count)]
+
+def legacyPass(rows, effective_date):
+    kept = 0
+    for enrolled, left in rows:
+        start_date = legacyParseDate(enrolled) - datetime.timedelta(days=easybridge.DAYS_UPCOMING)
+        end_date = legacyParseDate(left) + datetime.timedelta(days=easybridge.DAYS_PAST)
+        if effective_date >= start_date and effective_date <= end_date:
+            kept += 1
+            legacyFormatDate(enrolled)
+            legacyFormatDate(left)
+    return kept
+
+def enginePass(rows, effective_date):
+    kept = 0
+    enrolled_by = effective_date + datetime.timedelta(days=easybridge.DAYS_UPCOMING)
+    left_after = effective_date - datetime.timedelta(days=easybridge.DAYS_PAST)
+    for enrolled, left in rows:
+        if easybridge.parseDate(enrolled) <= enrolled_by and easybridge.parseDate(left) >= left_after:
+            kept += 1
+            easybridge.formatDate(enrolled)
+            easybridge.formatDate(left)
+    return kept
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark easybridge date handling.')
+    parser.add_argument('-r', '--rows', type=int, default=100000)
+    parser.add_argument('-d', '--distinct', type=int, default=300,
+        help='number of distinct date strings')
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = makeRows(args.rows, args.distinct)
+    effective_date = datetime.date(2017, 10, 1)
+    if legacyPass(rows, effective_date) != enginePass(rows, effective_date):
+        raise SystemExit('engine and legacy path disagree on active rows')
+
+    legacy = min(timeit.repeat(lambda: legacyPass(rows, effective_date), number=1, repeat=args.repeat))
+    easybridge.DATE_CACHE.clear()
+    engine = min(timeit.repeat(lambda: enginePass(rows, effective_date), number=1, repeat=args.repeat))
+    print "%d rows, %d distinct dates" % (args.rows, args.distinct)
+    print "legacy: %8.3fs  %10.0f rows/s" % (legacy, args.rows / legacy)
+    print "engine: %8.3fs  %10.0f rows/s" % (engine, args.rows / engine)
+    print "speedup: %.1fx" % (legacy / engine)
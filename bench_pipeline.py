@@ -0,0 +1,152 @@
+# Time each phase of an easybridge run, record peak memory, and compare
+# against a saved baseline. Use gen_district.py to make the source files:
+#
+#   python gen_district.py -o bench/source-50k --size 50k
+#   python bench_pipeline.py -s bench/source-50k --save-baseline bench/50k.json --save-golden bench/50k-golden.json
+#   ... change something ...
+#   python bench_pipeline.py -s bench/source-50k --baseline bench/50k.json --golden bench/50k-golden.json
+#
+# The golden check hashes every output file, so a faster engine can be
+# shown to produce byte-identical output. It exits non-zero on a mismatch.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import easybridge
+import fingerprint
+import sourcecache
+
+WRITERS = ['writeDistrictFile', 'writeSchoolsFile', 'writeStaffFile', 'writeStudentFile',
+    'writeSectionsFile', 'writeSectionStaffFile', 'writeSectionStudentFile', 'writeAssignmentFile']
+
+# Phases more than this much slower than the baseline are flagged,
+# unless they are too short to time reliably
+REGRESSION_RATIO = 1.2
+MIN_FLAGGED_SECONDS = 0.05
+
+def peakRss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+class PhaseTimer(object):
+    def __init__(self):
+        self.phases = [ ]
+
+    def run(self, phase, fn, *args):
+        start = time.time()
+        result = fn(*args)
+        self.phases.append({
+            'phase': phase,
+            'seconds': time.time() - start,
+            'peak_rss_kb': peakRss(),
+        })
+        return result
+
+def runPipeline(source_dir, output_dir, effective_date, jobs, cache_dir=None):
+    timer = PhaseTimer()
+    cache = sourcecache.SourceCache(cache_dir) if cache_dir else None
+    uploader = easybridge.EasyBridgeUploader(source_dir=source_dir, output_dir=output_dir,
+        autosend=True, effective_date=effective_date, jobs=jobs, cache=cache)
+    timer.run('loadMathCourses', uploader.loadMathCourses)
+    timer.run('loadExtraStudents', uploader.loadExtraStudents)
+    timer.run('loadStudents', uploader.loadStudents)
+    if jobs > 1:
+        timer.run('loadSchoolsParallel', uploader.loadSchoolsParallel)
+    else:
+        for school_name in uploader.schools:
+            timer.run('loadSchool:%s' % school_name, uploader.loadSchool, school_name)
+    timer.run('planSections', uploader.planSections)
+    timer.run('validate', uploader.validate)
+    for method in WRITERS:
+        timer.run(method, getattr(uploader, method))
+    timer.run('zipAllFiles', uploader.zipAllFiles)
+    return {
+        'source_dir': source_dir,
+        'effective_date': effective_date.isoformat(),
+        'jobs': jobs,
+        'cache_dir': cache_dir,
+        'phases': timer.phases,
+        'total_seconds': sum(p['seconds'] for p in timer.phases),
+        'peak_rss_kb': peakRss(),
+    }
+
+def outputHashes(output_dir):
+    return dict((name, fingerprint.hashFile(os.path.join(output_dir, name + '.txt')))
+        for name in easybridge.OUTPUT_FILES)
+
+def loadJson(path):
+    with open(path) as f:
+        return json.load(f)
+
+def saveJson(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+def printResults(results, baseline=None):
+    base_phases = { }
+    if baseline:
+        base_phases = dict((p['phase'], p['seconds']) for p in baseline['phases'])
+    print "%-32s %10s %12s %10s %8s" % ('phase', 'seconds', 'peak_rss_kb', 'baseline', 'ratio')
+    for p in results['phases'] + [{'phase': 'total', 'seconds': results['total_seconds'],
+            'peak_rss_kb': results['peak_rss_kb']}]:
+        if p['phase'] == 'total':
+            base = baseline and baseline['total_seconds']
+        else:
+            base = base_phases.get(p['phase'])
+        if base:
+            ratio = p['seconds'] / base
+            flag = ''
+            if ratio > REGRESSION_RATIO and p['seconds'] >= MIN_FLAGGED_SECONDS:
+                flag = '  SLOWER'
+            print "%-32s %10.3f %12d %10.3f %7.2fx%s" % (p['phase'], p['seconds'], p['peak_rss_kb'],
+                base, ratio, flag)
+        else:
+            print "%-32s %10.3f %12d" % (p['phase'], p['seconds'], p['peak_rss_kb'])
+    if baseline:
+        print "peak memory: %d KB (baseline %d KB)" % (results['peak_rss_kb'], baseline['peak_rss_kb'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the easybridge pipeline phase by phase.')
+    parser.add_argument('-s', '--source_dir', required=True, help='AutoSend source directory')
+    parser.add_argument('-o', '--output_dir', help='output directory (default: a temporary one)')
+    parser.add_argument('-t', '--effective-date', default='2017-10-02')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--cache-dir', help='use a source cache in this directory (run twice to time hits)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save-baseline')
+    parser.add_argument('--save-baseline', help='save the results as a baseline')
+    parser.add_argument('--golden', help='check output files against hashes saved with --save-golden')
+    parser.add_argument('--save-golden', help='save output file hashes')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='easybridge-bench-')
+    try:
+        effective_date = easybridge.parseDate(args.effective_date)
+        results = runPipeline(args.source_dir, output_dir, effective_date, args.jobs, args.cache_dir)
+        hashes = outputHashes(output_dir)
+    finally:
+        if not args.output_dir:
+            shutil.rmtree(output_dir)
+
+    printResults(results, args.baseline and loadJson(args.baseline))
+    if args.json:
+        saveJson(args.json, results)
+    if args.save_baseline:
+        saveJson(args.save_baseline, results)
+    if args.save_golden:
+        saveJson(args.save_golden, hashes)
+    if args.golden:
+        golden = loadJson(args.golden)
+        mismatched = [name for name in easybridge.OUTPUT_FILES if golden.get(name) != hashes[name]]
+        if mismatched:
+            print "golden check FAILED: %s" % ', '.join(mismatched)
+            sys.exit(1)
+        print "golden check passed: all %d output files identical" % len(hashes)
@@ -0,0 +1,101 @@
+# Time how long easybridge takes to start, in fresh interpreters, and
+# list the heavy modules each start loads. Every invocation is run
+# --runs times in a new process, and the best and median wall times are
+# kept; compare them against a saved baseline like bench_pipeline.py:
+#
+#   python bench_startup.py --save-baseline bench/startup.json
+#   ... change something ...
+#   python bench_startup.py --baseline bench/startup.json
+#
+# Run it twice after changing anything, so the .pyc files are written
+# and the times are for the cold starts a scheduler or flaskapp sees.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that are slow to import and only some runs need
+HEAVY_MODULES = ['paramiko', 'pysftp', 'cryptography', 'dateutil', 'numpy']
+
+# Runs in the child: the invocation, then the heavy modules it loaded,
+# written to stderr so --help's output can be thrown away
+CHILD = '''
+import sys
+sys.path.insert(0, %(here)r)
+try:
+    %(code)s
+except SystemExit:
+    pass
+sys.stderr.write('\\n' + ' '.join(m for m in %(heavy)r if m in sys.modules) + '\\n')
+'''
+
+INVOCATIONS = [
+    ('python', 'pass'),
+    ('import easybridge', 'import easybridge'),
+    ('import worker', 'import worker'),
+    ('easybridge.py --help', "import runpy; sys.argv = ['easybridge.py', '--help']; "
+        "runpy.run_path(%r, run_name='__main__')" % os.path.join(HERE, 'easybridge.py')),
+]
+
+def timeInvocation(code, runs):
+    script = CHILD % {'here': HERE, 'code': code, 'heavy': HEAVY_MODULES}
+    seconds = [ ]
+    loaded = None
+    with open(os.devnull, 'wb') as devnull:
+        for i in range(runs):
+            start = time.time()
+            child = subprocess.Popen([sys.executable, '-c', script], stdout=devnull,
+                stderr=subprocess.PIPE, cwd=HERE)
+            err = child.communicate()[1]
+            seconds.append(time.time() - start)
+            if child.returncode != 0:
+                raise RuntimeError('%s failed:\n%s' % (code, err))
+            loaded = err.rstrip('\n').rsplit('\n', 1)[-1].split()
+    seconds.sort()
+    return {'best_seconds': seconds[0], 'median_seconds': seconds[len(seconds) // 2],
+        'runs': runs, 'heavy_modules': loaded}
+
+def runAll(runs):
+    return dict((name, timeInvocation(code, runs)) for name, code in INVOCATIONS)
+
+def loadJson(path):
+    with open(path) as f:
+        return json.load(f)
+
+def saveJson(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+def printResults(results, baseline=None):
+    print "%-24s %9s %9s %9s %8s  %s" % ('invocation', 'best_ms', 'median_ms', 'baseline', 'ratio',
+        'heavy modules')
+    for name, code in INVOCATIONS:
+        r = results[name]
+        line = "%-24s %9.1f %9.1f" % (name, r['best_seconds'] * 1000, r['median_seconds'] * 1000)
+        base = baseline and baseline.get(name)
+        if base:
+            line += " %9.1f %7.2fx" % (base['median_seconds'] * 1000,
+                r['median_seconds'] / base['median_seconds'])
+        else:
+            line += " %9s %8s" % ('', '')
+        print "%s  %s" % (line, ' '.join(r['heavy_modules']) or '-')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark easybridge startup in fresh interpreters.')
+    parser.add_argument('-n', '--runs', type=int, default=11, help='runs of each invocation (default: 11)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save-baseline')
+    parser.add_argument('--save-baseline', help='save the results as a baseline')
+    args = parser.parse_args()
+
+    results = runAll(args.runs)
+    printResults(results, args.baseline and loadJson(args.baseline))
+    if args.json:
+        saveJson(args.json, results)
+    if args.save_baseline:
+        saveJson(args.save_baseline, results)
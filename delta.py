@@ -0,0 +1,110 @@
+# Delta uploads: compare the full output files against a snapshot of the
+# files that were last uploaded successfully, and send only the records
+# that were added, changed or removed.
+#
+# Every output file's first column is its natural key (student_code,
+# native_section_code, section_student_code, section_teacher_code,
+# native_assignment_code, ...), so records are matched on that column.
+
+import collections
+import csv
+import os
+import shutil
+import zipfile
+
+# Reference files that are always sent in full
+FULL_FILES = ['CODE_DISTRICT', 'SCHOOL']
+
+def readRecords(path):
+    records = collections.OrderedDict()
+    if not os.path.exists(path):
+        return None, records
+    with open(path) as f:
+        r = csv.reader(f, dialect='excel')
+        header = next(r, None)
+        for row in r:
+            records[row[0]] = row
+    return header, records
+
+class Snapshot(object):
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+
+    def path(self, name):
+        return os.path.join(self.snapshot_dir, name + '.txt')
+
+    # Write the delta for one file and return (added, changed, removed).
+    # Removed records are re-sent with date_end set to end_date when the
+    # file has a date_end column, which is how EasyBridge retires
+    # enrollments and assignments. Removed students and staff drop out
+    # on their own once their enrollments end, so they are only counted.
+    # If the columns have changed since the snapshot, removed records are
+    # moved onto the new columns, with the ones they did not have empty.
+    def diffFile(self, name, full_path, delta_path, end_date):
+        old_header, old_records = readRecords(self.path(name))
+        added = changed = removed = 0
+        with open(full_path) as fin, open(delta_path, 'w') as fout:
+            r = csv.reader(fin, dialect='excel')
+            w = csv.writer(fout, dialect='excel', quoting=csv.QUOTE_ALL)
+            header = next(r)
+            w.writerow(header)
+            for row in r:
+                old_row = old_records.pop(row[0], None)
+                if old_row is None:
+                    added += 1
+                    w.writerow(row)
+                elif old_row != row:
+                    changed += 1
+                    w.writerow(row)
+            if 'date_end' in header:
+                date_end_col = header.index('date_end')
+                for old_row in old_records.itervalues():
+                    if old_header != header:
+                        old_values = dict(zip(old_header, old_row))
+                        old_row = [old_values.get(column, '') for column in header]
+                    old_row[date_end_col] = end_date
+                    w.writerow(old_row)
+            removed = len(old_records)
+        return added, changed, removed
+
+    def writeDeltaFiles(self, full_dir, delta_dir, names, end_date):
+        try:
+            os.makedirs(delta_dir)
+        except:
+            pass
+        stats = { }
+        for name in names:
+            full_path = os.path.join(full_dir, name + '.txt')
+            delta_path = os.path.join(delta_dir, name + '.txt')
+            if name in FULL_FILES:
+                shutil.copyfile(full_path, delta_path)
+                continue
+            stats[name] = self.diffFile(name, full_path, delta_path, end_date)
+        return stats
+
+    # Only called after the upload succeeded, so a failed night is
+    # diffed against the same snapshot again on the next run.
+    def commit(self, full_dir, names):
+        try:
+            os.makedirs(self.snapshot_dir)
+        except:
+            pass
+        for name in names:
+            tmp_path = self.path(name) + '.tmp'
+            shutil.copyfile(os.path.join(full_dir, name + '.txt'), tmp_path)
+            os.rename(tmp_path, self.path(name))
+
+    # The same after a full upload, from the files in its zip file (a
+    # path or a file object), so the next --delta run is taken against
+    # what was last sent whichever mode sent it
+    def commitZip(self, zip_file, names):
+        try:
+            os.makedirs(self.snapshot_dir)
+        except:
+            pass
+        with zipfile.ZipFile(zip_file) as zf:
+            for name in names:
+                tmp_path = self.path(name) + '.tmp'
+                with zf.open(name + '.txt') as fin, open(tmp_path, 'wb') as fout:
+                    shutil.copyfileobj(fin, fout)
+                os.rename(tmp_path, self.path(name))
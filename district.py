@@ -0,0 +1,119 @@
+# District settings: the identity written to CODE_DISTRICT, SCHOOL and
+# ASSIGNMENT, the student email domain, the zip file name, the school
+# year, and where the district's files live and are uploaded to.
+#
+# A district is described by a JSON file, for example
+# districts/kentfield.json. Anything it leaves out comes from DEFAULTS,
+# which are the Kentfield settings the uploader has always used.
+# Relative directories are taken relative to the file. The SFTP password
+# is never kept in the file; password_env names the environment
+# variable that holds it.
+
+import copy
+import json
+import os
+
+DEFAULTS = {
+    'name': 'kentfield',
+    'district_code': '2165334',
+    'district_name': 'Kentfield Elementary School District',
+    'address_1': '750 College Ave',
+    'address_2': '',
+    'city': 'Kentfield',
+    'state': 'CA',
+    'zip': '94904',
+    'phone': '415-458-5130',
+    'schools': [
+        {
+            'school_code': '104',
+            'school_name': 'Adaline E. Kent Middle School',
+            'grade_start': '5',
+            'grade_end': '8',
+            'address_1': '800 College Ave',
+            'address_2': '',
+            'city': 'Kentfield',
+            'state': 'CA',
+            'zip': '94904',
+            'phone': '415-458-5970',
+        },
+    ],
+    # Institution for the ASSIGNMENT file
+    'assignment_school_code': '104',
+    'email_domain': 'kentfieldschools.org',
+    'zip_file': 'KENTFIELD.zip',
+    # Must change at start of year
+    'current_year': 2017,
+    'year_start': '2017-09-05',
+    'year_end': '2018-06-16',
+    'autosend': False,
+    'source_dir': './source',
+    'output_dir': './output',
+    'state_dir': './state',
+    'sftp': {
+        'host': 'sftp.pifdata.net',
+        'port': 22,
+        'folder': 'SIS',
+        'username': None,
+        'password_env': None,
+        'known_hosts': None,
+    },
+}
+
+SCHOOL_FIELDS = ['school_code', 'school_name', 'grade_start', 'grade_end',
+    'address_1', 'address_2', 'city', 'state', 'zip', 'phone']
+
+# Settings that change the output files, for the input fingerprint
+IDENTITY_FIELDS = ['district_code', 'district_name', 'address_1', 'address_2', 'city',
+    'state', 'zip', 'phone', 'schools', 'assignment_school_code', 'email_domain',
+    'current_year', 'year_start', 'year_end']
+
+DIR_FIELDS = ['source_dir', 'output_dir', 'state_dir']
+
+class District(object):
+    def __init__(self, settings=None, base_dir=None):
+        config = copy.deepcopy(DEFAULTS)
+        settings = settings or { }
+        for key, value in settings.items():
+            if key not in config:
+                raise ValueError('unknown district setting %r' % key)
+            if key == 'sftp':
+                config['sftp'].update(value)
+            else:
+                config[key] = value
+        for school in config['schools']:
+            missing = [field for field in SCHOOL_FIELDS if field not in school]
+            if missing:
+                raise ValueError('school %s is missing %s' % (school.get('school_code'), ', '.join(missing)))
+        if base_dir is not None:
+            for key in DIR_FIELDS:
+                config[key] = os.path.join(base_dir, config[key])
+            if config['sftp']['known_hosts']:
+                config['sftp']['known_hosts'] = os.path.join(base_dir, config['sftp']['known_hosts'])
+        self.config = config
+        for key, value in config.items():
+            setattr(self, key, value)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            settings = _utf8(json.load(f))
+        return cls(settings, os.path.dirname(os.path.abspath(path)))
+
+    def identity(self):
+        return dict((key, self.config[key]) for key in IDENTITY_FIELDS)
+
+    def sftpPassword(self):
+        password_env = self.sftp['password_env']
+        if password_env:
+            return os.environ.get(password_env)
+        return None
+
+# json gives unicode strings; the csv writers want UTF-8 bytes
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_utf8(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_utf8(k), _utf8(v)) for k, v in value.items())
+    return value
@@ -1,18 +1,74 @@
 import argparse
+import contextlib
+import cProfile
 import csv
 import datetime
-import dateutil.parser
+import errno
+import io
+import multiprocessing
 import os
+import pstats
 import re
 import sys
-import zipfile
-import pysftp
+
+import delta
+import district
+import exclusions
+import fingerprint
+import metrics
+import records
+import runarchive
+import sourcecache
+import sourcereader
+import spillsort
+import transfer
+import validation
+import watch
+import ziparchive
 
 DAYS_PAST = 7
 DAYS_UPCOMING = 7
 AUTOSEND = True
 LINETERM_IN = "\n"
 
+OUTPUT_FILES = ['CODE_DISTRICT', 'SCHOOL', 'STAFF', 'STUDENT',
+    'PIF_SECTION', 'PIF_SECTION_STAFF', 'PIF_SECTION_STUDENT', 'ASSIGNMENT']
+
+OUTPUT_WRITERS = {
+    'CODE_DISTRICT': 'writeDistrictFile',
+    'SCHOOL': 'writeSchoolsFile',
+    'STAFF': 'writeStaffFile',
+    'STUDENT': 'writeStudentFile',
+    'PIF_SECTION': 'writeSectionsFile',
+    'PIF_SECTION_STAFF': 'writeSectionStaffFile',
+    'PIF_SECTION_STUDENT': 'writeSectionStudentFile',
+    'ASSIGNMENT': 'writeAssignmentFile',
+}
+
+QUERY_KINDS = ['student', 'teacher', 'section', 'course']
+
+# For --watch: the readSchool entry each kind of school file is read
+# into, and the output files that depend on each table.
+# CODE_DISTRICT and SCHOOL come from the district settings alone, and
+# the PowerSchool course names are only used by --dump.
+SCHOOL_FILE_RE = re.compile(r'^(teachers|assignments|courses|sections|rosters)-(.+)\.txt$')
+SCHOOL_FILE_TABLES = {
+    'teachers': 'teachers',
+    'assignments': 'assignments',
+    'courses': 'courses',
+    'sections': 'sections',
+    'rosters': 'enrollments',
+}
+TABLE_OUTPUTS = {
+    'students': ['STUDENT'],
+    'extra_students': ['STUDENT', 'PIF_SECTION_STUDENT'],
+    'teachers': ['STAFF', 'PIF_SECTION', 'PIF_SECTION_STAFF', 'PIF_SECTION_STUDENT', 'ASSIGNMENT'],
+    'assignments': ['STAFF', 'PIF_SECTION', 'PIF_SECTION_STAFF', 'PIF_SECTION_STUDENT', 'ASSIGNMENT'],
+    'courses': [ ],
+    'sections': ['STAFF', 'PIF_SECTION', 'PIF_SECTION_STAFF', 'PIF_SECTION_STUDENT'],
+    'enrollments': ['STUDENT', 'PIF_SECTION_STUDENT'],
+}
+
 MATH_COURSE_HEADERS = [s.strip() for s in '''
 SchoolID
 Course_Number
@@ -96,6 +152,18 @@ Expression
 [05]Last_Name
 '''.split('\n')[1:-1]]
 
+# Columns the loaders use from each file; only these are kept in the
+# source cache
+MATH_COURSE_COLUMNS = MATH_COURSE_HEADERS
+STUDENT_COLUMNS = ['Student_Number', 'SchoolID', 'First_Name', 'Last_Name', 'Gender', 'Network_ID']
+TEST_STUDENT_COLUMNS = STUDENT_COLUMNS + ['Sections']
+TEACHER_COLUMNS = ['TeacherNumber', 'SchoolID', 'First_Name', 'Last_Name', 'Email_Addr', 'Status']
+COURSE_COLUMNS = ['SchoolID', 'Course_Number', 'Course_Name']
+SECTION_COLUMNS = ['SchoolID', 'Course_Number', 'Section_Number', '[13]Abbreviation',
+    '[13]FirstDay', '[13]LastDay', 'Expression', '[05]TeacherNumber']
+CC_COLUMNS = ['SchoolID', 'Course_Number', 'Section_Number', '[01]Student_Number',
+    'DateEnrolled', 'DateLeft']
+
 # Required character encoding is UTF-8.
 # Data fields must be comma delimited.
 # Data must be enclosed in double quotes. Fields without data should be represented as
@@ -123,22 +191,214 @@ Expression
 # Convert dates to YYYY-MM-DD
 # Calendar year is for start of year
 
+# AutoSend dates are M/D/YYYY. Each distinct date string is parsed once
+# and memoized as a (date, 'yyyy-mm-dd') pair, so the loaders and the
+# writers share the same work. Anything that is not M/D/YYYY falls back
+# to dateutil, which is only imported then.
+DATE_CACHE = { }
+
+def _parseDateEntry(s):
+    parts = s.split('/')
+    if len(parts) == 3 and len(parts[2]) == 4:
+        try:
+            dt = datetime.date(int(parts[2]), int(parts[0]), int(parts[1]))
+            return (dt, dt.isoformat())
+        except ValueError:
+            pass
+    import dateutil.parser
+    dt = dateutil.parser.parse(s).date()
+    return (dt, dt.isoformat())
+
+def dateEntry(s):
+    entry = DATE_CACHE.get(s)
+    if entry is None:
+        entry = _parseDateEntry(s)
+        DATE_CACHE[s] = entry
+    return entry
+
 def formatDate(s):
-    m, d, y = s.split('/')
-    return '-'.join((y, m, d))
+    return dateEntry(s)[1]
 
 def parseDate(s):
-    dt = dateutil.parser.parse(s)
-    return dt.date()
+    return dateEntry(s)[0]
+
+# Rows of an AutoSend file as tuples of the given columns, counted in
+# phase.rows_read (see sourcereader). With a sourcecache.SourceCache the
+# file is parsed only if there is no cache entry for its content.
+def readSource(path, autosend, headers, columns, cache, phase):
+    fieldnames = None if not autosend else headers
+    phase.rows_read = 0
+    if cache is None:
+        for row in sourcereader.readRows(path, fieldnames, columns):
+            phase.rows_read += 1
+            yield row
+        return
+    hit, rows = cache.rows(path, 'autosend' if autosend else 'header', columns,
+        lambda: sourcereader.readRows(path, fieldnames, columns))
+    phase.labels['cache'] = 'hit' if hit else 'miss'
+    for row in rows:
+        phase.rows_read += 1
+        yield row
+
+# Reads one school's AutoSend files into lists of records, without
+# touching any uploader state, so schools can be read in worker processes.
+# EasyBridgeUploader applies the records afterwards, one school at a time
+# in math-courses.txt order, so the result and the warnings are the same
+# whether the schools were read serially or in parallel. Rows for courses
+# that are not in math-courses.txt are dropped while reading.
+#
+# Each read is recorded as a phase in the reader's own metrics, which the
+# uploader merges into its metrics after the read.
+#
+# With read_enrollments=False, readSchool leaves the rosters to be
+# streamed by the uploader with iterEnrollments.
+class SchoolReader(object):
+    def __init__(self, source_dir, autosend, effective_date, course_ids, cache=None,
+            read_enrollments=True):
+        self.source_dir = source_dir
+        self.autosend = autosend
+        self.effective_date = effective_date
+        self.course_ids = course_ids
+        self.cache = cache
+        self.read_enrollments = read_enrollments
+        self.metrics = metrics.Metrics()
+
+    def readRows(self, file_name, headers, columns, phase):
+        return readSource(os.path.join(self.source_dir, file_name), self.autosend,
+            headers, columns, self.cache, phase)
+
+    def readTeachers(self, school_name, assignments):
+        file_name = 'teachers-%s.txt' % school_name
+        if assignments:
+            file_name = 'assignments-%s.txt' % school_name
+        with self.metrics.phase('readTeachers', school=school_name, file=file_name) as phase:
+            teachers = [records.Teacher.fromRow(row) for row in self.readRows(file_name, TEACHER_HEADERS, TEACHER_COLUMNS, phase)]
+            phase.rows_kept = len(teachers)
+        return teachers
+
+    # PowerSchool names of the mapped courses, as (course_id, course_name)
+    def readCourses(self, school_name):
+        file_name = 'courses-%s.txt' % school_name
+        courses = [ ]
+        with self.metrics.phase('readCourses', school=school_name, file=file_name) as phase:
+            for school_id, course_number, course_name in self.readRows(file_name, COURSE_HEADERS, COURSE_COLUMNS, phase):
+                course_id = (school_id, course_number)
+                if course_id in self.course_ids:
+                    courses.append((course_id, course_name))
+            phase.rows_kept = len(courses)
+        return courses
+
+    def readSections(self, school_name):
+        file_name = 'sections-%s.txt' % school_name
+        sections = [ ]
+        with self.metrics.phase('readSections', school=school_name, file=file_name) as phase:
+            for (school_id, course_number, section_number, term, first_day, last_day,
+                    expression, teacher_number) in self.readRows(file_name, SECTION_HEADERS, SECTION_COLUMNS, phase):
+                if (school_id, course_number) in self.course_ids:
+                    sections.append(records.Section(school_id, course_number, section_number, term,
+                        dateEntry(first_day), dateEntry(last_day), expression, teacher_number))
+            phase.rows_kept = len(sections)
+        return sections
+
+    # Only enrollments in a mapped course that are active around the
+    # effective date are kept
+    def readEnrollments(self, school_name):
+        return list(self.iterEnrollments(school_name))
+
+    # Enrollment records one at a time. Without the cache the file is
+    # never held in memory whole, since a cache entry is.
+    def iterEnrollments(self, school_name, use_cache=True):
+        file_name = 'rosters-%s.txt' % school_name
+        # Compare the enrollment dates against a window that is
+        # shifted once, instead of shifting every row's dates
+        enrolled_by = self.effective_date + datetime.timedelta(days=DAYS_UPCOMING)
+        left_after = self.effective_date - datetime.timedelta(days=DAYS_PAST)
+        with self.metrics.phase('readEnrollments', school=school_name, file=file_name) as phase:
+            rows = readSource(os.path.join(self.source_dir, file_name), self.autosend,
+                CC_HEADERS, CC_COLUMNS, self.cache if use_cache else None, phase)
+            phase.rows_kept = 0
+            for (school_id, course_number, section_number, student_number,
+                    date_enrolled, date_left) in rows:
+                date_enrolled = dateEntry(date_enrolled)
+                date_left = dateEntry(date_left)
+                if date_enrolled[0] <= enrolled_by and date_left[0] >= left_after:
+                    if (school_id, course_number) in self.course_ids:
+                        phase.rows_kept += 1
+                        yield records.Enrollment(school_id, course_number,
+                            section_number, student_number, date_enrolled, date_left)
+
+    # One of readSchool's entries
+    def readTable(self, table, school_name):
+        if table == 'teachers':
+            return self.readTeachers(school_name, False)
+        if table == 'assignments':
+            return self.readTeachers(school_name, True)
+        return getattr(self, 'read' + table.capitalize())(school_name)
+
+    def readSchool(self, school_name):
+        return {
+            'teachers': self.readTeachers(school_name, False),
+            'assignments': self.readTeachers(school_name, True),
+            'courses': self.readCourses(school_name),
+            'sections': self.readSections(school_name),
+            'enrollments': self.readEnrollments(school_name) if self.read_enrollments else None,
+            'phases': self.metrics.phases,
+        }
+
+# Process pool entry point
+def _readSchool(args):
+    reader, school_name = args
+    return reader.readSchool(school_name)
+
+# Process pool entry point for a writer stage. The pool is forked after
+# the source files are loaded, so each stage finds the loaded data in
+# _stage_uploader without it being copied.
+_stage_uploader = None
+
+def _writeStage(name):
+    uploader = _stage_uploader
+    uploader.metrics = metrics.Metrics()
+    if uploader.spill_bytes:
+        # To output_dir, with no archive open in this process
+        getattr(uploader, OUTPUT_WRITERS[name])()
+        return name, None, uploader.metrics.phases, uploader.metrics.gauges
+    files = uploader.renderOutputs([name])
+    return name, files[name + '.txt'], uploader.metrics.phases, uploader.metrics.gauges
+
+# Counts the lines a csv.writer writes through it, which writes each
+# row in one call
+class LineCounter(object):
+    def __init__(self, f):
+        self.f = f
+        self.lines = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.lines += data.count('\r\n')
+
+# Takes the place of the zip archive in openOutput to keep the output
+# files in memory
+class MemoryArchive(object):
+    def __init__(self):
+        self.files = { }
+
+    def writestr(self, name, data):
+        self.files[name] = data
 
 class EasyBridgeUploader(object):
-    def __init__(self, source_dir=None, output_dir=None, autosend=False, effective_date=None):
-        # Must change at start of year
-        self.current_year = 2017
-        self.year_start = '2017-09-05'
-        self.year_end = '2018-06-16'
+    def __init__(self, source_dir=None, output_dir=None, autosend=False, effective_date=None,
+            state_dir=None, jobs=1, loose_files=False, district_config=None, cache=None, indexes=False,
+            compression=ziparchive.DEFLATE, compress_level=ziparchive.DEFAULT_LEVEL, spill_bytes=None,
+            invalid_rows=validation.FAIL):
+        self.district = district_config or district.District()
+        self.current_year = self.district.current_year
+        self.year_start = self.district.year_start
+        self.year_end = self.district.year_end
+        self.zip_file = self.district.zip_file
 
         self.students = { }
+        self.student_records = [ ]
+        self.extra_students = { }
         self.extras = { }
         self.teachers = { }
         self.courses = { }
@@ -146,9 +406,19 @@ class EasyBridgeUploader(object):
         self.enrollments = { }
         self.course_map = { }
         self.section_map = { }
+        self.section_plan = { }
+        self.exported_sections = [ ]
+        self.native_section_codes = { }
+        self.skipped_sections = { }
+        self.student_sections = { }
+        self.teacher_sections = { }
+        self.section_students = { }
+        self.course_sections = { }
         self.schools = [ ]
-        self.source_dir = source_dir or './source'
-        self.output_dir = output_dir or './output'
+        self.school_data = { }
+        self.source_dir = source_dir or self.district.source_dir
+        self.output_dir = output_dir or self.district.output_dir
+        self.state_dir = state_dir or self.district.state_dir
         try:
             os.makedirs(self.output_dir)
         except:
@@ -157,421 +427,1450 @@ class EasyBridgeUploader(object):
         if effective_date is None:
           effective_date = datetime.date.today()
         self.effective_date = effective_date
+        self.jobs = jobs
+        self.loose_files = loose_files
+        self.cache = cache
+        self.indexes = indexes
+        self.compression = compression
+        self.compress_level = compress_level
+        # With a memory budget, enrollments go to a spillsort.SpillSorter
+        # instead of self.enrollments; see spillEnrollments
+        self.spill_bytes = spill_bytes
+        self.enrollment_spill = None
+        self.spill_section_counts = { }
+        # What to do with rows that fail validation; see validate
+        self.invalid_rows = invalid_rows
+        self.validation = validation.ValidationReport()
+        self.bad_section_maps = [ ]
+        self.unknown_student_enrollments = [ ]
+        self.exclusions = exclusions.ExclusionRules()
+        self.archive = None
+        # Set by writeDeltaFiles: the zip file holds deltas, and the full
+        # files are in output_dir
+        self.delta_written = False
+        # Output files written to output_dir only for the zip archive
+        self.disk_outputs = [ ]
+        self.metrics = metrics.Metrics()
+
+    # Fingerprint of the source files and every setting that affects the
+    # output, used to skip runs whose inputs were already uploaded
+    def fingerprintInputs(self):
+        settings = {
+            'effective_date': self.effective_date.isoformat(),
+            'days_upcoming': DAYS_UPCOMING,
+            'days_past': DAYS_PAST,
+            'district': self.district.identity(),
+            'autosend': self.autosend,
+        }
+        return fingerprint.Fingerprint(self.source_dir, settings)
 
     def loadData(self):
+        if self.spill_bytes:
+            self.enrollment_spill = spillsort.SpillSorter(os.path.join(self.state_dir, 'spill'),
+                self.spill_bytes)
+        self.loadExclusions()
         self.loadMathCourses()
         self.loadExtraStudents()
         self.loadStudents()
-        for school_name in self.schools:
-            self.loadTeachers(school_name, False)
-            self.loadTeachers(school_name, True)
-            self.loadCourses(school_name)
-            self.loadSections(school_name)
-            self.loadEnrollments(school_name)
-
-    def excludeFromEnrollment(self, school_course_id):
-        for ex in DO_NOT_ENROLL:
-            if ex == school_course_id:
-                return True
-            if ex[-2:1] == '.*':
-                school_id, course_id = school_course_id.split('.')
-                test_school = ex[0:-2]
-                if school_id == test_school:
-                    return True
-        return False
-
-    def getTeacherName(self, teacher_id):
-        teacher_data = self.teachers.get(teacher_id)
-        if teacher_data:
-            return teacher_data['Last_Name']
+        if self.jobs > 1 and len(self.schools) > 1:
+            self.loadSchoolsParallel()
+        else:
+            for school_name in self.schools:
+                self.loadSchool(school_name)
+        with self.metrics.phase('planSections') as phase:
+            self.planSections()
+            phase.rows_read = len(self.sections)
+            phase.rows_kept = len(self.exported_sections)
+        self.validate()
+        if self.indexes:
+            self.buildIndexes()
+        self.reportExclusions()
+        if self.enrollment_spill is not None:
+            self.metrics.set('enrollment_spill_runs', self.enrollment_spill.spills)
+
+    def schoolReader(self):
+        return SchoolReader(self.source_dir, self.autosend, self.effective_date,
+            frozenset(self.courses), self.cache, read_enrollments=self.enrollment_spill is None)
+
+    def readSource(self, file_name, headers, columns, phase):
+        return readSource(os.path.join(self.source_dir, file_name), self.autosend,
+            headers, columns, self.cache, phase)
+
+    # Read one of a school's files with a fresh SchoolReader
+    def readSchoolFile(self, method, *args):
+        reader = self.schoolReader()
+        rows = getattr(reader, method)(*args)
+        self.metrics.extend(reader.metrics.phases)
+        return rows
+
+    def loadSchool(self, school_name, school_data=None):
+        if school_data is None:
+            school_data = self.schoolReader().readSchool(school_name)
+        self.metrics.extend(school_data['phases'])
+        # Kept for reloadSourceFile
+        self.school_data[school_name] = school_data
+        with self.metrics.phase('loadSchool', school=school_name) as phase:
+            sections, enrollments = len(self.sections), self.enrollmentCount()
+            self.loadTeachers(school_name, False, school_data['teachers'])
+            self.loadTeachers(school_name, True, school_data['assignments'])
+            self.loadCourses(school_name, school_data['courses'])
+            self.loadSections(school_name, school_data['sections'])
+            if school_data['enrollments'] is None:
+                enrollment_rows = self.spillEnrollments(school_name)
+            else:
+                enrollment_rows = len(school_data['enrollments'])
+                self.loadEnrollments(school_name, school_data['enrollments'])
+            phase.rows_read = len(school_data['sections']) + enrollment_rows
+            phase.rows_kept = len(self.sections) - sections + self.enrollmentCount() - enrollments
+
+    # Check every reference between the loaded tables in one pass, against
+    # the students, sections and exported section codes, and keep the
+    # problems in self.validation (see validation). Enrollments of
+    # unknown students are never loaded; with the FAIL policy any error
+    # raises ValidationError once everything has been checked.
+    def validate(self):
+        report = validation.ValidationReport()
+        with self.metrics.phase('validate') as phase:
+            exported = set(plan.native_section_code for plan in self.exported_sections)
+
+            for school_id, course_number, target in self.bad_section_maps:
+                report.error('section_map', 'math-courses', course_number, target,
+                    'section %s of school %s is mapped to %s, which is not a course.section' % (
+                        course_number, school_id, target))
+            for source, target in sorted(self.section_map.iteritems()):
+                target_code = '.'.join(target)
+                if target_code not in exported:
+                    report.warning('section_map', 'math-courses', '.'.join(source), target_code,
+                        'sections are mapped to %s, which is not uploaded' % target_code)
+
+            for course_id, skipped in sorted(self.skipped_sections.iteritems()):
+                for section, reason in skipped:
+                    report.warning('section_teacher', 'sections', '%s.%s' % (section.course_number,
+                        section.section_number), 'T' + section.teacher_number,
+                        'section of school %s left out, %s' % (section.school_id, reason))
+
+            for enrollment in self.unknown_student_enrollments:
+                report.error('enrollment_student', 'rosters', '%s.%s.%s' % (enrollment.course_number,
+                    enrollment.section_number, enrollment.student_number), 'S' + enrollment.student_number,
+                    'student is not in students.txt (enrolled %s to %s, school %s)' % (enrollment.date_enrolled[1],
+                        enrollment.date_left[1], enrollment.school_id))
+
+            counts = self.enrollmentSectionCounts()
+            for native_section_code, count in sorted(counts.iteritems()):
+                if native_section_code not in exported:
+                    report.warning('enrollment_section', 'rosters', native_section_code, native_section_code,
+                        '%d enrollments in a section that is not uploaded' % count, count)
+
+            for section_id, extras in sorted(self.extras.iteritems()):
+                plan = self.section_plan.get(section_id)
+                students = ', '.join(extras)
+                if plan is None:
+                    report.warning('extra_section', 'extra-students', students, '%s.%s' % section_id[1:],
+                        'section %s.%s (%s) is not loaded' % (section_id[1], section_id[2], section_id[0]), len(extras))
+                elif plan.native_section_code not in exported:
+                    report.warning('extra_section', 'extra-students', students, plan.native_section_code,
+                        'section %s is not uploaded' % plan.native_section_code, len(extras))
+
+            phase.rows_read = (len(self.section_map) + len(self.sections) + len(self.enrollments) +
+                len(self.unknown_student_enrollments) + len(self.extras))
+            phase.rows_kept = phase.rows_read - len(report.errors())
+        self.validation = report
+        self.metrics.set('validation_errors', len(report.errors()))
+        self.metrics.set('validation_warnings', len(report.warnings()))
+        if report.problems:
+            print "validation: %s" % report
+        errors = report.errors()
+        if errors and self.invalid_rows == validation.FAIL:
+            raise validation.ValidationError('%d errors in the source files, the first in %s, %s: %s' % (
+                len(errors), errors[0].table, errors[0].key, errors[0].message))
+
+    # Active enrollments, before deduplication, by native_section_code
+    def enrollmentSectionCounts(self):
+        if self.enrollment_spill is not None:
+            return self.spill_section_counts
+        counts = { }
+        native_section_codes = self.native_section_codes
+        for enrollment_id in self.enrollments:
+            native_section_code = native_section_codes[enrollment_id[:3]]
+            counts[native_section_code] = counts.get(native_section_code, 0) + 1
+        return counts
+
+    def enrollmentCount(self):
+        if self.enrollment_spill is not None:
+            return len(self.enrollment_spill)
+        return len(self.enrollments)
+
+    # Read each school's files in a process pool, then apply them here in
+    # the same order as the serial path
+    def loadSchoolsParallel(self):
+        reader = self.schoolReader()
+        pool = multiprocessing.Pool(min(self.jobs, len(self.schools)))
+        try:
+            results = pool.imap(_readSchool, [(reader, school_name) for school_name in self.schools])
+            for school_name, school_data in zip(self.schools, results):
+                self.loadSchool(school_name, school_data)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def loadExclusions(self):
+        with self.metrics.phase('loadExclusions', file=exclusions.FILE_NAME) as phase:
+            self.exclusions = exclusions.ExclusionRules.load(os.path.join(self.source_dir, exclusions.FILE_NAME))
+            phase.rows_read = phase.rows_kept = len(self.exclusions)
+
+    # Rows dropped by each exclusion rule, including rules that matched
+    # nothing, which are probably out of date
+    def reportExclusions(self):
+        for rule in self.exclusions.rules:
+            hits = self.exclusions.hits[rule]
+            sections = hits.get('sections', 0)
+            enrollments = hits.get('enrollments', 0)
+            print "exclusion %s: %d sections, %d enrollments left out" % (rule, sections, enrollments)
+            self.metrics.set('exclusion_sections', sections, rule=rule)
+            self.metrics.set('exclusion_enrollments', enrollments, rule=rule)
+
+    # The native_section_code an enrollment in a source section is
+    # uploaded under, after course_map and section_map
+    def nativeSectionCode(self, section_id):
+        school_id, course_number, section_number = section_id
+        course_number = self.course_map.get((school_id, course_number), course_number)
+        source_section = (course_number, section_number)
+        return '.'.join(self.section_map.get(source_section, source_section))
+
+    # Resolve every loaded section, and every section that has active
+    # enrollments, once after loading, so the section writers only do
+    # lookups. exported_sections keeps self.sections order.
+    def planSections(self):
+        course_year = str(self.current_year + 1)
+        self.section_plan = { }
+        self.exported_sections = [ ]
+        self.native_section_codes = { }
+        for section_id, section in self.sections.iteritems():
+            school_id, course_number, section_number = section_id
+            course_id = (school_id, course_number)
+            native_section_code = self.nativeSectionCode(section_id)
+            self.native_section_codes[section_id] = native_section_code
+
+            # Mapped courses and sections are folded into their target
+            if course_id not in self.courses or course_id in self.course_map or \
+                    (course_number, section_number) in self.section_map:
+                self.section_plan[section_id] = records.SectionPlan(section, native_section_code, False)
+                continue
+
+            course_name = self.courses[course_id].target_course_name
+            period = re.sub(r'^(\d+)(.+)$', r'P\1', section.expression)
+            # TODO: Check Onboarding Guide about maximum length of the section name
+            section_name = course_name + ' - ' + self.getTeacherName(section.teacher_number) + ' ' + period + ' ' + course_year
+            section_teacher_code = '.'.join((course_number, section_number, section.teacher_number))
+            plan = records.SectionPlan(section, native_section_code, True,
+                course_name, section_name, section_teacher_code)
+            self.section_plan[section_id] = plan
+            self.exported_sections.append(plan)
+        self.planEnrollmentSections()
+
+    def planEnrollmentSections(self):
+        for enrollment_id in self.enrollments:
+            section_id = enrollment_id[:3]
+            if section_id not in self.native_section_codes:
+                self.native_section_codes[section_id] = self.nativeSectionCode(section_id)
+
+    def getTeacherName(self, teacher_number):
+        teacher = self.teachers.get(teacher_number)
+        if teacher:
+            return teacher.last_name
         return '?'
 
     def loadMathCourses(self):
-        with open(os.path.join(self.source_dir, 'math-courses.txt')) as f:
-            fieldnames = None if not self.autosend else MATH_COURSE_HEADERS
-            courses = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in courses:
-                school_id = row['SchoolID']
+        with self.metrics.phase('loadMathCourses', file='math-courses.txt') as phase:
+            for (school_id, course_number, target_course_number, course_name,
+                    school_name) in self.readSource('math-courses.txt', MATH_COURSE_HEADERS, MATH_COURSE_COLUMNS, phase):
                 # Oddity: course_number and target_course_number
                 # might contain a .section_number. In this case,
                 # map the source section to the target section_number.
                 # Used when the scheduler makes up crazy Core 5 sections
                 # because of Learning Center pullout schedules.
-                course_number = row['Course_Number']
-                target_course_number = row['Target_Course_Number']
                 if '.' in course_number:
                     if '.' in target_course_number:
                         # Mapping sections
                         # 'course_number' and 'target_course_number' are actually 'course.section'
-                        if course_number not in self.section_map:
-                            self.section_map[course_number] = { }
-                        self.section_map[course_number] = target_course_number
+                        source_section = tuple(intern(s) for s in course_number.split('.', 1))
+                        self.section_map[source_section] = tuple(intern(s) for s in target_course_number.split('.', 1))
                     else:
-                        # Error!
-                        pass
+                        self.bad_section_maps.append((school_id, course_number, target_course_number))
                 else:
                     # Mapping courses
-                    course_id = '.'.join((school_id, course_number))
-                    self.courses[course_id] = { 'Target_Course_Name': row['Course_Name'] }
+                    course = records.Course(school_id, course_number, course_name)
+                    course_id = (course.school_id, course.course_number)
+                    self.courses[course_id] = course
                     if course_number != target_course_number:
-                        self.course_map[course_id] = target_course_number
-                    school_name = row['School_Name']
+                        self.course_map[course_id] = intern(target_course_number)
                     if school_name not in self.schools:
                         self.schools.append(school_name)
+            phase.rows_kept = len(self.courses) + len(self.section_map)
 
-    # This is for teachers posing as students
-    def loadExtraStudents(self):
-        with open(os.path.join(self.source_dir, 'extra-students.txt')) as f:
-            fieldnames = None if not self.autosend else TEST_STUDENT_HEADERS
-            students = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in students:
-                student_id = 'S' + row['Student_Number']
-                school_id = row['SchoolID']
-                row.update({'Enrolled': '1'})
-                self.students[student_id] = row
-
-                # Add extra enrollments
-                sections = row['Sections'].split(',')
+    # This is for teachers posing as students. file_name may also be an
+    # absolute path, such as the working file edited by flaskapp.
+    #
+    # Extra students are loaded before students.txt, which replaces any
+    # with the same number, so an extra never replaces a real student.
+    def loadExtraStudents(self, file_name='extra-students.txt'):
+        with self.metrics.phase('loadExtraStudents', file=os.path.basename(file_name)) as phase:
+            for row in self.readSource(file_name, TEST_STUDENT_HEADERS, TEST_STUDENT_COLUMNS, phase):
+                student = records.Student.fromRow(row)
+                student.enrolled = True
+                existing = self.students.get(student.student_number)
+                if existing is None or existing is self.extra_students.get(student.student_number):
+                    self.students[student.student_number] = student
+                self.extra_students[student.student_number] = student
+
+                # Add extra enrollments; Sections is the last of
+                # TEST_STUDENT_COLUMNS
+                sections = row[-1].split(',')
                 for section in sections:
-                    school_section_id = '.'.join((school_id, section))
-                    if school_section_id not in self.extras:
-                        self.extras[school_section_id] = [ ]
-                    self.extras[school_section_id].append(student_id)
+                    course_number, section_number = section.split('.', 1)
+                    section_id = (student.school_id, intern(course_number), intern(section_number))
+                    if section_id not in self.extras:
+                        self.extras[section_id] = [ ]
+                    self.extras[section_id].append(student.student_number)
+            phase.rows_kept = phase.rows_read
+
+    # Replace the extra students of a loaded uploader, without loading
+    # anything else again
+    def reloadExtraStudents(self, file_name='extra-students.txt'):
+        for student_number, student in self.extra_students.iteritems():
+            if self.students.get(student_number) is student:
+                del self.students[student_number]
+        self.extra_students = { }
+        self.extras = { }
+        self.loadExtraStudents(file_name)
 
     def loadStudents(self):
-        with open(os.path.join(self.source_dir, 'students.txt')) as f:
-            fieldnames = None if not self.autosend else STUDENT_HEADERS
-            students = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in students:
-                student_id = 'S' + row['Student_Number']
-                row.update({'Enrolled': '0'})
-                self.students[student_id] = row
+        with self.metrics.phase('loadStudents', file='students.txt') as phase:
+            self.student_records = [records.Student.fromRow(row)
+                for row in self.readSource('students.txt', STUDENT_HEADERS, STUDENT_COLUMNS, phase)]
+            for student in self.student_records:
+                self.students[student.student_number] = student
+            phase.rows_kept = phase.rows_read
 
     # Create an assignments-kent.txt file that has the assigned teachers (and aides)
     # Same format as teachers-kent.txt
-    def loadTeachers(self, school_name, assignments):
-        file_name = 'teachers-%s.txt' % school_name
-        if assignments:
-            file_name = 'assignments-%s.txt' % school_name
-        with open(os.path.join(self.source_dir, file_name)) as f:
-            fieldnames = None if not self.autosend else TEACHER_HEADERS
-            teachers = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in teachers:
-                teacher_number = row['TeacherNumber']
-                teacher_id = 'T' + teacher_number
-                if assignments:
-                  row.update({'Assigned': '2'})
-                else:
-                  row.update({'Assigned': '0'})
-                self.teachers[teacher_id] = row
-
-    def loadCourses(self, school_name):
-        with open(os.path.join(self.source_dir, 'courses-%s.txt' % school_name)) as f:
-            fieldnames = None if not self.autosend else COURSE_HEADERS
-            courses = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in courses:
-                school_id = row['SchoolID']
-                course_number = row['Course_Number']
-                course_id = '.'.join((school_id, course_number))
-
-                # Replace empty dict with PowerSchool info
-                if course_id in self.courses:
-                    self.courses[course_id].update(row)
-
-    def loadSections(self, school_name):
-        with open(os.path.join(self.source_dir, 'sections-%s.txt' % school_name)) as f:
-            fieldnames = None if not self.autosend else SECTION_HEADERS
-            sections = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in sections:
-                school_id = row['SchoolID']
-                course_number = row['Course_Number']
-                section_number = row['Section_Number']
-                teacher_id = 'T' + row['[05]TeacherNumber']
-                course_id = '.'.join((school_id, course_number))
-                if course_id in self.courses:
-                    if teacher_id in self.teachers:
-                        if self.teachers[teacher_id]['Status'] == '1':
-                            if self.teachers[teacher_id]['Assigned'] == '0':
-                                self.teachers[teacher_id]['Assigned'] = '1'
-                            school_section_id = '.'.join((school_id, course_number, section_number))
-                            self.sections[school_section_id] = row
-                        else:
-                            print "section %s.%s (%s): teacher %s is not active" % (course_number, section_number, school_id, teacher_id)
+    #
+    # The per-school loaders read their file unless the records were
+    # already read by a SchoolReader
+    def loadTeachers(self, school_name, assignments, rows=None):
+        if rows is None:
+            rows = self.readSchoolFile('readTeachers', school_name, assignments)
+        for teacher in rows:
+            if assignments:
+              teacher.assigned = records.ASSIGNED
+            else:
+              teacher.assigned = records.NOT_ASSIGNED
+            self.teachers[teacher.teacher_number] = teacher
+
+    def loadCourses(self, school_name, rows=None):
+        if rows is None:
+            rows = self.readSchoolFile('readCourses', school_name)
+        for course_id, course_name in rows:
+            # Add PowerSchool info to the mapped course
+            if course_id in self.courses:
+                self.courses[course_id].course_name = course_name
+
+    def loadSections(self, school_name, rows=None):
+        if rows is None:
+            rows = self.readSchoolFile('readSections', school_name)
+        rules = self.exclusions if self.exclusions else None
+        for section in rows:
+            if (section.school_id, section.course_number) in self.courses:
+                if rules is not None:
+                    rule = rules.match(section.school_id, section.course_number)
+                    if rule is not None:
+                        rules.hit(rule, 'sections')
+                        continue
+                teacher = self.teachers.get(section.teacher_number)
+                if teacher:
+                    if teacher.status == '1':
+                        if teacher.assigned == records.NOT_ASSIGNED:
+                            teacher.assigned = records.TEACHES_SECTION
+                        self.sections[section.key()] = section
                     else:
-                        print "section %s.%s (%s): missing teacher %s" % (course_number, section_number, school_id, teacher_id)
-
-    def loadEnrollments(self, school_name):
-        with open(os.path.join(self.source_dir, 'rosters-%s.txt' % school_name)) as f:
-            fieldnames = None if not self.autosend else CC_HEADERS
-            cc = csv.DictReader(f, fieldnames=fieldnames,
-                dialect='excel-tab', lineterminator=LINETERM_IN)
-            for row in cc:
-                start_date = parseDate(row['DateEnrolled']) - datetime.timedelta(days=DAYS_UPCOMING)
-                end_date   = parseDate(row['DateLeft']) + datetime.timedelta(days=DAYS_PAST)
-                if self.effective_date >= start_date and self.effective_date <= end_date:
-                    school_id = row['SchoolID']
-                    course_number = row['Course_Number']
-                    section_number = row['Section_Number']
-                    course_id = '.'.join((school_id, course_number))
+                        self.skipSection(section, "teacher T%s is not active" % section.teacher_number)
+                else:
+                    self.skipSection(section, "missing teacher T%s" % section.teacher_number)
+
+    # Kept, by course, for --query course
+    def skipSection(self, section, reason):
+        print "section %s.%s (%s): %s" % (section.course_number, section.section_number, section.school_id, reason)
+        course_id = (section.school_id, section.course_number)
+        if course_id not in self.skipped_sections:
+            self.skipped_sections[course_id] = [ ]
+        self.skipped_sections[course_id].append((section, reason))
+
+    # Records are already limited to active enrollments in mapped courses
+    def loadEnrollments(self, school_name, rows=None):
+        if rows is None:
+            rows = self.readSchoolFile('readEnrollments', school_name)
+        rules = self.exclusions if self.exclusions else None
+        for enrollment in rows:
+            if rules is not None:
+                rule = rules.match(enrollment.school_id, enrollment.course_number)
+                if rule is not None:
+                    rules.hit(rule, 'enrollments')
+                    continue
+            student = self.students.get(enrollment.student_number)
+            if student is None:
+                # Reported by validate
+                self.unknown_student_enrollments.append(enrollment)
+                continue
+            enrollment_id = enrollment.key()
+            if enrollment_id not in self.enrollments:
+                self.enrollments[enrollment_id] = enrollment
+                student.enrolled = True
+
+    # loadEnrollments with a memory budget. The roster is streamed from
+    # the file, and each active enrollment is added to enrollment_spill as
+    # the PIF_SECTION_STUDENT row it becomes, (section_student_code,
+    # sequence number, student_number, native_section_code, date_start,
+    # date_end), with nothing kept in self.enrollments. Returns the number
+    # of enrollments read.
+    def spillEnrollments(self, school_name):
+        reader = self.schoolReader()
+        rules = self.exclusions if self.exclusions else None
+        spill = self.enrollment_spill
+        native_section_codes = { }
+        count = 0
+        for enrollment in reader.iterEnrollments(school_name, use_cache=False):
+            count += 1
+            if rules is not None:
+                rule = rules.match(enrollment.school_id, enrollment.course_number)
+                if rule is not None:
+                    rules.hit(rule, 'enrollments')
+                    continue
+            student = self.students.get(enrollment.student_number)
+            if student is None:
+                self.unknown_student_enrollments.append(enrollment)
+                continue
+            student.enrolled = True
+            section_id = (enrollment.school_id, enrollment.course_number, enrollment.section_number)
+            native_section_code = native_section_codes.get(section_id)
+            if native_section_code is None:
+                native_section_code = native_section_codes[section_id] = self.nativeSectionCode(section_id)
+            self.spill_section_counts[native_section_code] = self.spill_section_counts.get(native_section_code, 0) + 1
+            student_number = enrollment.student_number
+            spill.add((native_section_code + '.' + student_number, len(spill), student_number,
+                native_section_code, enrollment.date_enrolled[1], enrollment.date_left[1]))
+        self.metrics.extend(reader.metrics.phases)
+        return count
+
+    def closeSpill(self):
+        if self.enrollment_spill is not None:
+            self.enrollment_spill.close()
+
+    # Every enrollment in a mapped course, whatever its dates, for
+    # --preview-range, less the ones exclusions.txt leaves out and the
+    # ones of students who are not in students.txt, which are only
+    # counted. Returns (table, enrollments of unknown students). Needs
+    # math-courses.txt, the exclusions and the students loaded, and NumPy.
+    def loadEnrollmentTable(self):
+        import enrollmenttable
+        rules = self.exclusions if self.exclusions else None
+        students = self.students
+        unknown_students = 0
+        section_codes = [ ]
+        student_numbers = [ ]
+        dates_enrolled = [ ]
+        dates_left = [ ]
+        native_section_codes = { }
+        for school_name in self.schools:
+            file_name = 'rosters-%s.txt' % school_name
+            with self.metrics.phase('readEnrollmentTable', school=school_name, file=file_name) as phase:
+                rows_before = len(section_codes)
+                for (school_id, course_number, section_number, student_number,
+                        date_enrolled, date_left) in self.readSource(file_name, CC_HEADERS, CC_COLUMNS, phase):
+                    course_id = (school_id, course_number)
                     if course_id in self.courses:
-                        student_id = 'S' + row['[01]Student_Number']
-                        teacher_id = 'T' + row['[05]TeacherNumber']
-                        enrollment_id = '.'.join((school_id, course_number, section_number, student_id))
-                        if enrollment_id not in self.enrollments:
-                            self.enrollments[enrollment_id] = row
-                            try:
-                                self.students[student_id]['Enrolled'] = '1'
-                            except KeyError:
-                                print "------------------------------------------"
-                                print "Enrollment error for student %s in course: %s-%s" % (student_id, course_number, section_number)
-                                print "Effective Date - Start Date - End Date"
-                                print "%s       %s   %s" % (self.effective_date, start_date, end_date)
-                                print "Perhaps the student's actual start date is within 7 days of the effective date, pushing the above start date to earlier than the effective date?"
-                                print "------------------------------------------"
-                                raise
-                                
-    def dumpActiveEnrollments(self):
-        f = sys.stdout
+                        if rules is not None and rules.match(school_id, course_number) is not None:
+                            continue
+                        if student_number not in students:
+                            unknown_students += 1
+                            continue
+                        section_id = course_id + (section_number, )
+                        native_section_code = native_section_codes.get(section_id)
+                        if native_section_code is None:
+                            native_section_code = native_section_codes[section_id] = self.nativeSectionCode(section_id)
+                        section_codes.append(native_section_code)
+                        student_numbers.append(student_number)
+                        dates_enrolled.append(formatDate(date_enrolled))
+                        dates_left.append(formatDate(date_left))
+                phase.rows_kept = len(section_codes) - rows_before
+        with self.metrics.phase('buildEnrollmentTable') as phase:
+            table = enrollmenttable.EnrollmentTable(section_codes, student_numbers,
+                dates_enrolled, dates_left, DAYS_PAST, DAYS_UPCOMING)
+            phase.rows_read = phase.rows_kept = len(table)
+        return table, unknown_students
+
+    # What would be uploaded on each of the days from the effective date.
+    # Extra students are sent every day and are left out.
+    def previewRange(self, days, details_path=None):
+        import enrollmenttable
+        self.loadMathCourses()
+        self.loadExclusions()
+        self.loadStudents()
+        table, unknown_students = self.loadEnrollmentTable()
+        with self.metrics.phase('previewRange') as phase:
+            result = table.preview(self.effective_date, days)
+            phase.rows_read = len(table)
+        enrollmenttable.printPreview(result, sys.stdout)
+        if unknown_students:
+            # Skipped or stopped on by a real run, depending on invalid_rows
+            print "%d enrollments of students not in students.txt are not counted%s" % (unknown_students,
+                ', and a run would stop on the ones it sends' if self.invalid_rows == validation.FAIL else '')
+        if details_path:
+            enrollmenttable.writePreviewDetails(result, details_path)
+
+    # --watch support: read one changed source file again and update the
+    # tables it feeds. Each table is rebuilt from the records already
+    # read for every school, in loadData order, so the output is the same
+    # as a cold run's; only the changed file is parsed. Returns the output
+    # files that may have changed, or None if everything has to be
+    # loaded again.
+    def reloadSourceFile(self, file_name):
+        if file_name in ('math-courses.txt', exclusions.FILE_NAME):
+            return None
+        if file_name in ('students.txt', 'extra-students.txt'):
+            self.rebuildStudents(file_name == 'students.txt')
+            self.applyEnrollments()
+            self.validate()
+            return TABLE_OUTPUTS['students' if file_name == 'students.txt' else 'extra_students']
+        m = SCHOOL_FILE_RE.match(file_name)
+        if m is None or m.group(2) not in self.school_data:
+            return [ ]
+        table = SCHOOL_FILE_TABLES[m.group(1)]
+        school_name = m.group(2)
+        self.school_data[school_name][table] = self.readSchoolFile('readTable', table, school_name)
+        if table == 'courses':
+            self.applyCourses()
+        elif table == 'enrollments':
+            self.applyEnrollments()
+            self.planEnrollmentSections()
+        else:
+            self.applyTeachersAndSections()
+            with self.metrics.phase('planSections') as phase:
+                self.planSections()
+                phase.rows_read = len(self.sections)
+                phase.rows_kept = len(self.exported_sections)
+        self.validate()
+        return TABLE_OUTPUTS[table]
+
+    # Extra students first, as in loadData
+    def rebuildStudents(self, read_students):
+        self.students = { }
+        self.extra_students = { }
+        self.extras = { }
+        self.loadExtraStudents()
+        if read_students:
+            self.loadStudents()
+        else:
+            for student in self.student_records:
+                self.students[student.student_number] = student
+
+    def applyEnrollments(self):
+        for student in self.student_records:
+            student.enrolled = False
+        self.enrollments = { }
+        self.unknown_student_enrollments = [ ]
+        self.exclusions.resetHits('enrollments')
+        for school_name in self.schools:
+            self.loadEnrollments(school_name, self.school_data[school_name]['enrollments'])
+
+    def applyCourses(self):
+        for course in self.courses.itervalues():
+            course.course_name = None
+        for school_name in self.schools:
+            self.loadCourses(school_name, self.school_data[school_name]['courses'])
+
+    # Sections depend on the teachers loaded before them, so both are
+    # applied school by school
+    def applyTeachersAndSections(self):
+        self.teachers = { }
+        self.sections = { }
+        self.skipped_sections = { }
+        self.exclusions.resetHits('sections')
+        for school_name in self.schools:
+            school_data = self.school_data[school_name]
+            self.loadTeachers(school_name, False, school_data['teachers'])
+            self.loadTeachers(school_name, True, school_data['assignments'])
+            self.loadSections(school_name, school_data['sections'])
+
+    # Secondary indexes for --query and --dump, so that a query takes
+    # time in proportion to its answer rather than to the rosters. They
+    # are built by loadData only when the uploader is made with
+    # indexes=True, as an upload has no use for them.
+    #   student_sections  student_number -> section ids the student is in
+    #   teacher_sections  teacher_number -> section ids the teacher has
+    #   section_students  native_section_code -> (section id, student_number),
+    #                     one per row of PIF_SECTION_STUDENT
+    #   course_sections   (school_id, course_number) -> section ids
+    # Section ids are the source (school_id, course_number, section_number).
+    def buildIndexes(self):
+        with self.metrics.phase('buildIndexes') as phase:
+            self.student_sections = { }
+            self.teacher_sections = { }
+            self.section_students = { }
+            self.course_sections = { }
+            for section_id, section in self.sections.iteritems():
+                self.course_sections.setdefault(section_id[:2], [ ]).append(section_id)
+                self.teacher_sections.setdefault(section.teacher_number, [ ]).append(section_id)
+            seen_enrollments = set()
+            for enrollment_id in self.enrollments:
+                section_id = enrollment_id[:3]
+                student_number = enrollment_id[3]
+                native_section_code = self.native_section_codes[section_id]
+                self.student_sections.setdefault(student_number, [ ]).append(section_id)
+                if (native_section_code, student_number) not in seen_enrollments:
+                    seen_enrollments.add((native_section_code, student_number))
+                    self.section_students.setdefault(native_section_code, [ ]).append((section_id, student_number))
+            for section_id, extras in self.extras.iteritems():
+                plan = self.section_plan.get(section_id)
+                if plan is not None:
+                    for student_number in extras:
+                        self.student_sections.setdefault(student_number, [ ]).append(section_id)
+                        self.section_students.setdefault(plan.native_section_code, [ ]).append((section_id, student_number))
+            phase.rows_read = len(self.enrollments) + len(self.sections)
+            phase.rows_kept = sum(len(students) for students in self.section_students.itervalues())
+
+    # course_name, teacher_number and teacher name for a source section
+    def sectionInfo(self, section_id):
+        course = self.courses.get(section_id[:2])
+        course_name = course.target_course_name if course else ''
+        section = self.sections.get(section_id)
+        teacher_number = section.teacher_number if section else ''
+        return course_name, teacher_number, self.getTeacherName(teacher_number) if section else ''
+
+    # (date_start, date_end) that PIF_SECTION_STUDENT has for a student
+    # in a source section
+    def enrollmentDates(self, section_id, student_number):
+        enrollment = self.enrollments.get(section_id + (student_number, ))
+        if enrollment is not None:
+            return enrollment.date_enrolled[1], enrollment.date_left[1]
+        plan = self.section_plan[section_id]
+        return plan.date_start, plan.date_end
+
+    def studentName(self, student_number):
+        student = self.students.get(student_number)
+        if student is None:
+            return '?', ''
+        return student.last_name, student.first_name
+
+    def queryStudent(self, student_number, f):
+        w = csv.writer(f, dialect='excel-tab')
+        w.writerow(['student_number', 'last_name', 'first_name', 'native_section_code', 'course_name',
+            'teacher_number', 'teacher_name', 'date_start', 'date_end', 'extra'])
+        last_name, first_name = self.studentName(student_number)
+        for section_id in self.student_sections.get(student_number, [ ]):
+            course_name, teacher_number, teacher_name = self.sectionInfo(section_id)
+            date_start, date_end = self.enrollmentDates(section_id, student_number)
+            extra = 'yes' if section_id + (student_number, ) not in self.enrollments else ''
+            w.writerow([student_number, last_name, first_name, self.native_section_codes[section_id],
+                course_name, teacher_number, teacher_name, date_start, date_end, extra])
+
+    def querySection(self, native_section_code, f):
+        w = csv.writer(f, dialect='excel-tab')
+        w.writerow(['native_section_code', 'student_number', 'last_name', 'first_name',
+            'date_start', 'date_end', 'source_section'])
+        for section_id, student_number in self.section_students.get(native_section_code, [ ]):
+            last_name, first_name = self.studentName(student_number)
+            date_start, date_end = self.enrollmentDates(section_id, student_number)
+            w.writerow([native_section_code, student_number, last_name, first_name,
+                date_start, date_end, '.'.join(section_id)])
+
+    # The students in every section the teacher has; sections folded into
+    # the same native section are listed once
+    def queryTeacher(self, teacher_number, f):
+        w = csv.writer(f, dialect='excel-tab')
+        w.writerow(['teacher_number', 'native_section_code', 'course_name', 'student_number',
+            'last_name', 'first_name'])
+        seen = set()
+        for section_id in self.teacher_sections.get(teacher_number, [ ]):
+            native_section_code = self.native_section_codes[section_id]
+            if native_section_code in seen:
+                continue
+            seen.add(native_section_code)
+            course_name = self.sectionInfo(section_id)[0]
+            for _, student_number in self.section_students.get(native_section_code, [ ]):
+                w.writerow([teacher_number, native_section_code, course_name, student_number]
+                    + list(self.studentName(student_number)))
+
+    # Why a course has, or does not have, sections and students in the
+    # upload. course_code is school_id.course_number, or a course number
+    # to look in every school.
+    def queryCourse(self, course_code, f):
+        if '.' in course_code:
+            course_ids = [tuple(course_code.split('.', 1))]
+        else:
+            course_ids = sorted(course_id for course_id in self.courses if course_id[1] == course_code)
+            if not course_ids:
+                course_ids = [(None, course_code)]
+        for school_id, course_number in course_ids:
+            course_id = (school_id, course_number)
+            f.write('course %s\n' % '.'.join(part for part in course_id if part is not None))
+            course = self.courses.get(course_id)
+            if course is None:
+                f.write('  not in math-courses.txt, so none of its sections or enrollments are read\n')
+                continue
+            f.write('  in math-courses.txt as "%s"\n' % course.target_course_name)
+            if course.course_name is None:
+                f.write('  not in the PowerSchool courses file\n')
+            if course_id in self.course_map:
+                f.write('  uploaded as part of course %s\n' % self.course_map[course_id])
+            rule = self.exclusions.match(school_id, course_number) if self.exclusions else None
+            if rule is not None:
+                f.write('  left out by the exclusion rule %s in %s\n' % (rule, exclusions.FILE_NAME))
+                continue
+            section_ids = self.course_sections.get(course_id, [ ])
+            skipped = self.skipped_sections.get(course_id, [ ])
+            if not section_ids and not skipped:
+                f.write('  no sections in the sections file\n')
+            for section_id in section_ids:
+                plan = self.section_plan[section_id]
+                native_section_code = plan.native_section_code
+                students = len(self.section_students.get(native_section_code, [ ]))
+                if plan.exported:
+                    f.write('  section %s: uploaded, teacher T%s, %d students\n' % (section_id[2],
+                        plan.section.teacher_number, students))
+                else:
+                    f.write('  section %s: folded into section %s, %d students there\n' % (section_id[2],
+                        native_section_code, students))
+            for section, reason in skipped:
+                section_id = section.key()
+                students = sum(1 for enrolled_section_id, _ in self.section_students.get(
+                    self.nativeSectionCode(section_id), [ ]) if enrolled_section_id == section_id)
+                f.write('  section %s: left out, %s; %d students still sent in it\n' % (section.section_number,
+                    reason, students))
+
+    # Every mapped course, with its sections and students
+    def dumpAllCourses(self, f):
+        w = csv.writer(f, dialect='excel-tab')
+        w.writerow(['code', 'course_number', 'target_course_number', 'course_name', 'powerschool_name',
+            'sections', 'skipped_sections', 'students'])
+        for course_id, course in self.courses.iteritems():
+            section_ids = self.course_sections.get(course_id, [ ])
+            native_section_codes = set(self.native_section_codes[section_id] for section_id in section_ids)
+            students = sum(len(self.section_students.get(code, [ ])) for code in native_section_codes)
+            w.writerow(['.'.join(course_id), course.course_number, self.course_map.get(course_id, course.course_number),
+                course.target_course_name, course.course_name or '', len(section_ids),
+                len(self.skipped_sections.get(course_id, [ ])), students])
+
+    # One line per active enrollment, streamed as it is written. What is
+    # looked up for a section is looked up once, not for every student.
+    def dumpActiveEnrollments(self, f):
         w = csv.writer(f, dialect='excel-tab')
         w.writerow(['course_name', 'course_number', 'section_number', 'teacher_id', 'teacher_name', 'code', 'student_id'])
-        for enrollment_id, enrollment_data in self.enrollments.iteritems():
-            school_id, course_id, student_id, course_number, section_number, teacher_id = enrollment_id.split('.')
-            course_name = self.courses[course_number]['Course_Name']
-            teacher_name = self.teachers[teacher_id]['Last_Name']
-            section_id = '.'.join((school_id, course_number, section_number))
-            section_data = self.sections[section_id]
-            term = section_data['[13]Abbreviation']
-            w.writerow([course_name, course_number, section_number, teacher_id, teacher_name, course_id, student_id])
+        section_columns = { }
+        def rows():
+            for enrollment_id in self.enrollments:
+                section_id = enrollment_id[:3]
+                columns = section_columns.get(section_id)
+                if columns is None:
+                    school_id, course_number, section_number = section_id
+                    _, teacher_number, teacher_name = self.sectionInfo(section_id)
+                    course_name = self.courses[section_id[:2]].course_name
+                    columns = section_columns[section_id] = (course_name, course_number, section_number,
+                        teacher_number, teacher_name, school_id + '.' + course_number)
+                yield columns + (enrollment_id[3], )
+        w.writerows(rows())
+
+    # Output files are written straight into a zip member while
+    # buildZipFile is running, and also to output_dir if loose_files is
+    # set. Otherwise they are written to output_dir only. Python 2's
+    # zipfile cannot open a member for writing, so each member is
+    # buffered in memory and added whole.
+    #
+    # source_rows is the number of records the writer looks at, for the
+    # write phase's rows_read.
+    #
+    # With spill_bytes, the file is written to output_dir as it goes,
+    # and the zip archive compresses it from there when it is closed, so
+    # the file is never in memory; buildZipFile removes it afterwards
+    # unless loose_files is set. Files rendered into a MemoryArchive are
+    # still buffered.
+    @contextlib.contextmanager
+    def openOutput(self, name, source_rows=None):
+        file_name = name + '.txt'
+        with self.metrics.phase('write', file=file_name) as phase:
+            if self.spill_bytes and not isinstance(self.archive, MemoryArchive):
+                path = os.path.join(self.output_dir, file_name)
+                with open(path, 'wb') as f:
+                    counter = LineCounter(f)
+                    yield counter
+                    size = f.tell()
+                if self.archive is not None:
+                    self.zipDiskOutput(file_name)
+                lines = counter.lines
+            else:
+                buf = io.BytesIO()
+                yield buf
+                data = buf.getvalue()
+                if self.archive is not None:
+                    self.archive.writestr(file_name, data)
+                if self.archive is None or self.loose_files:
+                    with open(os.path.join(self.output_dir, file_name), 'w') as f:
+                        f.write(data)
+                size = len(data)
+                lines = data.count('\r\n')
+            # Less the header line
+            phase.rows_kept = lines - 1
+            phase.rows_read = phase.rows_kept if source_rows is None else source_rows
+            self.metrics.set('output_bytes', size, file=file_name)
+
+    def zipDiskOutput(self, file_name):
+        path = os.path.join(self.output_dir, file_name)
+        self.archive.writefile(file_name, path)
+        if not self.loose_files:
+            self.disk_outputs.append(path)
+
+    # Output files as a {file name: data} dict, written by the given
+    # writer methods without touching the disk
+    def renderFiles(self, writers):
+        self.archive = MemoryArchive()
+        try:
+            for writer in writers:
+                writer()
+            return self.archive.files
+        finally:
+            self.archive = None
+
+    # The given OUTPUT_FILES names, or all of them, rendered in memory
+    def renderOutputs(self, names=None):
+        return self.renderFiles([getattr(self, OUTPUT_WRITERS[name]) for name in OUTPUT_FILES
+            if names is None or name in names])
+
+    # In OUTPUT_FILES order, which is also the order of the zip members
+    def writeAllFiles(self):
+        self.writeDistrictFile()
+        self.writeSchoolsFile()
+        self.writeStaffFile()
+        self.writeStudentFile()
+        self.writeSectionsFile()
+        self.writeSectionStaffFile()
+        self.writeSectionStudentFile()
+        self.writeAssignmentFile()
+
+    # Each output file written by its own process, handed to the zip
+    # archive as it comes back, in OUTPUT_FILES order. The pool is
+    # started before the archive's compression threads, so the writer
+    # processes are not forked in the middle of using them.
+    def startWriterStages(self):
+        global _stage_uploader
+        _stage_uploader = self
+        try:
+            return multiprocessing.Pool(min(self.jobs, len(OUTPUT_FILES)))
+        finally:
+            _stage_uploader = None
+
+    # With spill_bytes, each stage writes its file to output_dir and
+    # sends back None for the data
+    def writeStages(self, pool):
+        try:
+            for name, data, phases, gauges in pool.imap(_writeStage, OUTPUT_FILES):
+                self.metrics.extend(phases)
+                self.metrics.gauges.extend(gauges)
+                if data is None:
+                    self.zipDiskOutput(name + '.txt')
+                else:
+                    self.archive.writestr(name + '.txt', data)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # Write every output file into the zip archive. With in_memory the
+    # archive never touches the disk and its bytes are returned, ready
+    # for uploadZipFile. With spill_bytes the archive is always built in
+    # output_dir, so that neither it nor PIF_SECTION_STUDENT is held in
+    # memory, and None is returned.
+    def buildZipFile(self, in_memory=False):
+        in_memory = in_memory and not self.spill_bytes
+        target = io.BytesIO() if in_memory else os.path.join(self.output_dir, self.zip_file)
+        pool = self.startWriterStages() if self.jobs > 1 else None
+        self.archive = self.openZip(target)
+        try:
+            if pool is not None:
+                self.writeStages(pool)
+            else:
+                self.writeAllFiles()
+        finally:
+            try:
+                self.closeZip(self.archive)
+            finally:
+                self.archive = None
+                for path in self.disk_outputs:
+                    os.remove(path)
+                self.disk_outputs = [ ]
+        if in_memory:
+            zip_data = target.getvalue()
+            self.metrics.set('zip_bytes', len(zip_data), file=self.zip_file)
+            return zip_data
+        self.metrics.set('zip_bytes', os.path.getsize(target), file=self.zip_file)
+        return None
 
     def writeDistrictFile(self):
-        with open(os.path.join(self.output_dir, 'CODE_DISTRICT.txt'), 'w') as f:
+        with self.openOutput('CODE_DISTRICT') as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['district_code', 'district_name',
                 'address_1', 'address_2', 'city', 'state', 'zip', 'phone', 'current_school_year'])
-            w.writerow(['2165334', 'Kentfield Elementary School District',
-                '750 College Ave', '', 'Kentfield', 'CA', '94904', '415-458-5130', self.current_year])
+            d = self.district
+            w.writerow([d.district_code, d.district_name,
+                d.address_1, d.address_2, d.city, d.state, d.zip, d.phone, self.current_year])
 
     def writeSchoolsFile(self):
-        with open(os.path.join(self.output_dir, 'SCHOOL.txt'), 'w') as f:
+        with self.openOutput('SCHOOL') as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['school_code', 'school_name', 'district_code', 'grade_start', 'grade_end',
                 'address_1', 'address_2', 'city', 'state', 'zip', 'phone'])
-            w.writerow([104, 'Adaline E. Kent Middle School', '2165334', '5', '8',
-                '800 College Ave', '', 'Kentfield', 'CA', '94904', '415-458-5970'])
+            for school in self.district.schools:
+                w.writerow([school['school_code'], school['school_name'], self.district.district_code,
+                    school['grade_start'], school['grade_end'], school['address_1'], school['address_2'],
+                    school['city'], school['state'], school['zip'], school['phone']])
 
     def writeSectionsFile(self):
-        course_year = str(self.current_year + 1)
-        with open(os.path.join(self.output_dir, 'PIF_SECTION.txt'), 'w')  as f:
+        with self.openOutput('PIF_SECTION', len(self.sections)) as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['native_section_code', 'school_code', # 'section_type', 'section_type_description',
                 'date_start', 'date_end', 'school_year', 'course_number',
                 'course_name','section_name', 'section_number'])
-            for school_section_id in self.sections:
-                row = self.sections[school_section_id]
-                school_id = row['SchoolID']
-                course_number = row['Course_Number']
-                section_number = row['Section_Number']
-                course_id = '.'.join((school_id, course_number))
-
-                # Filter out mapped courses
-                if course_id not in self.courses or course_id in self.course_map:
-                    continue
-
-                # Filter out mapped sections
-                native_section_code = '.'.join((course_number, section_number))
-                if native_section_code in self.section_map:
-                    continue
-
-                course_name = self.courses[course_id]['Target_Course_Name']
-                period = re.sub(r'^(\d+)(.+)$', r'P\1', row['Expression'])
-                date_start = formatDate(row['[13]FirstDay'])
-                date_end = formatDate(row['[13]LastDay'])
-
-                # TODO: Check Onboarding Guide about maximum length of the section name
-                section_name = course_name + ' - ' + self.getTeacherName('T' + row['[05]TeacherNumber']) + ' ' + period + ' ' + course_year
-                w.writerow([native_section_code, school_id,
-                    date_start, date_end,
-                    self.current_year, course_number,
-                    course_name, section_name, section_number])
+            for plan in self.exported_sections:
+                section = plan.section
+                w.writerow([plan.native_section_code, section.school_id,
+                    plan.date_start, plan.date_end,
+                    self.current_year, section.course_number,
+                    plan.course_name, plan.section_name, section.section_number])
 
     def writeStaffFile(self):
-        with open(os.path.join(self.output_dir, 'STAFF.txt'), 'w') as f:
+        with self.openOutput('STAFF', len(self.teachers)) as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['staff_code', 'last_name', 'first_name', 'email', 'staff_number', 'federated_id'])
-            for teacher_id, teacher_data in self.teachers.iteritems():
-                if teacher_data['Assigned'] != '0':
-                    school_id = teacher_data['SchoolID']
-                    teacher_number = teacher_data['TeacherNumber']
-                    last_name = teacher_data['Last_Name']
-                    first_name = teacher_data['First_Name']
-                    email = teacher_data['Email_Addr']
-                    w.writerow([teacher_number, last_name, first_name, email, teacher_number, email])
+            for teacher in self.teachers.itervalues():
+                if teacher.assigned != records.NOT_ASSIGNED:
+                    teacher_number = teacher.teacher_number
+                    email = teacher.email
+                    w.writerow([teacher_number, teacher.last_name, teacher.first_name, email, teacher_number, email])
 
     def writeStudentFile(self):
-        with open(os.path.join(self.output_dir, 'STUDENT.txt'), 'w') as f:
+        email_suffix = '@' + self.district.email_domain
+        with self.openOutput('STUDENT', len(self.students)) as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['student_code', 'last_name', 'first_name', 'gender_code',
                 'email', 'student_number', 'federated_id'])
-            for student_id, student_data in self.students.iteritems():
-                if student_data['Enrolled'] == '1':
-                    school_id = student_data['SchoolID']
-                    last_name = student_data['Last_Name']
-                    first_name = student_data['First_Name']
-                    student_number = student_data['Student_Number']
-                    gender = student_data['Gender']
-                    email = student_data['Network_ID'] + '@kentfieldschools.org'
-                    w.writerow([student_number, last_name, first_name, gender,
+            for student in self.students.itervalues():
+                if student.enrolled:
+                    student_number = student.student_number
+                    email = student.network_id + email_suffix
+                    w.writerow([student_number, student.last_name, student.first_name, student.gender,
                         email, student_number, email])
 
     def writeSectionStaffFile(self):
-        with open(os.path.join(self.output_dir, 'PIF_SECTION_STAFF.txt'), 'w')  as f:
+        with self.openOutput('PIF_SECTION_STAFF', len(self.sections)) as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['section_teacher_code', 'staff_code', 'native_section_code',
                 'date_start', 'date_end', 'school_year', 'teacher_of_record'])
-            for school_section_id in self.sections:
-                row = self.sections[school_section_id]
-                school_id = row['SchoolID']
-                course_number = row['Course_Number']
-                section_number = row['Section_Number']
-                course_id = '.'.join((school_id, course_number))
-
-                # Filter out mapped courses
-                if course_id not in self.courses or course_id in self.course_map:
-                    continue
-
-                # Filter out mapped sections
-                native_section_code = '.'.join((course_number, section_number))
-                if native_section_code in self.section_map:
-                    continue
-
-                teacher_number = row['[05]TeacherNumber']
-                section_teacher_code = '.'.join((course_number, section_number, teacher_number))
-                native_section_code = '.'.join((course_number, section_number))
-
+            for plan in self.exported_sections:
                 # Use real teacher assingment dates if possible
-                w.writerow([section_teacher_code, teacher_number, native_section_code,
-                    formatDate(row['[13]FirstDay']), formatDate(row['[13]LastDay']),
+                w.writerow([plan.section_teacher_code, plan.section.teacher_number, plan.native_section_code,
+                    plan.date_start, plan.date_end,
                     self.current_year, 'true'])
 
     def writeSectionStudentFile(self):
-        seen_enrollments = { }
-        with open(os.path.join(self.output_dir, 'PIF_SECTION_STUDENT.txt'), 'w')  as f:
+        seen_enrollments = set()
+        native_section_codes = self.native_section_codes
+        source_rows = self.enrollmentCount() + sum(len(extras) for extras in self.extras.itervalues())
+        with self.openOutput('PIF_SECTION_STUDENT', source_rows) as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['section_student_code', 'student_code', 'native_section_code',
                 'date_start', 'date_end', 'school_year'])
-            for enrollment_id, enrollment_data in self.enrollments.iteritems():
-                school_id, course_number, section_number, student_id = enrollment_id.split('.')
-                student_number = self.students[student_id]['Student_Number']
-
-                # Change setion_student_code and native_section_code based
+            if self.enrollment_spill is not None:
+                self.writeSpilledEnrollments(w)
+            for enrollment_id, enrollment in self.enrollments.iteritems():
+                # setion_student_code and native_section_code are based
                 # on mapped courses and sections
-                course_id = '.'.join((school_id, course_number))
-                if course_id in self.course_map:
-                    course_number = self.course_map[course_id]
-
-                source_section_code = '.'.join((course_number, section_number))
-                native_section_code = source_section_code
-                if native_section_code in self.section_map:
-                    native_section_code = self.section_map[native_section_code]
-
-                section_student_code = '.'.join((native_section_code, student_number))
+                student_number = enrollment_id[3]
+                native_section_code = native_section_codes[enrollment_id[:3]]
+                section_student_code = native_section_code + '.' + student_number
                 if section_student_code not in seen_enrollments:
-                    date_start = formatDate(enrollment_data['DateEnrolled'])
-                    date_end = formatDate(enrollment_data['DateLeft'])
-                    seen_enrollments[section_student_code] = (source_section_code, date_start, date_end)
+                    seen_enrollments.add(section_student_code)
                     w.writerow([section_student_code, student_number, native_section_code,
-                        date_start, date_end, self.current_year])
+                        enrollment.date_enrolled[1], enrollment.date_left[1], self.current_year])
 
             # Now handle special "extras" - teachers posing as students, etc.
-            for school_section_id in self.extras:
-                school_id, course_number, section_number = school_section_id.split('.')
-                extras = self.extras[school_section_id]
-                for student_id in extras:
-                    student_number = self.students[student_id]['Student_Number']
-                    section_student_code = '.'.join((course_number, section_number, student_number))
-                    native_section_code = '.'.join((course_number, section_number))
-                    date_start = formatDate(self.sections[school_section_id]['[13]FirstDay'])
-                    date_end = formatDate(self.sections[school_section_id]['[13]LastDay'])
+            for section_id, extras in self.extras.iteritems():
+                plan = self.section_plan.get(section_id)
+                if plan is None:
+                    print "extra students in section %s.%s (%s), which is not loaded" % (section_id[1],
+                        section_id[2], ', '.join(extras))
+                    continue
+                native_section_code = plan.native_section_code
+                for student_number in extras:
+                    section_student_code = native_section_code + '.' + student_number
                     w.writerow([section_student_code, student_number, native_section_code,
-                        date_start, date_end, self.current_year])
+                        plan.date_start, plan.date_end, self.current_year])
+
+    # The spilled rows come back sorted by section_student_code, then in
+    # the order they were read, so of the rows with the same code the one
+    # written is the first read (schools in math-courses.txt order, rows
+    # in file order)
+    def writeSpilledEnrollments(self, w):
+        last_code = None
+        for (section_student_code, _, student_number, native_section_code,
+                date_start, date_end) in self.enrollment_spill.merged():
+            if section_student_code != last_code:
+                last_code = section_student_code
+                w.writerow([section_student_code, student_number, native_section_code,
+                    date_start, date_end, self.current_year])
 
     def writeAssignmentFile(self):
-        with open(os.path.join(self.output_dir, 'ASSIGNMENT.txt'), 'w')  as f:
+        with self.openOutput('ASSIGNMENT', len(self.teachers)) as f:
             w = csv.writer(f, dialect='excel', quoting=csv.QUOTE_ALL)
             w.writerow(['native_assignment_code', 'staff_code', 'school_year', 'institution_code',
                 'date_start', 'date_end', 'position_code'])
-            school_id = '104'
-            for teacher_id, teacher_data in self.teachers.iteritems():
-                if teacher_data['Assigned'] == '2':
-                    teacher_number = teacher_data['TeacherNumber']
+            school_id = self.district.assignment_school_code
+            for teacher in self.teachers.itervalues():
+                if teacher.assigned == records.ASSIGNED:
+                    teacher_number = teacher.teacher_number
                     native_assignment_code = '.'.join((school_id, teacher_number))
                     w.writerow([native_assignment_code, teacher_number, self.current_year, school_id,
                         self.year_start, self.year_end, 'Teacher'])
 
-    def zipAllFiles(self):
-        with zipfile.ZipFile(os.path.join(self.output_dir, 'KENTFIELD.zip'), 'w') as myzip:
-            for name in ['CODE_DISTRICT', 'SCHOOL', 'STAFF', 'STUDENT', 'PIF_SECTION', 'PIF_SECTION_STAFF', 'PIF_SECTION_STUDENT', 'ASSIGNMENT']:
-                arcname = name + '.txt'
-                myzip.write(os.path.join(self.output_dir, arcname), arcname)
+    # Write delta versions of the output files, relative to the snapshot
+    # of the last successful upload, into output_dir/delta
+    def writeDeltaFiles(self, snapshot):
+        delta_dir = os.path.join(self.output_dir, 'delta')
+        self.delta_written = True
+        stats = snapshot.writeDeltaFiles(self.output_dir, delta_dir, OUTPUT_FILES,
+            self.effective_date.isoformat())
+        for name in OUTPUT_FILES:
+            if name in stats:
+                print "%s: %d added, %d changed, %d removed" % ((name, ) + stats[name])
+        return delta_dir
 
-    def uploadZipFile(self, host, folder, username, password):
-        try:
-            # cnopts = pysftp.CnOpts(knownhosts='./known_hosts.txt')
-            # cnopts.hostkeys = None
-            sftp = pysftp.Connection(host, username=username, password=password)
-        except Exception as e:
-            print "Can't connect SFTP: %s" % e
-            return
+    # Members are compressed in threads while the rest are written; see
+    # ziparchive
+    def openZip(self, target):
+        return ziparchive.ZipBuilder(target, self.compression, self.compress_level)
+
+    # Report the compression ratio and time, to weigh the compression
+    # level against upload time
+    def closeZip(self, archive):
+        with self.metrics.phase('zip', file=self.zip_file) as phase:
+            stats = archive.close()
+            phase.labels['compression'] = '%s-%d' % (self.compression, self.compress_level)
+            phase.rows_read = phase.rows_kept = stats.members
+        print "%s: %s" % (self.zip_file, stats)
+        self.metrics.set('zip_input_bytes', stats.input_bytes, file=self.zip_file)
+        self.metrics.set('zip_ratio', stats.ratio, file=self.zip_file)
+        self.metrics.set('zip_compress_seconds', stats.compress_seconds, file=self.zip_file)
+        return stats
+
+    # Zip output files already rendered by renderFiles
+    def zipRenderedFiles(self, files):
+        zip_path = os.path.join(self.output_dir, self.zip_file)
+        archive = self.openZip(zip_path)
+        for name in OUTPUT_FILES:
+            archive.writestr(name + '.txt', files[name + '.txt'])
+        self.closeZip(archive)
+        self.metrics.set('zip_bytes', os.path.getsize(zip_path), file=self.zip_file)
+
+    def zipAllFiles(self, files_dir=None):
+        files_dir = files_dir or self.output_dir
+        zip_path = os.path.join(self.output_dir, self.zip_file)
+        archive = self.openZip(zip_path)
+        for name in OUTPUT_FILES:
+            arcname = name + '.txt'
+            with open(os.path.join(files_dir, arcname), 'rb') as f:
+                archive.writestr(arcname, f.read())
+        self.closeZip(archive)
+        self.metrics.set('zip_bytes', os.path.getsize(zip_path), file=self.zip_file)
+
+    def snapshot(self):
+        return delta.Snapshot(os.path.join(self.state_dir, 'snapshot'))
+
+    # After every successful upload, full or delta, what was sent becomes
+    # the snapshot the next --delta run is taken against
+    def commitSnapshot(self, zip_data=None):
+        snapshot = self.snapshot()
+        with self.metrics.phase('snapshot'):
+            if self.delta_written:
+                snapshot.commit(self.output_dir, OUTPUT_FILES)
+            elif zip_data is not None:
+                snapshot.commitZip(io.BytesIO(zip_data), OUTPUT_FILES)
+            else:
+                snapshot.commitZip(os.path.join(self.output_dir, self.zip_file), OUTPUT_FILES)
+
+    def newTransfer(self, host, username, password, **options):
+        return transfer.SftpTransfer(host, username, password, run_metrics=self.metrics, **options)
+
+    # Uploads zip_data if given, otherwise the zip file in output_dir.
+    # options are passed on to transfer.SftpTransfer. sftp is one already
+    # connected, or connecting in the background, by newTransfer.
+    # Returns the transfer.TransferResult, or None if the upload failed.
+    def uploadZipFile(self, host, folder, username, password, zip_data=None, sftp=None, **options):
+        if sftp is None:
+            sftp = self.newTransfer(host, username, password, **options)
+        if zip_data is None:
+            f = open(os.path.join(self.output_dir, self.zip_file), 'rb')
+        else:
+            f = io.BytesIO(zip_data)
         try:
-            with sftp.cd(folder):
-              localpath = os.path.join(self.output_dir, 'KENTFIELD.zip')
-              sftp.put(localpath)
-              print "zip file uploaded"
-        except Exception as e:
-            print "Can't put SFTP: %s" % e
+            result = sftp.upload(f, folder, self.zip_file)
+        except transfer.TransferError as e:
+            print "Can't upload zip file: %s" % e
+            return None
         finally:
+            f.close()
             sftp.close()
+        print "zip file uploaded: %s" % result
+        self.commitSnapshot(zip_data)
+        self.metrics.set('upload_bytes', result.size, file=self.zip_file)
+        self.metrics.set('upload_attempts', result.attempts, file=self.zip_file)
+        if result.bytes_per_second is not None:
+            self.metrics.set('upload_bytes_per_second', result.bytes_per_second, file=self.zip_file)
+        return result
+
+# Library entry points, for running the steps of the command line
+# in-process, from a scheduler or worker.py:
+#
+#   uploader = easybridge.load(source_dir='/data/autosend', autosend=True)
+#   built = easybridge.build(uploader)
+#   result = easybridge.upload(uploader, built)
+#   easybridge.archive(uploader, built)
+#
+# Each step returns its result instead of an exit status. Options are
+# EasyBridgeUploader's, and the SFTP settings default to the district's.
+# pysftp and paramiko are only imported by an upload, dateutil by a date
+# that is not M/D/YYYY, and NumPy by previewRange.
+
+# zip_path is None for a zip file built in memory, zip_data None for one
+# in output_dir
+class BuildResult(object):
+    def __init__(self, zip_file, zip_path, zip_data, zip_bytes, zip_hash):
+        self.zip_file = zip_file
+        self.zip_path = zip_path
+        self.zip_data = zip_data
+        self.zip_bytes = zip_bytes
+        self.zip_hash = zip_hash
+
+# Returns the loaded EasyBridgeUploader. Raises
+# validation.ValidationError or sourcereader.SourceFormatError if the
+# source files cannot be used.
+def load(**options):
+    uploader = EasyBridgeUploader(**options)
+    uploader.loadData()
+    return uploader
+
+def build(uploader, in_memory=True):
+    zip_data = uploader.buildZipFile(in_memory=in_memory)
+    if zip_data is not None:
+        return BuildResult(uploader.zip_file, None, zip_data, len(zip_data), fingerprint.hashBytes(zip_data))
+    zip_path = os.path.join(uploader.output_dir, uploader.zip_file)
+    return BuildResult(uploader.zip_file, zip_path, None, os.path.getsize(zip_path),
+        fingerprint.hashFile(zip_path))
+
+# A transfer.SftpTransfer for upload. Call its connectInBackground to log
+# in while the zip file is being built.
+def connect(uploader, host=None, username=None, password=None, port=None, known_hosts=None, **options):
+    sftp = uploader.district.sftp
+    return uploader.newTransfer(host or sftp['host'], username or sftp['username'],
+        password or uploader.district.sftpPassword(), port=port or sftp['port'],
+        known_hosts=known_hosts or sftp['known_hosts'], **options)
+
+# Uploads built, or without it the zip file in output_dir, and returns
+# the transfer.TransferResult, or None if the upload failed
+def upload(uploader, built=None, folder=None, connection=None):
+    connection = connection or connect(uploader)
+    return uploader.uploadZipFile(connection.host, folder or uploader.district.sftp['folder'],
+        connection.username, connection.password, zip_data=built and built.zip_data, sftp=connection)
+
+# Stores the source files and the zip members of an upload in the run
+# archive (see runarchive), by default state_dir/archive. inputs is the
+# fingerprint taken before loading, if there is one. Returns the run's
+# manifest.
+def archive(uploader, built=None, inputs=None, archive_dir=None):
+    run_archive = runarchive.Archive(archive_dir or os.path.join(uploader.state_dir, 'archive'))
+    with uploader.metrics.phase('archive'):
+        if built is not None and built.zip_data is not None:
+            zip_file = io.BytesIO(built.zip_data)
+        else:
+            zip_file = os.path.join(uploader.output_dir, uploader.zip_file)
+        manifest = run_archive.storeRun(uploader.source_dir, inputs or uploader.fingerprintInputs(),
+            uploader.zip_file, zip_file, uploader.compression, uploader.compress_level)
+    print "archived run %s: %d new files, %d bytes" % (manifest['run_id'], manifest['blobs_added'],
+        manifest['bytes_added'])
+    uploader.metrics.set('archive_blobs_added', manifest['blobs_added'])
+    uploader.metrics.set('archive_bytes_added', manifest['bytes_added'])
+    return manifest
+
+# Run the command line workflow and return the exit status
+def run(args):
+    eff_date = None
+    if args.effective_date:
+      eff_date = parseDate(args.effective_date)
+
+    if args.district:
+        district_config = district.District.load(args.district)
+    else:
+        district_config = district.District()
+    state_dir = args.state_dir or district_config.state_dir
+    cache = None
+    if not args.no_cache:
+        cache = sourcecache.SourceCache(args.cache_dir or os.path.join(state_dir, 'cache'),
+            args.cache_size << 20)
+
+    archive_dir = args.archive_dir or os.path.join(state_dir, 'archive')
+    source_dir = args.source_dir
+    autosend = args.autosend or district_config.autosend
+    if args.from_run:
+        # Run again on the source files and date of an archived run
+        source_dir = os.path.join(state_dir, 'restore', args.from_run)
+        try:
+            restored = runarchive.Archive(archive_dir).restore(args.from_run, source_dir)
+        except runarchive.ArchiveError as e:
+            print "Can't restore run: %s" % e
+            return 1
+        print "restored the source files of run %s to %s" % (args.from_run, source_dir)
+        eff_date = eff_date or parseDate(restored['settings']['effective_date'])
+        autosend = restored['settings']['autosend']
+
+    def newUploader(effective_date):
+        return EasyBridgeUploader(source_dir=source_dir, output_dir=args.output_dir,
+            autosend=autosend, effective_date=effective_date,
+            state_dir=state_dir, jobs=args.jobs or multiprocessing.cpu_count(),
+            loose_files=args.write_files, district_config=district_config, cache=cache,
+            indexes=bool(args.dump or args.query), compression=args.zip_compression,
+            compress_level=args.zip_level, spill_bytes=args.spill_mb and args.spill_mb << 20,
+            invalid_rows=args.invalid_rows)
+
+    def newTransfer(uploader):
+        return connect(uploader, args.sftp_host, args.username, args.password, args.sftp_port,
+            args.known_hosts, retries=args.retries, retry_wait=args.retry_wait, verify=args.verify)
+
+    # connection is a transfer from newTransfer, otherwise one is opened
+    def uploadZip(uploader, built=None, connection=None):
+        return upload(uploader, built, args.sftp_folder, connection or newTransfer(uploader))
+
+    # An archive that cannot be written does not fail an upload that
+    # has been made
+    def archiveRun(uploader, built, inputs):
+        if args.no_archive:
+            return
+        try:
+            archive(uploader, built, inputs, archive_dir)
+            removed_runs, removed_blobs, freed = runarchive.Archive(archive_dir).collect(
+                args.keep_days, args.keep_runs)
+        except (runarchive.ArchiveError, IOError, OSError) as e:
+            print "Can't archive run: %s" % e
+            return
+        if removed_runs or removed_blobs:
+            print "removed %d old runs and %d files (%d bytes) from the archive" % (
+                removed_runs, removed_blobs, freed)
+
+    if args.watch:
+        return runWatch(args, newUploader, uploadZip, archiveRun, eff_date)
+
+    uploader = newUploader(eff_date)
+    connection = None
+    try:
+        # Skip the whole run if these exact inputs were already uploaded
+        inputs = None
+        manifest = None
+        if not (args.dump or args.query or args.dry_run or args.preview_range):
+            inputs = uploader.fingerprintInputs()
+            manifest = fingerprint.Manifest(os.path.join(uploader.state_dir, 'fingerprint.json'))
+            if manifest.matches(inputs) and not args.force:
+                print "inputs unchanged since last upload at %s, nothing to do" % manifest.data['uploaded_at']
+                return 0
+            # Log in to the SFTP server while the zip file is built
+            connection = newTransfer(uploader)
+            connection.connectInBackground()
+
+        if args.preview_range:
+            uploader.previewRange(args.preview_range, args.preview_file)
+            return 0
+
+        uploader.loadData()
+        if args.query:
+            kind, key = args.query
+            getattr(uploader, 'query' + kind.capitalize())(key, sys.stdout)
+        elif args.dump:
+            uploader.dumpAllCourses(sys.stdout)
+            sys.stdout.write('\n')
+            uploader.dumpActiveEnrollments(sys.stdout)
+        else:
+            built = None
+            if args.delta:
+                # The delta is taken between full output files on disk
+                uploader.writeAllFiles()
+                uploader.zipAllFiles(uploader.writeDeltaFiles(uploader.snapshot()))
+            else:
+                # Keep the zip file for a dry run, otherwise stream it to SFTP
+                built = build(uploader, in_memory=not args.dry_run)
+            if args.dry_run:
+                print "dry run, zip file created but not uploaded"
+            else:
+                uploaded = uploadZip(uploader, built, connection)
+                # A failed upload has to be visible to the scheduler
+                if not uploaded:
+                    return 1
+                if built is None:
+                    zip_hash = fingerprint.hashFile(os.path.join(uploader.output_dir, uploader.zip_file))
+                else:
+                    zip_hash = built.zip_hash
+                manifest.save(inputs, uploader.zip_file, zip_hash)
+                archiveRun(uploader, built, inputs)
+        return 0
+    except sourcereader.SourceFormatError as e:
+        print "Can't read source files: %s" % e
+        return 1
+    except validation.ValidationError as e:
+        print "Can't build: %s" % e
+        return 1
+    except IOError as e:
+        # --dump or --query piped into something like head
+        if e.errno == errno.EPIPE:
+            return 0
+        raise
+    finally:
+        # After a failed build, drop the session opened for the upload
+        if connection is not None:
+            connection.close()
+        uploader.closeSpill()
+        if args.validation_report:
+            uploader.validation.write(args.validation_report)
+        if args.metrics:
+            uploader.metrics.writeJson(args.metrics)
+        if args.prometheus:
+            uploader.metrics.writePrometheus(args.prometheus)
+
+# --watch. The manifest is saved only if the files uploaded are still
+# the ones in the source directory, so a nightly run never skips files
+# that arrived during an upload.
+def runWatch(args, new_uploader, upload_zip, archive_run, effective_date):
+    def upload(uploader, up_to_date):
+        if args.dry_run:
+            print "dry run, zip file created but not uploaded"
+            return True
+        inputs = uploader.fingerprintInputs()
+        manifest = fingerprint.Manifest(os.path.join(uploader.state_dir, 'fingerprint.json'))
+        if manifest.matches(inputs) and not args.force:
+            print "inputs unchanged since last upload at %s" % manifest.data['uploaded_at']
+            return True
+        if not upload_zip(uploader):
+            return False
+        if up_to_date:
+            zip_hash = fingerprint.hashFile(os.path.join(uploader.output_dir, uploader.zip_file))
+            manifest.save(inputs, uploader.zip_file, zip_hash)
+            archive_run(uploader, None, inputs)
+        return True
+
+    source_dir = args.source_dir or new_uploader(effective_date).source_dir
+    watcher = watch.Watcher(new_uploader, upload, source_dir, effective_date,
+        poll_interval=args.poll_interval, upload_delay=args.upload_delay)
+    return watcher.run()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process files for Pearson EasyBridge.')
+    parser.add_argument('--district', help='district settings file (default: Kentfield)')
     parser.add_argument('-a', '--autosend', action='store_true',
         help='use autosend files (no header line)')
     parser.add_argument('-t', '--effective-date')
     parser.add_argument('-n', '--dry-run', action='store_true')
     parser.add_argument('-s', '--source_dir', help='source directory')
     parser.add_argument('-o', '--output_dir', help='output directory')
+    parser.add_argument('--state_dir', help='directory for state kept between runs')
     parser.add_argument('-u', '--username')
     parser.add_argument('-p', '--password')
+    parser.add_argument('--sftp-host')
+    parser.add_argument('--sftp-port', type=int)
+    parser.add_argument('--sftp-folder')
+    parser.add_argument('--known-hosts', help='known_hosts file with the SFTP host key (default ~/.ssh/known_hosts)')
+    parser.add_argument('--retries', type=int, default=transfer.DEFAULT_RETRIES,
+        help='number of times to retry a failed upload')
+    parser.add_argument('--retry-wait', type=float, default=transfer.DEFAULT_RETRY_WAIT,
+        help='seconds to wait before the first retry, doubled for each one after')
+    parser.add_argument('--verify', choices=[transfer.VERIFY_SIZE, transfer.VERIFY_CHECKSUM],
+        default=transfer.VERIFY_CHECKSUM, help='how to check the uploaded file before renaming it into place')
+    parser.add_argument('--zip-compression', choices=ziparchive.COMPRESSIONS, default=ziparchive.DEFLATE)
+    parser.add_argument('--zip-level', type=int, choices=range(10), default=ziparchive.DEFAULT_LEVEL, metavar='0-9',
+        help='deflate level, from 1 (fastest) to 9 (smallest)')
     parser.add_argument('-d', '--dump', action='store_true',
-        help='dump courses and sections')
+        help='dump courses and active enrollments')
+    parser.add_argument('-q', '--query', nargs=2, metavar=('KIND', 'ID'),
+        help='show the sections of a student, the students of a teacher or of a native section, '
+            'or why a course is or is not uploaded (KIND is one of %s)' % ', '.join(QUERY_KINDS))
+    parser.add_argument('--delta', action='store_true',
+        help='upload only records changed since the last successful upload')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of processes for reading school files and writing output files (0 = one per core)')
+    parser.add_argument('--spill-mb', type=int, metavar='MB',
+        help='sort the enrollments for PIF_SECTION_STUDENT on disk, keeping about MB of them in memory')
+    parser.add_argument('--invalid-rows', choices=validation.POLICIES, default=validation.FAIL,
+        help='leave out rows with broken references, such as enrollments of unknown students, '
+            'or stop before building (the default)')
+    parser.add_argument('--validation-report', metavar='FILE',
+        help='write every reference problem found to FILE, as JSON if it ends in .json, otherwise tab-delimited')
+    parser.add_argument('-k', '--write-files', action='store_true',
+        help='also write the output .txt files to the output directory')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='upload even if the inputs match the last successful upload')
+    parser.add_argument('--cache-dir', help='directory for parsed source files (default: state_dir/cache)')
+    parser.add_argument('--cache-size', type=int, default=sourcecache.DEFAULT_MAX_BYTES >> 20,
+        help='largest size of the source cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='parse every source file')
+    parser.add_argument('--preview-range', type=int, metavar='DAYS',
+        help='show the students, sections and enrollments added and dropped on each of DAYS days from the effective date')
+    parser.add_argument('--preview-file', help='with --preview-range, write each added and dropped code to this file')
+    parser.add_argument('--watch', action='store_true',
+        help='keep running, rebuild as source files change and upload once they settle')
+    parser.add_argument('--poll-interval', type=float, default=watch.POLL_INTERVAL,
+        help='seconds between looks at the source directory with --watch')
+    parser.add_argument('--upload-delay', type=float, default=watch.UPLOAD_DELAY,
+        help='seconds without changes before uploading with --watch')
+    parser.add_argument('--archive-dir', help='directory for the run archive (default: state_dir/archive)')
+    parser.add_argument('--no-archive', action='store_true', help='do not archive uploaded runs')
+    parser.add_argument('--keep-days', type=int, default=runarchive.DEFAULT_KEEP_DAYS,
+        help='remove archived runs older than this (default: %(default)s)')
+    parser.add_argument('--keep-runs', type=int, default=runarchive.DEFAULT_KEEP_RUNS,
+        help='but always keep this many of the newest (default: %(default)s)')
+    parser.add_argument('--from-run', metavar='RUN_ID',
+        help='build from the source files and effective date of an archived run, without uploading')
+    parser.add_argument('--resend', action='store_true',
+        help='with --from-run, upload the rebuilt zip file to the SFTP folder')
+    parser.add_argument('--metrics', help='write run metrics to this JSON file')
+    parser.add_argument('--prometheus', help='write run metrics to this Prometheus textfile')
+    parser.add_argument('--profile', help='run under cProfile and write sorted stats to this file')
     args = parser.parse_args()
+    if args.watch and (args.dump or args.delta or args.query):
+        parser.error('--watch cannot be used with --dump, --delta or --query')
+    if args.from_run and (args.watch or args.source_dir):
+        parser.error('--from-run cannot be used with --watch or -s')
+    if args.resend and not args.from_run:
+        parser.error('--resend can only be used with --from-run')
+    # An old night's files only replace the live ones when asked to
+    if args.from_run and not args.resend:
+        args.dry_run = True
+    if args.spill_mb is not None and (args.watch or args.dump or args.query):
+        parser.error('--spill-mb cannot be used with --watch, --dump or --query')
+    if args.spill_mb is not None and args.spill_mb < 1:
+        parser.error('--spill-mb must be at least 1')
+    if args.query and args.query[0] not in QUERY_KINDS:
+        parser.error('query KIND must be one of %s' % ', '.join(QUERY_KINDS))
 
-    eff_date = None
-    if args.effective_date:
-      eff_date = parseDate(args.effective_date)
-
-    uploader = EasyBridgeUploader(source_dir=args.source_dir, output_dir=args.output_dir, autosend=args.autosend, effective_date=eff_date)
-    uploader.loadData()
-    if args.dump:
-        uploader.dumpAllCourses()
-        uploader.dumpActiveEnrollments()
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            status = profiler.runcall(run, args)
+        finally:
+            with open(args.profile, 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats()
     else:
-        uploader.writeDistrictFile()
-        uploader.writeSchoolsFile()
-        uploader.writeSectionsFile()
-        uploader.writeStaffFile()
-        uploader.writeStudentFile()
-        uploader.writeSectionStaffFile()
-        uploader.writeSectionStudentFile()
-        uploader.writeAssignmentFile()
-        uploader.zipAllFiles()
-        if args.dry_run:
-            print "dry run, zip file created but not uploaded"
-        else:
-            uploader.uploadZipFile('sftp.pifdata.net', 'SIS', args.username, args.password)
+        status = run(args)
+    sys.exit(status)
+
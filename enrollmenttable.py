@@ -0,0 +1,129 @@
+# Column-oriented enrollment table for --preview-range, which shows
+# what would be uploaded on each of the next few days, around term
+# changes for example.
+#
+# The daily run checks each roster row against the window for one
+# effective date while reading. This table keeps every enrollment in a
+# mapped course, whatever its dates, with the dates as datetime64 arrays,
+# so that the window check for a date is one vectorized comparison and a
+# whole range of dates is worked out in a single pass.
+#
+# Enrollments are identified by section_student_code (native section
+# code and student number), like the rows of PIF_SECTION_STUDENT, so
+# roster rows that repeat one are merged, and sections by their native
+# section code.
+
+import datetime
+
+import numpy as np
+
+# One day of a preview: the number of sections, students and enrollments
+# active that day, and the codes of the ones added and dropped since the
+# day before
+class DayChanges(object):
+    def __init__(self, date):
+        self.date = date
+        self.active = { }
+        self.added = { }
+        self.dropped = { }
+
+KINDS = ['students', 'sections', 'enrollments']
+
+class EnrollmentTable(object):
+    # Parallel lists, one entry per roster row; dates are yyyy-mm-dd
+    def __init__(self, section_codes, student_numbers, dates_enrolled, dates_left,
+            days_past, days_upcoming):
+        self.days_past = days_past
+        self.days_upcoming = days_upcoming
+        self.section_codes, self.section_index = np.unique(
+            np.array(section_codes, dtype=str), return_inverse=True)
+        self.student_numbers, self.student_index = np.unique(
+            np.array(student_numbers, dtype=str), return_inverse=True)
+        pairs = self.section_index.astype(np.int64) * len(self.student_numbers) + self.student_index
+        self.enrollment_pairs, self.enrollment_index = np.unique(pairs, return_inverse=True)
+        self.date_enrolled = np.array(dates_enrolled, dtype='datetime64[D]')
+        self.date_left = np.array(dates_left, dtype='datetime64[D]')
+
+    def __len__(self):
+        return len(self.date_enrolled)
+
+    # Rows in the window around effective_date
+    def activeRows(self, effective_date):
+        d = np.datetime64(effective_date, 'D')
+        return (self.date_enrolled <= d + self.days_upcoming) & (self.date_left >= d - self.days_past)
+
+    def enrollmentCode(self, i):
+        section, student = divmod(int(self.enrollment_pairs[i]), len(self.student_numbers))
+        return '%s.%s' % (self.section_codes[section], self.student_numbers[student])
+
+    def codes(self, kind, indexes):
+        if kind == 'students':
+            return [self.student_numbers[i] for i in indexes]
+        if kind == 'sections':
+            return [self.section_codes[i] for i in indexes]
+        return [self.enrollmentCode(i) for i in indexes]
+
+    # Boolean arrays (students, sections, enrollments), each of shape
+    # (count, days), saying which are active on each day from first_date.
+    # Each row is active from date_enrolled - days_upcoming through
+    # date_left + days_past; the rows are marked at the first and after
+    # the last day of that span, and a running sum over the days gives
+    # the number of active rows for each student, section and enrollment.
+    def activeByDay(self, first_date, days):
+        d0 = np.datetime64(first_date, 'D')
+        first = (self.date_enrolled - self.days_upcoming - d0).astype(np.int64)
+        last = (self.date_left + self.days_past - d0).astype(np.int64)
+        live = (first <= last) & (first < days) & (last >= 0)
+        first = np.clip(first[live], 0, days)
+        end = np.clip(last[live], -1, days - 1) + 1
+
+        def active(index, count):
+            marks = np.zeros((count, days + 1), np.int32)
+            np.add.at(marks, (index[live], first), 1)
+            np.add.at(marks, (index[live], end), -1)
+            return np.cumsum(marks, axis=1)[:, :days] > 0
+
+        return (active(self.student_index, len(self.student_numbers)),
+            active(self.section_index, len(self.section_codes)),
+            active(self.enrollment_index, len(self.enrollment_pairs)))
+
+    # A DayChanges for each of days dates from first_date. The first day
+    # has no added or dropped codes.
+    def preview(self, first_date, days):
+        result = [ ]
+        by_kind = zip(KINDS, self.activeByDay(first_date, days))
+        for day in xrange(days):
+            changes = DayChanges(first_date + datetime.timedelta(days=day))
+            for kind, active in by_kind:
+                today = active[:, day]
+                changes.active[kind] = int(today.sum())
+                if day > 0:
+                    yesterday = active[:, day - 1]
+                    changes.added[kind] = self.codes(kind, np.flatnonzero(today & ~yesterday))
+                    changes.dropped[kind] = self.codes(kind, np.flatnonzero(yesterday & ~today))
+            result.append(changes)
+        return result
+
+def printPreview(days, f):
+    f.write('%-10s' % 'date')
+    for kind in KINDS:
+        f.write(' %11s %6s %6s' % (kind, 'added', 'drop'))
+    f.write('\n')
+    for changes in days:
+        f.write('%-10s' % changes.date.isoformat())
+        for kind in KINDS:
+            added = len(changes.added.get(kind, ''))
+            dropped = len(changes.dropped.get(kind, ''))
+            f.write(' %11d %6s %6s' % (changes.active[kind],
+                '+%d' % added if added else '', '-%d' % dropped if dropped else ''))
+        f.write('\n')
+
+# One tab-delimited line per code added or dropped
+def writePreviewDetails(days, path):
+    with open(path, 'w') as f:
+        f.write('date\tchange\tkind\tcode\n')
+        for changes in days:
+            for change, codes_by_kind in (('added', changes.added), ('dropped', changes.dropped)):
+                for kind in KINDS:
+                    for code in codes_by_kind.get(kind, [ ]):
+                        f.write('%s\t%s\t%s\t%s\n' % (changes.date.isoformat(), change, kind, code))
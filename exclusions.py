@@ -0,0 +1,97 @@
+# Courses whose sections and enrollments are never uploaded, listed in
+# exclusions.txt in the source directory, one rule per line:
+#
+#   104.6100    course 6100 at school 104
+#   104.*       every course at school 104
+#   104.61*     every course at school 104 whose number starts with 61
+#
+# Blank lines and anything after a # are ignored.
+#
+# The rules are compiled into a dict of exact (school, course) pairs, a
+# dict of schools excluded entirely, and for each school the prefixes
+# grouped by length, so a lookup costs the same however many rules there
+# are. When more than one rule matches a course, the most specific one
+# (exact, then the longest prefix, then the school) is the one counted.
+# Each course is only matched once.
+
+import os
+
+import sourcereader
+
+FILE_NAME = 'exclusions.txt'
+
+class ExclusionRules(object):
+    def __init__(self):
+        self.rules = [ ]
+        self.exact = { }
+        self.schools = { }
+        # school_id -> [(length, {prefix: rule})], longest first
+        self.prefixes = { }
+        self.matches = { }
+        # rule -> {table: rows dropped}
+        self.hits = { }
+
+    # A missing file means no exclusions. A bad rule is a
+    # sourcereader.SourceFormatError, like any other bad source line.
+    @classmethod
+    def load(cls, path):
+        rules = cls()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line_number, line in enumerate(f, 1):
+                    rule = line.split('#', 1)[0].strip()
+                    if rule:
+                        try:
+                            rules.add(rule)
+                        except ValueError as e:
+                            raise sourcereader.SourceFormatError('%s, line %d: %s' % (path, line_number, e))
+        return rules
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, rule):
+        school_id, sep, course = rule.partition('.')
+        if not sep or not school_id or not course or '*' in course[:-1]:
+            raise ValueError('bad exclusion rule %r, expected school.course, school.* or school.prefix*' % rule)
+        if rule in self.hits:
+            return
+        if course == '*':
+            self.schools[school_id] = rule
+        elif course.endswith('*'):
+            prefix = course[:-1]
+            by_length = dict(self.prefixes.get(school_id, [ ]))
+            by_length.setdefault(len(prefix), { })[prefix] = rule
+            self.prefixes[school_id] = sorted(by_length.items(), reverse=True)
+        else:
+            self.exact[(school_id, course)] = rule
+        self.rules.append(rule)
+        self.hits[rule] = { }
+        self.matches = { }
+
+    # The rule that excludes a course, or None
+    def match(self, school_id, course_number):
+        course_id = (school_id, course_number)
+        try:
+            return self.matches[course_id]
+        except KeyError:
+            pass
+        rule = self.exact.get(course_id)
+        if rule is None:
+            for length, prefixes in self.prefixes.get(school_id, [ ]):
+                rule = prefixes.get(course_number[:length])
+                if rule is not None:
+                    break
+        if rule is None:
+            rule = self.schools.get(school_id)
+        self.matches[course_id] = rule
+        return rule
+
+    def hit(self, rule, table):
+        counts = self.hits[rule]
+        counts[table] = counts.get(table, 0) + 1
+
+    # Before a table is loaded again
+    def resetHits(self, table):
+        for counts in self.hits.itervalues():
+            counts.pop(table, None)
@@ -0,0 +1,76 @@
+# Input fingerprinting: hash every AutoSend source file together with the
+# settings that affect the output, so a nightly run whose inputs have not
+# changed since the last successful upload can stop before parsing.
+
+import hashlib
+import json
+import os
+import re
+import time
+
+CHUNK_SIZE = 1 << 20
+HASH_ALGORITHM = 'sha256'
+
+SOURCE_FILES = ['students.txt', 'math-courses.txt', 'extra-students.txt', 'exclusions.txt']
+SCHOOL_FILE_RE = re.compile(r'^(teachers|assignments|courses|sections|rosters)-.+\.txt$')
+
+# Read in fixed-size chunks so large rosters are never held in memory
+def hashStream(f):
+    h = hashlib.new(HASH_ALGORITHM)
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+def hashFile(path):
+    with open(path, 'rb') as f:
+        return hashStream(f)
+
+def hashBytes(data):
+    return hashlib.new(HASH_ALGORITHM, data).hexdigest()
+
+# The per-school files are found by name rather than from
+# math-courses.txt, so nothing has to be parsed to fingerprint them
+def sourceFiles(source_dir):
+    school_files = sorted(name for name in os.listdir(source_dir) if SCHOOL_FILE_RE.match(name))
+    return SOURCE_FILES + school_files
+
+class Fingerprint(object):
+    def __init__(self, source_dir, settings):
+        self.files = { }
+        for name in sourceFiles(source_dir):
+            path = os.path.join(source_dir, name)
+            self.files[name] = hashFile(path) if os.path.exists(path) else None
+        self.settings = settings
+        h = hashlib.new(HASH_ALGORITHM)
+        h.update(json.dumps([self.files, self.settings], sort_keys=True).encode('utf-8'))
+        self.digest = h.hexdigest()
+
+class Manifest(object):
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def matches(self, fingerprint):
+        return self.data is not None and self.data.get('fingerprint') == fingerprint.digest
+
+    # Record a successful upload, along with the hash of the zip sent
+    def save(self, fingerprint, zip_name, zip_hash):
+        self.data = {
+            'fingerprint': fingerprint.digest,
+            'files': fingerprint.files,
+            'settings': fingerprint.settings,
+            'zip_file': zip_name,
+            'zip_hash': zip_hash,
+            'hash_algorithm': HASH_ALGORITHM,
+            'uploaded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        state_dir = os.path.dirname(self.path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
@@ -5,12 +5,13 @@ from logging.handlers import RotatingFileHandler
 import re
 import shutil
 
-from flask import Flask, request, session, render_template, make_response, redirect, url_for
-from pyexcel import get_array
-from pyexcel_io import save_data
+from flask import Flask, request, session, render_template, make_response, redirect, url_for, jsonify, abort
 import werkzeug.exceptions
 from werkzeug.utils import secure_filename
 
+import jobs
+import studentstore
+
 
 # Initialize an app instance
 app = Flask(__name__)
@@ -19,23 +20,40 @@ app = Flask(__name__)
 import app_config
 app.config.from_object(app_config.Config)
 
+# Loaded on first use and shared by the request threads
+extra_students = None
+
+def extraStudents():
+    global extra_students
+    if extra_students is None:
+        extra_students = studentstore.ExtraStudentStore(app.config['EXTRA_STUDENTS_WORKING_PATH'],
+            app.config['EXTRA_STUDENTS_COMPACT_EVERY'])
+    return extra_students
+
+# Started on first use; the worker loads the source files right away
+job_queue = None
+
+def jobQueue():
+    global job_queue
+    if job_queue is None:
+        job_queue = jobs.JobQueue(app.config['EASYBRIDGE_WORKER'])
+    return job_queue
+
 @app.route('/edit', methods=['GET','POST'])
 def edit():
     # shutil.copyfile(app.config['EXTRA_STUDENTS_SOURCE_PATH'], app.config['EXTRA_STUDENTS_WORKING_PATH'])
-    records = get_array(file_name=app.config['EXTRA_STUDENTS_WORKING_PATH'])
+    store = extraStudents()
     if request.method == 'POST':
-        changed = False
         removes = []
         for key in request.form.keys():
             m = re.match('remove_(\d+)', key)
             if m:
-                removes.append(int(m.group(1)))
-                changed = True
+                removes.append(m.group(1))
 
-        records = [r for r in records if not (r[0] in removes)]
+        puts = []
         if request.form['student_number'] and request.form['first_name'] and \
             request.form['last_name'] and request.form['email']:
-            records.append([
+            puts.append([
                 request.form['student_number'],
                 request.form['first_name'],
                 request.form['last_name'],
@@ -44,11 +62,43 @@ def edit():
                 request.form['email'],
                 '9919.1'
             ])
-            changed = True
-        if changed:
-            save_data(app.config['EXTRA_STUDENTS_WORKING_PATH'], records, lineterminator='\n')
+        store.update(removes, puts)
+    elif request.if_none_match.contains(store.etag()):
+        return make_response('', 304)
+
+    etag, records = store.snapshot()
+    response = make_response(render_template('students.html', page_title='Edit Students', records=records))
+    response.set_etag(etag)
+    return response
+
+# Queue a preview, build or upload of the extra students being edited.
+# Poll the returned URL for the job's state, result and timings.
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_job(kind):
+    if kind not in jobs.KINDS:
+        abort(404)
+    store = extraStudents()
+    # The worker reads the working file, so fold the journal into it
+    store.compact()
+    params = {'extra_students': store.path}
+    if kind == 'upload':
+        params['publish_to'] = app.config['EXTRA_STUDENTS_SOURCE_PATH']
+    job = jobQueue().submit(kind, **params)
+    response = jsonify(job.asDict())
+    response.status_code = 202
+    response.headers['Location'] = url_for('job_status', job_id=job.id)
+    return response
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = jobQueue().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.asDict())
 
-    return render_template('students.html', page_title='Edit Students', records=records)
+@app.route('/jobs')
+def job_list():
+    return jsonify(jobs=[job.asDict() for job in jobQueue().recent()])
 
 
 
@@ -0,0 +1,205 @@
+# Generate a synthetic district in AutoSend format (tab delimited, no
+# header line, M/D/YYYY dates) for benchmarking easybridge at scale.
+#
+#   python gen_district.py -o bench/source-50k --size 50k
+#   python gen_district.py -o /tmp/district --students 20000 --schools 4
+#
+# Run easybridge against the result with --autosend. The data is
+# deterministic for a given size and --seed, and exercises the awkward
+# parts of the real exports: course and section mappings, inactive and
+# missing teachers, dropped and upcoming enrollments, and extra students.
+
+import argparse
+import os
+import random
+
+SIZES = {
+    '1k': (1000, 2),
+    '50k': (50000, 10),
+    '500k': (500000, 40),
+}
+
+FIRST_NAMES = ['Ava', 'Ben', 'Chloe', 'Diego', 'Emma', 'Farah', 'Gus', 'Hana', 'Ivan', 'Jada',
+    'Kai', 'Lena', 'Milo', 'Nora', 'Omar', 'Pia', 'Quinn', 'Rosa', 'Sam', 'Theo']
+LAST_NAMES = ['Adams', 'Baker', 'Chen', 'Diaz', 'Evans', 'Fox', 'Garcia', 'Hill', 'Ito', 'Jones',
+    'Kim', 'Lopez', 'Moore', 'Nguyen', 'Ortiz', 'Patel', 'Reyes', 'Smith', 'Tran', 'Young']
+
+YEAR_START = (8, 30, 2017)
+YEAR_END = (6, 14, 2018)
+TERMS = [
+    (2700, 'YR', (8, 30, 2017), (6, 14, 2018)),
+    (2701, 'S1', (8, 30, 2017), (1, 19, 2018)),
+    (2702, 'S2', (1, 22, 2018), (6, 14, 2018)),
+]
+COURSES_PER_SCHOOL = 24
+MATH_COURSES_PER_SCHOOL = 5
+CLASS_SIZE = 28
+COURSES_PER_STUDENT = 6
+
+def autosendDate(mdy):
+    return '%02d/%02d/%04d' % mdy
+
+class DistrictWriter(object):
+    def __init__(self, output_dir, students, schools, seed):
+        self.output_dir = output_dir
+        self.num_students = students
+        self.num_schools = schools
+        self.random = random.Random(seed)
+        try:
+            os.makedirs(output_dir)
+        except:
+            pass
+
+    def open(self, file_name):
+        return open(os.path.join(self.output_dir, file_name), 'w')
+
+    def writeRow(self, f, row):
+        f.write('\t'.join(str(v) for v in row))
+        f.write('\n')
+
+    def schoolName(self, i):
+        return 'school%02d' % (i + 1)
+
+    def schoolId(self, i):
+        return str(101 + i)
+
+    # Course numbers are unique across the district, so native section
+    # codes do not collide between schools
+    def courseNumber(self, school, k):
+        return str((school + 1) * 1000 + k)
+
+    def teacherNumber(self, school, t):
+        return str((school + 1) * 10000 + t)
+
+    def studentsAt(self, school):
+        return range(school, self.num_students, self.num_schools)
+
+    def studentNumber(self, s):
+        return str(100000 + s)
+
+    def name(self, n):
+        return FIRST_NAMES[n % len(FIRST_NAMES)], LAST_NAMES[(n // len(FIRST_NAMES)) % len(LAST_NAMES)]
+
+    def write(self):
+        self.writeMathCourses()
+        self.writeStudents()
+        self.writeExtraStudents()
+        for school in range(self.num_schools):
+            self.writeSchool(school)
+
+    # The first math course of each school is folded into the second
+    # (course map), and one section of the third into another section
+    # (section map)
+    def writeMathCourses(self):
+        with self.open('math-courses.txt') as f:
+            for school in range(self.num_schools):
+                school_id = self.schoolId(school)
+                school_name = self.schoolName(school)
+                for k in range(MATH_COURSES_PER_SCHOOL):
+                    course_number = self.courseNumber(school, k)
+                    target = self.courseNumber(school, 1) if k == 0 else course_number
+                    self.writeRow(f, [school_id, course_number, target, 'Math %d' % k, school_name])
+                course_number = self.courseNumber(school, 2)
+                self.writeRow(f, [school_id, course_number + '.9', course_number + '.1',
+                    'Math 2', school_name])
+
+    def writeStudents(self):
+        with self.open('students.txt') as f:
+            for s in range(self.num_students):
+                first, last = self.name(s)
+                self.writeRow(f, [self.studentNumber(s), self.schoolId(s % self.num_schools),
+                    autosendDate(YEAR_START), autosendDate(YEAR_END), first, '', last,
+                    'MF'[s % 2], 5 + s % 4, '%s%s%d' % (first.lower(), last.lower(), s),
+                    'Parent', last, 'parent%d@example.com' % s, 'Parent', last, 'parent%d@example.org' % s])
+
+    def writeExtraStudents(self):
+        with self.open('extra-students.txt') as f:
+            for e in range(3):
+                self.writeRow(f, [900000 + e, 'Extra', 'Student%d' % e, self.schoolId(0),
+                    'MF'[e % 2], 'extra%d' % e, '%s.1' % self.courseNumber(0, 3)])
+
+    def writeSchool(self, school):
+        school_id = self.schoolId(school)
+        school_name = self.schoolName(school)
+        students = self.studentsAt(school)
+        sections_per_course = len(students) * COURSES_PER_STUDENT // (COURSES_PER_SCHOOL * CLASS_SIZE) + 1
+        num_teachers = max(2, COURSES_PER_SCHOOL * sections_per_course // 5)
+
+        with self.open('teachers-%s.txt' % school_name) as f:
+            for t in range(num_teachers):
+                first, last = self.name(t + 7)
+                # Every 40th teacher is no longer active
+                status = '2' if t % 40 == 39 else '1'
+                self.writeRow(f, [self.teacherNumber(school, t), first, last, school_id,
+                    't%s@example.com' % self.teacherNumber(school, t), status, '1', ''])
+
+        with self.open('assignments-%s.txt' % school_name) as f:
+            for t in range(3):
+                number = self.teacherNumber(school, num_teachers + t)
+                self.writeRow(f, [number, 'Aide', 'Number%d' % t, school_id,
+                    't%s@example.com' % number, '1', '1', ''])
+
+        with self.open('courses-%s.txt' % school_name) as f:
+            for k in range(COURSES_PER_SCHOOL):
+                self.writeRow(f, [school_id, 'Course %d' % k, self.courseNumber(school, k), '', ''])
+
+        # Sections, with one in every 200 taught by a teacher who is not
+        # in the teachers file. Section 1 of every course (where the extra
+        # students go) is taught by the first teacher, who is active.
+        sections = [ ]
+        with self.open('sections-%s.txt' % school_name) as f:
+            n = 0
+            for k in range(COURSES_PER_SCHOOL):
+                course_number = self.courseNumber(school, k)
+                course_sections = [ ]
+                for sn in range(1, sections_per_course + 1):
+                    term_id, term, first_day, last_day = TERMS[n % len(TERMS)]
+                    if sn == 1:
+                        teacher_number = self.teacherNumber(school, 0)
+                    elif n % 200 == 199:
+                        teacher_number = self.teacherNumber(school, num_teachers + 50)
+                    else:
+                        teacher_number = self.teacherNumber(school, n % num_teachers)
+                    course_sections.append((course_number, sn, term_id, term,
+                        first_day, last_day, '%d(A)' % (1 + n % 7), teacher_number))
+                    n += 1
+                if k == 2:
+                    course_sections.append((course_number, 9, 2700, 'YR',
+                        YEAR_START, YEAR_END, '7(A)', self.teacherNumber(school, 0)))
+                for course_number, sn, term_id, term, first_day, last_day, expression, teacher_number in course_sections:
+                    self.writeRow(f, [school_id, course_number, sn, term_id, term,
+                        autosendDate(first_day), autosendDate(last_day), expression, teacher_number])
+                sections.append(course_sections)
+
+        # Each student takes a few courses; some enrollments have already
+        # ended and some start later in the year
+        with self.open('rosters-%s.txt' % school_name) as f:
+            rnd = self.random
+            for s in students:
+                first, last = self.name(s)
+                for k in rnd.sample(range(COURSES_PER_SCHOOL), COURSES_PER_STUDENT):
+                    course_number, sn, term_id, term, first_day, last_day, expression, teacher_number = \
+                        rnd.choice(sections[k])
+                    date_enrolled, date_left = first_day, last_day
+                    roll = rnd.random()
+                    if roll < 0.05:
+                        date_left = (10, rnd.randint(1, 20), 2017)
+                    elif roll < 0.08:
+                        date_enrolled = (10, rnd.randint(5, 30), 2017)
+                    self.writeRow(f, [course_number, sn, school_id, term_id,
+                        autosendDate(date_enrolled), autosendDate(date_left), '1(A)',
+                        self.studentNumber(s), first, last, teacher_number, 'Teacher'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic AutoSend district.')
+    parser.add_argument('-o', '--output_dir', required=True, help='directory for the source files')
+    parser.add_argument('--size', choices=sorted(SIZES), default='1k',
+        help='preset number of students and schools')
+    parser.add_argument('--students', type=int, help='number of students (overrides --size)')
+    parser.add_argument('--schools', type=int, help='number of schools (overrides --size)')
+    parser.add_argument('--seed', type=int, default=2017)
+    args = parser.parse_args()
+
+    students, schools = SIZES[args.size]
+    DistrictWriter(args.output_dir, args.students or students, args.schools or schools,
+        args.seed).write()
@@ -0,0 +1,113 @@
+# Python 3.5
+
+# Build, preview and upload jobs for flaskapp. Jobs are queued and run
+# one at a time by worker.py, which runs under Python 2 with the rest of
+# easybridge and keeps the loaded source files between jobs. The worker
+# is started with the queue and loads the source files right away, so
+# the first job does not pay for it.
+
+import itertools
+import json
+import queue
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+KINDS = ['preview', 'build', 'upload']
+KEEP_JOBS = 50
+
+# Job.state values
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class Job(object):
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.state = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.reply = { }
+
+    def asDict(self):
+        d = {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.created)),
+        }
+        if self.started is not None:
+            d['queued_seconds'] = self.started - self.created
+        if self.finished is not None:
+            d['run_seconds'] = self.finished - self.started
+        for key in ['result', 'error', 'log', 'phases', 'seconds']:
+            if key in self.reply:
+                d[key] = self.reply[key]
+        return d
+
+class JobQueue(object):
+    def __init__(self, command, keep=KEEP_JOBS):
+        self.command = command
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.process = None
+        self.submit('load')
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, kind, **params):
+        with self.lock:
+            job = Job(next(self.ids), kind, params)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                self.jobs.popitem(last=False)
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def recent(self):
+        with self.lock:
+            return list(reversed(self.jobs.values()))
+
+    def worker(self):
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        return self.process
+
+    # A worker that dies fails its job and is started again for the next
+    def call(self, request):
+        process = self.worker()
+        try:
+            process.stdin.write(json.dumps(request) + '\n')
+            process.stdin.flush()
+            line = process.stdout.readline()
+        except (BrokenPipeError, OSError) as e:
+            line = ''
+        if not line:
+            process.kill()
+            process.wait()
+            return {'ok': False, 'error': 'worker exited with status %s' % process.returncode}
+        return json.loads(line)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            job.state = RUNNING
+            job.started = time.time()
+            request = dict(job.params, op=job.kind)
+            job.reply = self.call(request)
+            job.finished = time.time()
+            job.state = DONE if job.reply.get('ok') else FAILED
@@ -0,0 +1,118 @@
+# Run instrumentation: wall and CPU time and row counts for each load and
+# write phase, plus gauges such as output bytes per file, zip size and
+# SFTP timings. Metrics are written as JSON, and optionally as a
+# Prometheus textfile for the node_exporter textfile collector.
+
+import contextlib
+import json
+import os
+import time
+
+PROMETHEUS_PREFIX = 'easybridge_'
+
+def cpuTime():
+    t = os.times()
+    return t[0] + t[1]
+
+class Phase(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.rows_read = None
+        self.rows_kept = None
+
+    @property
+    def rows_filtered(self):
+        if self.rows_read is None or self.rows_kept is None:
+            return None
+        return self.rows_read - self.rows_kept
+
+    def asDict(self):
+        d = {
+            'phase': self.name,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+        }
+        d.update(self.labels)
+        if self.rows_read is not None:
+            d['rows_read'] = self.rows_read
+        if self.rows_kept is not None:
+            d['rows_kept'] = self.rows_kept
+            d['rows_filtered'] = self.rows_filtered
+        return d
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.phases = [ ]
+        self.gauges = [ ]
+
+    @contextlib.contextmanager
+    def phase(self, name, **labels):
+        phase = Phase(name, labels)
+        wall = time.time()
+        cpu = cpuTime()
+        try:
+            yield phase
+        finally:
+            phase.wall_seconds = time.time() - wall
+            phase.cpu_seconds = cpuTime() - cpu
+            self.phases.append(phase)
+
+    # Phases measured elsewhere, e.g. by a SchoolReader in a worker process
+    def extend(self, phases):
+        self.phases.extend(phases)
+
+    def set(self, name, value, **labels):
+        self.gauges.append((name, value, labels))
+
+    def asDict(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': time.time() - self.started,
+            'phases': [phase.asDict() for phase in self.phases],
+            'gauges': [dict(labels, name=name, value=value) for name, value, labels in self.gauges],
+        }
+
+    def writeJson(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.asDict(), f, indent=2, sort_keys=True)
+
+    # Written to a temporary name and renamed, so the collector never
+    # reads a partial file
+    def writePrometheus(self, path):
+        lines = [ ]
+        def sample(name, value, labels):
+            label_text = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                for k, v in sorted(labels.items()))
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append('%s%s%s %s' % (PROMETHEUS_PREFIX, name, label_text, repr(float(value))))
+
+        for field in ['wall_seconds', 'cpu_seconds', 'rows_read', 'rows_kept', 'rows_filtered']:
+            lines.append('# TYPE %sphase_%s gauge' % (PROMETHEUS_PREFIX, field))
+            for phase in self.phases:
+                value = getattr(phase, field)
+                if value is not None:
+                    sample('phase_' + field, value, dict(phase.labels, phase=phase.name))
+        # Samples of one metric have to be grouped under its TYPE line
+        names = [ ]
+        for name, value, labels in self.gauges:
+            if name not in names:
+                names.append(name)
+        for name in names:
+            lines.append('# TYPE %s%s gauge' % (PROMETHEUS_PREFIX, name))
+            for gauge_name, value, labels in self.gauges:
+                if gauge_name == name:
+                    sample(name, value, labels)
+        lines.append('# TYPE %srun_wall_seconds gauge' % PROMETHEUS_PREFIX)
+        sample('run_wall_seconds', time.time() - self.started, { })
+        lines.append('# TYPE %slast_run_timestamp_seconds gauge' % PROMETHEUS_PREFIX)
+        sample('last_run_timestamp_seconds', self.started, { })
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, path)
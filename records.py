@@ -0,0 +1,121 @@
+# Compact in-memory records for the AutoSend data.
+#
+# The loaders used to keep every csv.DictReader row, with all of its
+# columns, for the whole run. These classes keep only the columns the
+# writers use, share repeated values (school ids, course and section
+# numbers, term abbreviations, names) through intern(), and hold dates as
+# the shared (date, iso) entries from the easybridge date cache.
+#
+# Records are keyed by tuples instead of dotted strings:
+#   students     student_number
+#   teachers     teacher_number
+#   courses      (school_id, course_number)
+#   sections     (school_id, course_number, section_number)
+#   enrollments  (school_id, course_number, section_number, student_number)
+
+# Teacher.assigned values
+NOT_ASSIGNED = 0
+TEACHES_SECTION = 1
+ASSIGNED = 2
+
+class Student(object):
+    __slots__ = ('student_number', 'school_id', 'first_name', 'last_name',
+        'gender', 'network_id', 'enrolled')
+
+    def __init__(self, student_number, school_id, first_name, last_name,
+            gender, network_id, enrolled=False):
+        self.student_number = intern(student_number)
+        self.school_id = intern(school_id)
+        self.first_name = first_name
+        self.last_name = last_name
+        self.gender = intern(gender)
+        self.network_id = network_id
+        self.enrolled = enrolled
+
+    # row starts with the easybridge.STUDENT_COLUMNS values
+    @classmethod
+    def fromRow(cls, row):
+        return cls(*row[:6])
+
+class Teacher(object):
+    __slots__ = ('teacher_number', 'school_id', 'first_name', 'last_name',
+        'email', 'status', 'assigned')
+
+    def __init__(self, teacher_number, school_id, first_name, last_name,
+            email, status, assigned=NOT_ASSIGNED):
+        self.teacher_number = intern(teacher_number)
+        self.school_id = intern(school_id)
+        self.first_name = intern(first_name)
+        self.last_name = intern(last_name)
+        self.email = email
+        self.status = intern(status)
+        self.assigned = assigned
+
+    # row holds the easybridge.TEACHER_COLUMNS values
+    @classmethod
+    def fromRow(cls, row):
+        return cls(*row)
+
+# A course selected in math-courses.txt; course_name is filled in from
+# the PowerSchool courses file
+class Course(object):
+    __slots__ = ('school_id', 'course_number', 'target_course_name', 'course_name')
+
+    def __init__(self, school_id, course_number, target_course_name, course_name=None):
+        self.school_id = intern(school_id)
+        self.course_number = intern(course_number)
+        self.target_course_name = intern(target_course_name)
+        self.course_name = course_name
+
+class Section(object):
+    __slots__ = ('school_id', 'course_number', 'section_number', 'term',
+        'first_day', 'last_day', 'expression', 'teacher_number')
+
+    def __init__(self, school_id, course_number, section_number, term,
+            first_day, last_day, expression, teacher_number):
+        self.school_id = intern(school_id)
+        self.course_number = intern(course_number)
+        self.section_number = intern(section_number)
+        self.term = intern(term)
+        self.first_day = first_day
+        self.last_day = last_day
+        self.expression = intern(expression)
+        self.teacher_number = intern(teacher_number)
+
+    def key(self):
+        return (self.school_id, self.course_number, self.section_number)
+
+class Enrollment(object):
+    __slots__ = ('school_id', 'course_number', 'section_number', 'student_number',
+        'date_enrolled', 'date_left')
+
+    def __init__(self, school_id, course_number, section_number, student_number,
+            date_enrolled, date_left):
+        self.school_id = intern(school_id)
+        self.course_number = intern(course_number)
+        self.section_number = intern(section_number)
+        self.student_number = intern(student_number)
+        self.date_enrolled = date_enrolled
+        self.date_left = date_left
+
+    def key(self):
+        return (self.school_id, self.course_number, self.section_number, self.student_number)
+
+# A section from self.sections resolved once against the course and
+# section maps, with everything the section writers need. Only exported
+# sections (not folded into another course or section) get their own
+# PIF_SECTION and PIF_SECTION_STAFF rows.
+class SectionPlan(object):
+    __slots__ = ('section', 'native_section_code', 'exported', 'course_name',
+        'section_name', 'section_teacher_code', 'date_start', 'date_end')
+
+    def __init__(self, section, native_section_code, exported, course_name=None,
+            section_name=None, section_teacher_code=None):
+        self.section = section
+        self.native_section_code = native_section_code
+        self.exported = exported
+        self.course_name = course_name
+        self.section_name = section_name
+        self.section_teacher_code = section_teacher_code
+        self.date_start = section.first_day[1]
+        self.date_end = section.last_day[1]
@@ -0,0 +1,329 @@
+# Archive of what each upload read and sent, so any past night can be
+# looked at or run again.
+#
+# Every source file and every member of the zip file is stored once as
+# a blob, named by the sha256 of its content and compressed with zlib:
+#
+#   archive_dir/blobs/ab/ab12...   blob
+#   archive_dir/runs/RUN_ID.json   manifest of one run
+#
+# A manifest lists the run's source files and zip members by hash, along
+# with the settings from its fingerprint, the zip file's hash, and what
+# is needed to build the same zip file again. Most source files change
+# little or not at all from one night to the next, and a file that is
+# already stored is only referred to again, so a night usually adds a
+# few blobs. Source files are hashed for the fingerprint anyway, so one
+# that is already stored is not even read.
+#
+# restore() writes a run's source files to a directory, to load them
+# with EasyBridgeUploader, and can also write its output files and
+# rebuild its zip file. collect() removes the manifests of runs older
+# than keep_days, except the newest keep_runs, then the blobs no
+# manifest refers to.
+#
+#   python runarchive.py -d state/archive list
+#   python runarchive.py -d state/archive restore 20171003-020512 -o /tmp/run --outputs
+#   python runarchive.py -d state/archive gc --keep-days 90
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import zipfile
+import zlib
+
+import fingerprint
+import ziparchive
+
+FORMAT_VERSION = 1
+BLOB_LEVEL = 6
+DEFAULT_KEEP_DAYS = 365
+DEFAULT_KEEP_RUNS = 7
+# Blobs younger than this are never collected: a run that is being
+# archived writes its blobs before its manifest
+GC_GRACE_SECONDS = 3600
+RUN_ID_FORMAT = '%Y%m%d-%H%M%S'
+
+class ArchiveError(Exception):
+    pass
+
+class Archive(object):
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.blob_dir = os.path.join(archive_dir, 'blobs')
+        self.run_dir = os.path.join(archive_dir, 'runs')
+
+    def blobPath(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def hasBlob(self, digest):
+        return os.path.exists(self.blobPath(digest))
+
+    # Written to a temporary name and renamed, so a blob is either whole
+    # or missing. Returns the bytes written, 0 if it was already stored.
+    def writeBlob(self, digest, chunks):
+        path = self.blobPath(digest)
+        if os.path.exists(path):
+            return 0
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        compressor = zlib.compressobj(BLOB_LEVEL)
+        h = hashlib.new(fingerprint.HASH_ALGORITHM)
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                h.update(chunk)
+                f.write(compressor.compress(chunk))
+            f.write(compressor.flush())
+            size = f.tell()
+        if h.hexdigest() != digest:
+            os.remove(tmp_path)
+            raise ArchiveError('content of blob %s changed while it was stored' % digest)
+        os.rename(tmp_path, path)
+        return size
+
+    def storeFile(self, path, digest=None):
+        digest = digest or fingerprint.hashFile(path)
+        if self.hasBlob(digest):
+            return digest, 0
+        with open(path, 'rb') as f:
+            size = self.writeBlob(digest, iter(lambda: f.read(fingerprint.CHUNK_SIZE), b''))
+        return digest, size
+
+    # A zip member is read twice, once to hash it and again only if it
+    # is not stored yet, so it is never in memory whole
+    def storeMember(self, zf, info):
+        with zf.open(info) as f:
+            digest = fingerprint.hashStream(f)
+        if self.hasBlob(digest):
+            return digest, 0
+        with zf.open(info) as f:
+            return digest, self.writeBlob(digest, iter(lambda: f.read(fingerprint.CHUNK_SIZE), b''))
+
+    # Yields the content of a blob in chunks, and checks its hash at the end
+    def readBlob(self, digest):
+        decompressor = zlib.decompressobj()
+        h = hashlib.new(fingerprint.HASH_ALGORITHM)
+        try:
+            f = open(self.blobPath(digest), 'rb')
+        except IOError:
+            raise ArchiveError('blob %s is missing' % digest)
+        with f:
+            for chunk in iter(lambda: f.read(fingerprint.CHUNK_SIZE), b''):
+                data = decompressor.decompress(chunk)
+                h.update(data)
+                yield data
+        data = decompressor.flush()
+        h.update(data)
+        yield data
+        if h.hexdigest() != digest:
+            raise ArchiveError('blob %s is corrupt' % digest)
+
+    def blobBytes(self, digest):
+        return b''.join(self.readBlob(digest))
+
+    def manifestPath(self, run_id):
+        return os.path.join(self.run_dir, run_id + '.json')
+
+    def newRunId(self, now):
+        run_id = time.strftime(RUN_ID_FORMAT, time.localtime(now))
+        n = 1
+        while os.path.exists(self.manifestPath(run_id if n == 1 else '%s-%d' % (run_id, n))):
+            n += 1
+        return run_id if n == 1 else '%s-%d' % (run_id, n)
+
+    # Store a run. inputs is the fingerprint.Fingerprint of source_dir,
+    # zip_file the zip file that was sent, as a path or a seekable file
+    # object. Returns the manifest, with 'blobs_added' and 'bytes_added'
+    # for this run.
+    def storeRun(self, source_dir, inputs, zip_name, zip_file, compression, level):
+        now = time.time()
+        added = [0, 0]
+        def count(size):
+            if size:
+                added[0] += 1
+                added[1] += size
+
+        input_hashes = { }
+        for name, digest in sorted(inputs.files.items()):
+            if digest is not None:
+                digest, size = self.storeFile(os.path.join(source_dir, name), digest)
+                count(size)
+            input_hashes[name] = digest
+
+        if isinstance(zip_file, basestring):
+            zip_file = open(zip_file, 'rb')
+        with zip_file:
+            zip_hash = fingerprint.hashStream(zip_file)
+            zip_bytes = zip_file.tell()
+            zip_file.seek(0)
+            outputs = [ ]
+            with zipfile.ZipFile(zip_file) as zf:
+                for info in zf.infolist():
+                    digest, size = self.storeMember(zf, info)
+                    count(size)
+                    outputs.append({'name': info.filename, 'hash': digest, 'bytes': info.file_size,
+                        'date_time': list(info.date_time)})
+
+        try:
+            os.makedirs(self.run_dir)
+        except OSError:
+            pass
+        run_id = self.newRunId(now)
+        manifest = {
+            'format': FORMAT_VERSION,
+            'run_id': run_id,
+            'created': now,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now)),
+            'hash_algorithm': fingerprint.HASH_ALGORITHM,
+            'fingerprint': inputs.digest,
+            'settings': inputs.settings,
+            'inputs': input_hashes,
+            'outputs': outputs,
+            'zip_file': zip_name,
+            'zip_hash': zip_hash,
+            'zip_bytes': zip_bytes,
+            'compression': compression,
+            'compress_level': level,
+        }
+        path = self.manifestPath(run_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+        manifest['blobs_added'], manifest['bytes_added'] = added
+        return manifest
+
+    # Run ids, oldest first
+    def runIds(self):
+        try:
+            names = os.listdir(self.run_dir)
+        except OSError:
+            return [ ]
+        return sorted(name[:-5] for name in names if name.endswith('.json'))
+
+    def loadRun(self, run_id):
+        try:
+            with open(self.manifestPath(run_id)) as f:
+                return json.load(f)
+        except IOError:
+            raise ArchiveError('no run %s in %s' % (run_id, self.archive_dir))
+
+    def runs(self):
+        return [self.loadRun(run_id) for run_id in self.runIds()]
+
+    # Write a run's source files to dest_dir, and with outputs=True its
+    # output files and zip file as well. Returns the manifest.
+    def restore(self, run_id, dest_dir, outputs=False):
+        manifest = self.loadRun(run_id)
+        try:
+            os.makedirs(dest_dir)
+        except OSError:
+            pass
+        for name, digest in sorted(manifest['inputs'].items()):
+            path = os.path.join(dest_dir, name)
+            if digest is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            with open(path, 'wb') as f:
+                for chunk in self.readBlob(digest):
+                    f.write(chunk)
+        if outputs:
+            self.restoreOutputs(manifest, dest_dir)
+        return manifest
+
+    # The zip file is built again from the members, with their original
+    # times, compression and level, so it comes out the same as the one
+    # that was sent
+    def restoreOutputs(self, manifest, dest_dir):
+        zip_path = os.path.join(dest_dir, manifest['zip_file'])
+        archive = ziparchive.ZipBuilder(zip_path, manifest['compression'], manifest['compress_level'])
+        for output in manifest['outputs']:
+            data = self.blobBytes(output['hash'])
+            with open(os.path.join(dest_dir, output['name']), 'wb') as f:
+                f.write(data)
+            archive.writestr(str(output['name']), data, tuple(output['date_time']))
+        archive.close()
+        if fingerprint.hashFile(zip_path) != manifest['zip_hash']:
+            raise ArchiveError('%s does not match the zip file of run %s' % (
+                manifest['zip_file'], manifest['run_id']))
+
+    # Returns (runs removed, blobs removed, bytes freed)
+    def collect(self, keep_days=DEFAULT_KEEP_DAYS, keep_runs=DEFAULT_KEEP_RUNS, now=None):
+        now = now or time.time()
+        cutoff = now - keep_days * 86400
+        runs = self.runs()
+        kept = [ ]
+        removed_runs = 0
+        for i, manifest in enumerate(runs):
+            if manifest['created'] < cutoff and i < len(runs) - keep_runs:
+                os.remove(self.manifestPath(manifest['run_id']))
+                removed_runs += 1
+            else:
+                kept.append(manifest)
+
+        referenced = set()
+        for manifest in kept:
+            referenced.update(digest for digest in manifest['inputs'].itervalues() if digest)
+            referenced.update(output['hash'] for output in manifest['outputs'])
+        removed_blobs = freed = 0
+        try:
+            prefixes = os.listdir(self.blob_dir)
+        except OSError:
+            prefixes = [ ]
+        for prefix in prefixes:
+            prefix_dir = os.path.join(self.blob_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                if name in referenced:
+                    continue
+                path = os.path.join(prefix_dir, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime > now - GC_GRACE_SECONDS:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed_blobs += 1
+                freed += st.st_size
+        return removed_runs, removed_blobs, freed
+
+def formatRun(manifest):
+    return '%s  %s  %s  %d inputs, %d outputs, %s %d bytes' % (
+        manifest['run_id'], manifest['settings']['effective_date'], manifest['fingerprint'][:12],
+        sum(1 for digest in manifest['inputs'].itervalues() if digest),
+        len(manifest['outputs']), manifest['zip_file'], manifest['zip_bytes'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List, restore and clean up archived easybridge runs.')
+    parser.add_argument('-d', '--archive-dir', default=os.path.join('state', 'archive'),
+        help='archive directory (default: state/archive)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='list the archived runs, oldest first')
+    restore = commands.add_parser('restore', help="write a run's source files to a directory")
+    restore.add_argument('run_id')
+    restore.add_argument('-o', '--output_dir', required=True)
+    restore.add_argument('--outputs', action='store_true', help='also write its output files and zip file')
+    gc = commands.add_parser('gc', help='remove old runs and the files only they refer to')
+    gc.add_argument('--keep-days', type=int, default=DEFAULT_KEEP_DAYS)
+    gc.add_argument('--keep-runs', type=int, default=DEFAULT_KEEP_RUNS)
+    args = parser.parse_args()
+
+    archive = Archive(args.archive_dir)
+    try:
+        if args.command == 'list':
+            for manifest in archive.runs():
+                print formatRun(manifest)
+        elif args.command == 'restore':
+            manifest = archive.restore(args.run_id, args.output_dir, args.outputs)
+            print "restored run %s to %s" % (manifest['run_id'], args.output_dir)
+            print "run it again with: python easybridge.py -s %s -t %s%s" % (args.output_dir,
+                manifest['settings']['effective_date'], ' -a' if manifest['settings']['autosend'] else '')
+        else:
+            print "removed %d runs and %d files (%d bytes)" % archive.collect(args.keep_days, args.keep_runs)
+    except ArchiveError as e:
+        print "Can't %s: %s" % (args.command, e)
+        raise SystemExit(1)
@@ -0,0 +1,215 @@
+# A local stand-in for the EasyBridge SFTP server, serving a directory
+# on 127.0.0.1, so uploads can be tried without the network:
+#
+#   python sftp_standin.py -d /tmp/sftp-root --port 2222 --known-hosts /tmp/known_hosts
+#   python easybridge.py -a -s source -o output -u test -p test \
+#       --sftp-host 127.0.0.1 --sftp-port 2222 --known-hosts /tmp/known_hosts
+#
+# The host key is generated at startup and written to --known-hosts, so
+# the upload checks it the same way as against the real server.
+# --drop-after closes every connection once that many bytes have been
+# written, to exercise retries and resumed uploads, and
+# --no-posix-rename turns off the OpenSSH rename extension, like a
+# server that only speaks plain SFTP v3.
+
+import argparse
+import os
+import socket
+import sys
+import threading
+
+import paramiko
+
+class StandinServer(paramiko.ServerInterface):
+    def __init__(self, options):
+        self.options = options
+        self.transport = None
+        self.bytes_written = 0
+
+    def check_auth_password(self, username, password):
+        if username == self.options.username and password == self.options.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    # Called for every SFTP write on this connection
+    def countWrite(self, n):
+        self.bytes_written += n
+        drop_after = self.options.drop_after
+        if drop_after and self.bytes_written >= drop_after and self.transport.is_active():
+            print "dropping connection after %d bytes" % self.bytes_written
+            self.transport.close()
+
+class StandinHandle(paramiko.SFTPHandle):
+    def __init__(self, server, flags=0):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.server = server
+
+    def write(self, offset, data):
+        result = paramiko.SFTPHandle.write(self, offset, data)
+        self.server.countWrite(len(data))
+        return result
+
+# Every SFTP path is resolved inside the served directory
+class DirectorySFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server, root, posix_rename=True):
+        paramiko.SFTPServerInterface.__init__(self, server)
+        self.server = server
+        self.root = root
+        self.allow_posix_rename = posix_rename
+
+    def localPath(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        try:
+            local_path = self.localPath(path)
+            result = [ ]
+            for name in os.listdir(local_path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.localPath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.localPath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self.localPath(path)
+        try:
+            fd = os.open(local_path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        try:
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = StandinHandle(self.server, flags)
+        handle.filename = local_path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self.localPath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    # Plain SFTP v3 rename fails if the target exists
+    def rename(self, oldpath, newpath):
+        new_path = self.localPath(newpath)
+        if os.path.exists(new_path):
+            return paramiko.SFTP_FAILURE
+        try:
+            os.rename(self.localPath(oldpath), new_path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        if not self.allow_posix_rename:
+            return paramiko.SFTP_OP_UNSUPPORTED
+        try:
+            os.rename(self.localPath(oldpath), self.localPath(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.localPath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.localPath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+def writeKnownHosts(path, host_key, port):
+    with open(path, 'w') as f:
+        # pysftp looks host keys up by host name alone, without the port
+        for host in ['127.0.0.1', 'localhost', '[127.0.0.1]:%d' % port, '[localhost]:%d' % port]:
+            f.write('%s %s %s\n' % (host, host_key.get_name(), host_key.get_base64()))
+
+def serveConnection(sock, host_key, options):
+    transport = paramiko.Transport(sock)
+    server = StandinServer(options)
+    server.transport = transport
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler('sftp', paramiko.SFTPServer, DirectorySFTPServer,
+        options.root, posix_rename=not options.no_posix_rename)
+    try:
+        transport.start_server(server=server)
+    except (paramiko.SSHException, EOFError, socket.error) as e:
+        print "connection failed: %s" % e
+        return
+    while transport.is_active():
+        transport.join(1)
+
+def serve(options):
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', options.port))
+    listener.listen(5)
+    port = listener.getsockname()[1]
+    if options.known_hosts:
+        writeKnownHosts(options.known_hosts, host_key, port)
+    print "serving %s on 127.0.0.1:%d" % (options.root, port)
+    sys.stdout.flush()
+    while True:
+        sock, addr = listener.accept()
+        t = threading.Thread(target=serveConnection, args=(sock, host_key, options))
+        t.daemon = True
+        t.start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a directory over SFTP on 127.0.0.1.')
+    parser.add_argument('-d', '--root', required=True, help='directory to serve')
+    parser.add_argument('--port', type=int, default=2222, help='port to listen on (0 = any free port)')
+    parser.add_argument('--known-hosts', help='write the generated host key to this known_hosts file')
+    parser.add_argument('-u', '--username', default='test')
+    parser.add_argument('-p', '--password', default='test')
+    parser.add_argument('--drop-after', type=int, default=0,
+        help='close each connection after this many bytes have been written')
+    parser.add_argument('--no-posix-rename', action='store_true',
+        help='do not support the posix-rename@openssh.com extension')
+    options = parser.parse_args()
+
+    options.root = os.path.abspath(options.root)
+    if not os.path.isdir(options.root):
+        os.makedirs(options.root)
+    try:
+        serve(options)
+    except KeyboardInterrupt:
+        pass
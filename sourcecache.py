@@ -0,0 +1,140 @@
+# On-disk cache of parsed AutoSend files.
+#
+# Parsing the tab-delimited exports is most of the cost of a run, and
+# reruns on the same exports (--dump, another --effective-date, a fixed
+# math-courses.txt) used to parse every file again. Each file's rows are
+# cached under a key made from the sha256 of its content, the header
+# mode (autosend files have no header line) and the columns kept, so a
+# file is parsed again only when its content changes.
+#
+# Only the columns the loaders use are kept, and rows are cached before
+# any filtering by date or course, so the cache entry does not depend on
+# the effective date or math-courses.txt.
+#
+# Entry format (native byte order, so entries are only valid on the
+# machine that wrote them):
+#   header   magic, column count, row count, string count, string bytes
+#   offsets  string count + 1 unsigned ints into the string bytes
+#   strings  each distinct value once; string 0 stands for None
+#   rows     row count * column count string numbers
+# Entries are read with mmap, and each distinct value becomes one shared
+# string object.
+#
+# When the entries add up to more than max_bytes, the least recently
+# used ones are removed.
+
+import array
+import hashlib
+import mmap
+import os
+import struct
+
+import fingerprint
+
+FORMAT_VERSION = 1
+MAGIC = 'EBC1'
+HEADER = struct.Struct('=4sIIII')
+SUFFIX = '.ebc'
+DEFAULT_MAX_BYTES = 256 << 20
+
+class SourceCache(object):
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+
+    def entryPath(self, path, variant, columns):
+        h = hashlib.sha256()
+        h.update('%d\0%s\0%s\0%s' % (FORMAT_VERSION, fingerprint.hashFile(path),
+            variant, '\0'.join(columns)))
+        return os.path.join(self.cache_dir, h.hexdigest() + SUFFIX)
+
+    # Returns (hit, rows), with rows of path as tuples in columns order.
+    # parse() is called to read the file when there is no usable entry
+    # for its current content.
+    def rows(self, path, variant, columns, parse):
+        entry_path = self.entryPath(path, variant, columns)
+        try:
+            with open(entry_path, 'rb') as f:
+                rows = self.load(f, len(columns))
+            # Mark as recently used for eviction
+            os.utime(entry_path, None)
+            return True, rows
+        except (IOError, OSError, ValueError, struct.error):
+            pass
+        rows = [tuple(row) for row in parse()]
+        self.store(entry_path, len(columns), rows)
+        return False, rows
+
+    def load(self, f, num_columns):
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, ncols, nrows, nstrings, blob_size = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or ncols != num_columns:
+                raise ValueError('bad source cache entry %s' % f.name)
+            pos = HEADER.size
+            offsets = array.array('I')
+            offsets.fromstring(mm[pos:pos + (nstrings + 1) * offsets.itemsize])
+            pos += len(offsets) * offsets.itemsize
+            blob = mm[pos:pos + blob_size]
+            pos += blob_size
+            strings = [blob[offsets[i]:offsets[i + 1]] for i in xrange(nstrings)]
+            strings[0] = None
+            ids = array.array('I')
+            ids.fromstring(mm[pos:pos + nrows * ncols * ids.itemsize])
+        finally:
+            mm.close()
+        lookup = strings.__getitem__
+        return [tuple(map(lookup, ids[i:i + ncols])) for i in xrange(0, len(ids), ncols)]
+
+    # Written to a temporary name and renamed, so a reader in another
+    # process never sees a partial entry
+    def store(self, entry_path, num_columns, rows):
+        string_ids = {None: 0}
+        strings = ['']
+        ids = array.array('I')
+        for row in rows:
+            for value in row:
+                i = string_ids.get(value)
+                if i is None:
+                    i = string_ids[value] = len(strings)
+                    strings.append(value)
+                ids.append(i)
+        offsets = array.array('I', [0])
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        blob = ''.join(strings)
+
+        tmp_path = '%s.%d.tmp' % (entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, num_columns, len(rows), len(strings), len(blob)))
+            f.write(offsets.tostring())
+            f.write(blob)
+            f.write(ids.tostring())
+        os.rename(tmp_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        entries = [ ]
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,53 @@
+# Positional reader for the tab-delimited source files.
+#
+# csv.DictReader builds a dict with every column of every row, and the
+# loaders then looked the few columns they use up by name. Here the
+# column names are compiled into indexes once per file, from the fixed
+# AutoSend layout (those files have no header line) or from the file's
+# header line, and each row comes back as a tuple of only the columns
+# asked for, in the order asked for. The file is read through a large
+# buffer.
+#
+# The layout is checked once per file: a column that is not in it is an
+# error before any row is read. After that each line only has its length
+# compared with the layout's, so a short or long line is reported with
+# its line number instead of having its values shifted into the wrong
+# columns. Blank lines are skipped, as DictReader did.
+
+import csv
+import operator
+
+BUFFER_SIZE = 1 << 20
+
+class SourceFormatError(ValueError):
+    pass
+
+# Turns a list of cells into a tuple of the cells at indexes
+def columnGetter(indexes):
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda cells: (cells[index], )
+    return operator.itemgetter(*indexes)
+
+# Rows of path as tuples of the given columns. headers is the layout of
+# a file without a header line; with headers=None the first line names
+# the columns.
+def readRows(path, headers, columns):
+    with open(path, 'rb', BUFFER_SIZE) as f:
+        reader = csv.reader(f, dialect='excel-tab')
+        if headers is None:
+            headers = next(reader, None)
+            if headers is None:
+                return
+        missing = [column for column in columns if column not in headers]
+        if missing:
+            raise SourceFormatError('%s: no %s column' % (path, ', '.join(missing)))
+        width = len(headers)
+        getter = columnGetter([headers.index(column) for column in columns])
+        for cells in reader:
+            if len(cells) != width:
+                if not cells:
+                    continue
+                raise SourceFormatError('%s, line %d: %d columns, expected %d' % (
+                    path, reader.line_num, len(cells), width))
+            yield getter(cells)
@@ -0,0 +1,95 @@
+# External sort for rows that do not all fit in memory.
+#
+# Records (tuples of strings and ints) are added one at a time and kept
+# in a list until their estimated size reaches the memory budget. The
+# list is then sorted and written to a run file with marshal. merged()
+# reads every run back at the same time, with the records still in
+# memory, and yields all of them in sorted order, holding only one
+# record per run. Once there are MAX_RUNS run files they are merged into
+# one, so a small budget never needs more open files than that.
+#
+# Run files go in spill_dir and are removed by close().
+
+import heapq
+import marshal
+import os
+import tempfile
+
+MAX_RUNS = 64
+READ_BUFFER = 1 << 16
+# Rough size of a record in memory: the tuple, plus a pointer and an
+# object header for each field
+TUPLE_BYTES = 56
+FIELD_BYTES = 45
+
+def recordBytes(record):
+    return TUPLE_BYTES + sum(FIELD_BYTES + len(v) if isinstance(v, str) else FIELD_BYTES
+        for v in record)
+
+def readRun(path):
+    with open(path, 'rb', READ_BUFFER) as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+class SpillSorter(object):
+    def __init__(self, spill_dir, budget_bytes):
+        self.spill_dir = spill_dir
+        self.budget_bytes = budget_bytes
+        self.buffer = [ ]
+        self.buffer_bytes = 0
+        self.runs = [ ]
+        self.count = 0
+        self.spills = 0
+        try:
+            os.makedirs(spill_dir)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.buffer_bytes += recordBytes(record)
+        self.count += 1
+        if self.buffer_bytes >= self.budget_bytes:
+            self.spill()
+
+    def writeRun(self, records):
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self.spill_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for record in records:
+                marshal.dump(record, f)
+        return path
+
+    def spill(self):
+        self.buffer.sort()
+        self.runs.append(self.writeRun(self.buffer))
+        self.buffer = [ ]
+        self.buffer_bytes = 0
+        self.spills += 1
+        if len(self.runs) >= MAX_RUNS:
+            runs = self.runs
+            self.runs = [self.writeRun(heapq.merge(*[readRun(path) for path in runs]))]
+            for path in runs:
+                os.remove(path)
+
+    # Every record added so far, in order. The records in memory are
+    # sorted in place, and nothing is removed, so this can be called
+    # again.
+    def merged(self):
+        self.buffer.sort()
+        return heapq.merge(self.buffer, *[readRun(path) for path in self.runs])
+
+    def close(self):
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = [ ]
+        self.buffer = [ ]
+        self.buffer_bytes = 0
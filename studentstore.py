@@ -0,0 +1,173 @@
+# Python 3.5
+
+# The extra students edited by flaskapp, kept in memory and indexed by
+# student number.
+#
+# The working file (extra-students.tsv) is read once. Each change after
+# that is appended to a journal next to it (extra-students.tsv.journal),
+# one JSON line per change, and the journal is folded back into the
+# working file every compact_every changes. Until then the working file
+# on disk is behind; call compact() (or run this module with the file's
+# path) before copying it anywhere.
+#
+# Every process that opens the store takes a lock file for its changes,
+# and picks up changes made by other processes from the journal before
+# making its own, so concurrent editors add to each other's changes
+# instead of overwriting them.
+
+import csv
+import fcntl
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+JOURNAL_SUFFIX = '.journal'
+LOCK_SUFFIX = '.lock'
+COMPACT_EVERY = 100
+
+class ExtraStudentStore(object):
+    def __init__(self, path, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.lock_path = path + LOCK_SUFFIX
+        self.compact_every = compact_every
+        self.records = OrderedDict()
+        self.base_id = None
+        self.journal_offset = 0
+        self.journal_entries = 0
+        self.thread_lock = threading.Lock()
+        with self.lock(fcntl.LOCK_SH):
+            self.load()
+
+    # The file lock keeps other processes out; the thread lock keeps
+    # other request threads of this process from changing the index
+    # while it is being read or refreshed
+    @contextmanager
+    def lock(self, mode):
+        with self.thread_lock, open(self.lock_path, 'a') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Identifies the working file, which compaction replaces
+    def baseId(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def journalSize(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def load(self):
+        self.records = OrderedDict()
+        self.base_id = self.baseId()
+        if self.base_id is not None:
+            with open(self.path, newline='') as f:
+                for row in csv.reader(f, dialect='excel-tab'):
+                    if row:
+                        self.records[row[0]] = row
+        self.journal_offset = 0
+        self.journal_entries = 0
+        self.replayJournal()
+
+    # Apply the journal lines written since the last read. A line that
+    # is still being written (no newline yet) is left for next time.
+    def replayJournal(self):
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self.journal_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.journal_offset += len(line)
+                self.journal_entries += 1
+                self.applyChange(json.loads(line.decode('utf-8')))
+
+    def applyChange(self, change):
+        if change['op'] == 'put':
+            self.records[change['record'][0]] = change['record']
+        elif change['op'] == 'remove':
+            self.records.pop(change['student_number'], None)
+
+    # Only a couple of stat calls when nothing has changed
+    def refresh(self):
+        if self.baseId() != self.base_id or self.journalSize() < self.journal_offset:
+            self.load()
+        elif self.journalSize() > self.journal_offset:
+            self.replayJournal()
+
+    # Changes on disk, from this process or any other, change the tag
+    def currentTag(self):
+        return '-'.join('%x' % n for n in (self.base_id or (0, 0, 0)) + (self.journal_offset, ))
+
+    def etag(self):
+        with self.lock(fcntl.LOCK_SH):
+            self.refresh()
+            return self.currentTag()
+
+    # (etag, records) as of the same moment
+    def snapshot(self):
+        with self.lock(fcntl.LOCK_SH):
+            self.refresh()
+            return self.currentTag(), list(self.records.values())
+
+    def get(self, student_number):
+        with self.lock(fcntl.LOCK_SH):
+            self.refresh()
+            return self.records.get(student_number)
+
+    # Remove and add records in one locked append
+    def update(self, removes=(), puts=()):
+        changes = [{'op': 'remove', 'student_number': n} for n in removes]
+        changes += [{'op': 'put', 'record': list(record)} for record in puts]
+        if not changes:
+            return
+        with self.lock(fcntl.LOCK_EX):
+            self.refresh()
+            data = b''.join(json.dumps(change).encode('utf-8') + b'\n' for change in changes)
+            with open(self.journal_path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.replayJournal()
+            if self.journal_entries >= self.compact_every:
+                self.compactLocked()
+
+    def compact(self):
+        with self.lock(fcntl.LOCK_EX):
+            self.refresh()
+            self.compactLocked()
+
+    # Rewrite the working file with every change and empty the journal.
+    # The new file is renamed into place, so readers see the old file or
+    # the new one.
+    def compactLocked(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            w = csv.writer(f, dialect='excel-tab', lineterminator='\n')
+            for record in self.records.values():
+                w.writerow(record)
+        os.replace(tmp_path, self.path)
+        with open(self.journal_path, 'wb'):
+            pass
+        self.base_id = self.baseId()
+        self.journal_offset = 0
+        self.journal_entries = 0
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: studentstore.py extra-students.tsv')
+    ExtraStudentStore(sys.argv[1]).compact()
@@ -0,0 +1,279 @@
+# Resilient SFTP upload.
+#
+# The file is written to a temporary name in the remote folder and
+# renamed into place only after its size (and by default its checksum)
+# has been checked, so the EasyBridge importer never sees a partial zip
+# file. The temporary name includes the start of the file's hash, so an
+# interrupted upload is resumed from where it stopped, but only by a
+# retry of the same file. Writes are pipelined, without waiting for the
+# server to acknowledge each one. Failed attempts are retried after a
+# backoff that doubles each time.
+#
+# sftp_standin.py serves a local directory over SFTP for trying this out
+# without the network, including dropped connections.
+
+import contextlib
+import errno
+import logging
+import os
+import threading
+import time
+
+import fingerprint
+import metrics
+
+DEFAULT_PORT = 22
+DEFAULT_RETRIES = 5
+DEFAULT_RETRY_WAIT = 2.0
+MAX_RETRY_WAIT = 60.0
+WRITE_SIZE = 1 << 18
+PART_SUFFIX = '.part'
+MB = 1 << 20
+POOL_SIZE = 2
+# Errors from the SFTP server that another attempt will not fix, such as
+# a missing folder or one the account cannot write to
+PERMANENT_ERRNOS = (errno.ENOENT, errno.EACCES)
+
+# paramiko and pysftp (with cryptography) take longer to import than the
+# rest of easybridge put together, so they are imported by the methods
+# that need them, and runs that never upload never load them.
+
+# Connection errors are reported by upload(); without a handler,
+# paramiko's logger prints a warning about having none
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+# verify settings
+VERIFY_SIZE = 'size'
+VERIFY_CHECKSUM = 'checksum'
+
+class TransferError(Exception):
+    pass
+
+class TransferResult(object):
+    def __init__(self, size, seconds, attempts, resumed_bytes):
+        self.size = size
+        self.seconds = seconds
+        self.attempts = attempts
+        self.resumed_bytes = resumed_bytes
+
+    @property
+    def bytes_per_second(self):
+        if self.seconds <= 0:
+            return None
+        return self.size / self.seconds
+
+    def __str__(self):
+        text = '%d bytes in %.2fs' % (self.size, self.seconds)
+        if self.bytes_per_second is not None:
+            text += ' (%.2f MB/s)' % (self.bytes_per_second / MB)
+        if self.attempts > 1:
+            text += ', %d attempts' % self.attempts
+        if self.resumed_bytes:
+            text += ', resumed after %d bytes' % self.resumed_bytes
+        return text
+
+class SftpTransfer(object):
+    def __init__(self, host, username, password, port=DEFAULT_PORT, known_hosts=None,
+            retries=DEFAULT_RETRIES, retry_wait=DEFAULT_RETRY_WAIT, verify=VERIFY_CHECKSUM,
+            run_metrics=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.known_hosts = known_hosts
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.verify = verify
+        self.metrics = run_metrics or metrics.Metrics()
+        self.connection = None
+        self.connect_thread = None
+        self.connect_error = None
+
+    # Host keys come from known_hosts, ~/.ssh/known_hosts by default
+    def connect(self):
+        if self.connection is None:
+            with self.metrics.phase('sftpConnect', host=self.host):
+                import pysftp
+                cnopts = pysftp.CnOpts(knownhosts=self.known_hosts)
+                self.connection = pysftp.Connection(self.host, username=self.username,
+                    password=self.password, port=self.port, cnopts=cnopts)
+        return self.connection
+
+    # Log in on another thread, so the SSH handshake and authentication
+    # happen while the zip file is still being built. upload() waits for
+    # it, and connects again if it failed.
+    def connectInBackground(self):
+        def backgroundConnect():
+            try:
+                self.connect()
+            except Exception as e:
+                self.connect_error = e
+        self.connect_error = None
+        self.connect_thread = threading.Thread(target=backgroundConnect, name='sftpConnect')
+        self.connect_thread.daemon = True
+        self.connect_thread.start()
+
+    def waitForConnect(self):
+        if self.connect_thread is not None:
+            self.connect_thread.join()
+            self.connect_thread = None
+
+    # Also cancels a background connect, once it has finished, so that a
+    # run whose build failed does not leave a session open
+    def close(self):
+        self.waitForConnect()
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def retryWait(self, attempt):
+        return min(self.retry_wait * 2 ** (attempt - 1), MAX_RETRY_WAIT)
+
+    # Upload a seekable file object as folder/name, retrying failed
+    # attempts. Returns a TransferResult, or raises TransferError once
+    # the retries are used up.
+    def upload(self, f, folder, name):
+        import paramiko
+        f.seek(0)
+        digest = fingerprint.hashStream(f)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        remote_path = folder + '/' + name
+        part_path = '%s/%s.%s%s' % (folder, name, digest[:12], PART_SUFFIX)
+        self.waitForConnect()
+        if isinstance(self.connect_error, paramiko.AuthenticationException):
+            raise TransferError('authentication failed: %s' % self.connect_error)
+
+        start = time.time()
+        resumed_bytes = 0
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with self.metrics.phase('sftpTransfer', host=self.host, file=name, attempt=attempt):
+                    offset = self.sendPart(f, size, part_path)
+                    resumed_bytes = max(resumed_bytes, offset)
+                    self.checkPart(part_path, size, digest)
+                    self.replace(part_path, remote_path)
+                break
+            except paramiko.AuthenticationException as e:
+                self.close()
+                raise TransferError('authentication failed: %s' % e)
+            except Exception as e:
+                self.close()
+                if isinstance(e, IOError) and e.errno in PERMANENT_ERRNOS:
+                    raise TransferError('%s: %s' % (folder, e))
+                if attempt > self.retries:
+                    raise TransferError('giving up after %d attempts: %s' % (attempt, e))
+                wait = self.retryWait(attempt)
+                print "upload attempt %d failed (%s), retrying in %.1fs" % (attempt, str(e) or type(e).__name__, wait)
+                time.sleep(wait)
+        self.removeStaleParts(folder, name, part_path)
+        return TransferResult(size, time.time() - start, attempt, resumed_bytes)
+
+    # Write f to part_path, continuing after whatever an earlier attempt
+    # already wrote. Returns the offset the upload started from.
+    def sendPart(self, f, size, part_path):
+        client = self.connect().sftp_client
+        try:
+            offset = client.stat(part_path).st_size
+        except IOError:
+            offset = 0
+        if offset > size:
+            client.remove(part_path)
+            offset = 0
+        remote = client.open(part_path, 'r+b' if offset else 'wb')
+        try:
+            remote.set_pipelined(True)
+            remote.seek(offset)
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(WRITE_SIZE), b''):
+                remote.write(chunk)
+        finally:
+            # Waits for the acknowledgements of the pipelined writes
+            remote.close()
+        return offset
+
+    # A part that fails the checksum is removed, so the retry starts over
+    def checkPart(self, part_path, size, digest):
+        client = self.connect().sftp_client
+        remote_size = client.stat(part_path).st_size
+        if remote_size != size:
+            raise TransferError('remote size %d, expected %d' % (remote_size, size))
+        if self.verify == VERIFY_CHECKSUM:
+            remote = client.open(part_path, 'rb')
+            try:
+                remote.prefetch(size)
+                remote_digest = fingerprint.hashStream(remote)
+            finally:
+                remote.close()
+            if remote_digest != digest:
+                client.remove(part_path)
+                raise TransferError('remote checksum %s, expected %s' % (remote_digest, digest))
+
+    # posix-rename@openssh.com replaces the target in one step. A plain
+    # SFTP v3 rename fails if the target exists, so without the extension
+    # the old file is removed first.
+    def replace(self, part_path, remote_path):
+        client = self.connect().sftp_client
+        try:
+            client.posix_rename(part_path, remote_path)
+            return
+        except IOError:
+            pass
+        try:
+            client.remove(remote_path)
+        except IOError:
+            pass
+        client.rename(part_path, remote_path)
+
+    # Parts left behind by interrupted uploads of other files
+    def removeStaleParts(self, folder, name, part_path):
+        try:
+            client = self.connect().sftp_client
+            for file_name in client.listdir(folder):
+                path = folder + '/' + file_name
+                if file_name.startswith(name + '.') and file_name.endswith(PART_SUFFIX) and path != part_path:
+                    client.remove(path)
+        except Exception as e:
+            print "can't remove old partial uploads: %s" % e
+
+# Connections kept open between uploads, so districts that share an
+# SFTP account log in once. At most size idle connections are kept for
+# each account.
+class SftpPool(object):
+    def __init__(self, size=POOL_SIZE, **options):
+        self.size = size
+        self.options = options
+        self.idle = { }
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transfer(self, host, username, password, port=DEFAULT_PORT, known_hosts=None):
+        key = (host, port, username)
+        with self.lock:
+            idle = self.idle.get(key)
+            sftp = idle.pop() if idle else None
+        if sftp is None:
+            sftp = SftpTransfer(host, username, password, port=port, known_hosts=known_hosts,
+                **self.options)
+        try:
+            yield sftp
+        finally:
+            with self.lock:
+                idle = self.idle.setdefault(key, [ ])
+                if sftp.connection is not None and len(idle) < self.size:
+                    idle.append(sftp)
+                    sftp = None
+            if sftp is not None:
+                sftp.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for sftp in idle:
+                    sftp.close()
+            self.idle = { }
@@ -0,0 +1,86 @@
+# Problems with the references between the source files, collected over
+# a whole run into one report, rather than found one at a time by runs
+# that stop at the first.
+#
+# Errors are rows that cannot be uploaded as they are: an enrollment of
+# a student who is not in students.txt, or a math-courses.txt line that
+# maps a section to something that is not a course.section. The policy
+# decides what happens to them: SKIP leaves them out and carries on,
+# FAIL stops the run before anything is built.
+#
+# Warnings are what the upload has always put up with, and are only
+# reported: sections left out because of their teacher, enrollments and
+# extra students in sections that are not uploaded, and section
+# mappings whose target is not uploaded.
+#
+# The report is JSON if its file name ends in .json, otherwise
+# tab-delimited with a header line.
+
+import csv
+import json
+
+ERROR = 'error'
+WARNING = 'warning'
+
+SKIP = 'skip'
+FAIL = 'fail'
+POLICIES = [SKIP, FAIL]
+
+FIELDS = ['severity', 'check', 'table', 'key', 'reference', 'count', 'message']
+
+class ValidationError(Exception):
+    pass
+
+# key is the row (or section) with the problem and reference what it
+# refers to; count is the number of rows it stands for
+class Problem(object):
+    __slots__ = FIELDS
+
+    def __init__(self, severity, check, table, key, reference, message, count=1):
+        self.severity = severity
+        self.check = check
+        self.table = table
+        self.key = key
+        self.reference = reference
+        self.message = message
+        self.count = count
+
+    def asDict(self):
+        return dict((field, getattr(self, field)) for field in FIELDS)
+
+class ValidationReport(object):
+    def __init__(self):
+        self.problems = [ ]
+
+    def __len__(self):
+        return len(self.problems)
+
+    def error(self, check, table, key, reference, message, count=1):
+        self.problems.append(Problem(ERROR, check, table, key, reference, message, count))
+
+    def warning(self, check, table, key, reference, message, count=1):
+        self.problems.append(Problem(WARNING, check, table, key, reference, message, count))
+
+    def errors(self):
+        return [problem for problem in self.problems if problem.severity == ERROR]
+
+    def warnings(self):
+        return [problem for problem in self.problems if problem.severity == WARNING]
+
+    def __str__(self):
+        return '%d errors, %d warnings' % (len(self.errors()), len(self.warnings()))
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            if path.endswith('.json'):
+                json.dump({
+                    'errors': len(self.errors()),
+                    'warnings': len(self.warnings()),
+                    'problems': [problem.asDict() for problem in self.problems],
+                }, f, indent=2, sort_keys=True)
+                f.write('\n')
+            else:
+                w = csv.writer(f, dialect='excel-tab', lineterminator='\n')
+                w.writerow(FIELDS)
+                for problem in self.problems:
+                    w.writerow([getattr(problem, field) for field in FIELDS])
@@ -0,0 +1,167 @@
+# --watch: keep the source files loaded and rebuild as AutoSend drops
+# new ones into the source directory, one school and file at a time,
+# during the morning.
+#
+# The source directory is polled; nothing else has to be running. A file
+# is picked up once its size and modification time have stayed the same
+# for one poll, so a file AutoSend is still writing is not read half
+# done. Only the changed file is read again (see
+# EasyBridgeUploader.reloadSourceFile), only the output files it feeds
+# are written again, and the zip file is rebuilt from the output files
+# kept in memory.
+#
+# An upload is made once the output has stopped changing for
+# upload_delay seconds, but no later than MAX_UPLOAD_DELAY after the
+# first change it includes. A change to math-courses.txt or
+# exclusions.txt, or a new day when no effective date was given, loads
+# everything again.
+
+import datetime
+import os
+import time
+
+POLL_INTERVAL = 5
+UPLOAD_DELAY = 120
+MAX_UPLOAD_DELAY = 900
+
+# (size, mtime) of each file in source_dir
+def scanDirectory(source_dir):
+    files = { }
+    for name in os.listdir(source_dir):
+        try:
+            st = os.stat(os.path.join(source_dir, name))
+        except OSError:
+            continue
+        files[name] = (st.st_size, st.st_mtime)
+    return files
+
+class SourceWatcher(object):
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.scanned = scanDirectory(source_dir)
+        # What the loaded data was read from
+        self.loaded = dict(self.scanned)
+
+    # Start over from the files as they are now, before a full load
+    def reset(self):
+        self.scanned = scanDirectory(self.source_dir)
+        self.loaded = dict(self.scanned)
+
+    # Files that differ from the ones loaded and have not changed since
+    # the last poll. A file that disappears is left as it was loaded.
+    def changedFiles(self):
+        scanned = scanDirectory(self.source_dir)
+        changed = sorted(name for name, stat in scanned.iteritems()
+            if stat != self.loaded.get(name) and stat == self.scanned.get(name))
+        self.scanned = scanned
+        return changed
+
+    def markLoaded(self, names):
+        for name in names:
+            self.loaded[name] = self.scanned[name]
+
+    def upToDate(self):
+        return scanDirectory(self.source_dir) == self.loaded
+
+class Watcher(object):
+    # new_uploader(effective_date) returns an EasyBridgeUploader that has
+    # not loaded anything yet. upload(uploader, up_to_date) uploads its
+    # zip file and returns True if it was sent (or did not need to be);
+    # up_to_date says whether the loaded files are still the ones in the
+    # source directory.
+    # Without an effective_date, each day's date is used.
+    def __init__(self, new_uploader, upload, source_dir, effective_date=None,
+            poll_interval=POLL_INTERVAL, upload_delay=UPLOAD_DELAY):
+        self.new_uploader = new_uploader
+        self.upload = upload
+        self.source_watcher = SourceWatcher(source_dir)
+        self.fixed_date = effective_date
+        self.poll_interval = poll_interval
+        self.upload_delay = upload_delay
+        self.uploader = None
+        self.effective_date = None
+        self.files = { }
+        self.first_change = None
+        self.upload_at = None
+
+    def effectiveDate(self):
+        return self.fixed_date or datetime.date.today()
+
+    def fullLoad(self):
+        start = time.time()
+        self.effective_date = self.effectiveDate()
+        self.source_watcher.reset()
+        self.uploader = None
+        uploader = self.new_uploader(self.effective_date)
+        uploader.loadData()
+        self.files = uploader.renderOutputs()
+        uploader.zipRenderedFiles(self.files)
+        self.uploader = uploader
+        print "loaded all source files for %s in %.1fs" % (self.effective_date, time.time() - start)
+        self.scheduleUpload()
+
+    # Read the changed files again and write the output files they feed.
+    # Anything that goes wrong leaves the data half updated, so the next
+    # change loads everything again.
+    def reload(self, changed):
+        start = time.time()
+        outputs = set()
+        for name in changed:
+            names = self.uploader.reloadSourceFile(name)
+            if names is None:
+                print "%s changed" % name
+                self.fullLoad()
+                return
+            outputs.update(names)
+        self.source_watcher.markLoaded(changed)
+        rendered = self.uploader.renderOutputs(outputs)
+        updated = sorted(name for name, data in rendered.iteritems() if self.files.get(name) != data)
+        self.files.update(rendered)
+        if updated:
+            self.uploader.zipRenderedFiles(self.files)
+            self.scheduleUpload()
+        print "%s: reloaded in %.2fs, %s" % (', '.join(changed), time.time() - start,
+            ', '.join(updated) + ' changed' if updated else 'no output changed')
+
+    def scheduleUpload(self):
+        now = time.time()
+        if self.first_change is None:
+            self.first_change = now
+        self.upload_at = min(now + self.upload_delay, self.first_change + MAX_UPLOAD_DELAY)
+
+    def uploadIfDue(self):
+        if self.uploader is None or self.upload_at is None or time.time() < self.upload_at:
+            return
+        if self.upload(self.uploader, self.source_watcher.upToDate()):
+            self.first_change = None
+            self.upload_at = None
+        else:
+            self.upload_at = time.time() + self.upload_delay
+
+    def poll(self):
+        changed = self.source_watcher.changedFiles()
+        new_day = self.effectiveDate() != self.effective_date
+        if self.uploader is None:
+            # After a failed load, wait for the files to change
+            if new_day or changed:
+                self.fullLoad()
+        elif new_day:
+            self.fullLoad()
+        elif changed:
+            self.reload(changed)
+        self.uploadIfDue()
+
+    def run(self):
+        print "watching %s (Ctrl-C to stop)" % self.source_watcher.source_dir
+        try:
+            while True:
+                try:
+                    self.poll()
+                except Exception as e:
+                    print "can't rebuild: %s: %s" % (type(e).__name__, e)
+                    self.uploader = None
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            if self.upload_at is not None:
+                print "stopped with an upload pending"
+            return 0
@@ -0,0 +1,179 @@
+# A long-lived process that keeps a loaded EasyBridgeUploader for the
+# build, preview and upload jobs of flaskapp. flaskapp runs on Python 3
+# and this on Python 2 with the rest of easybridge, so flaskapp starts
+# it (see jobs.py) and sends one JSON request per line on stdin:
+#
+#   {"op": "preview", "extra_students": "/path/to/extra-students.tsv"}
+#
+# and reads one JSON reply per line from stdout:
+#
+#   {"ok": true, "result": {...}, "log": [...], "phases": [...], "seconds": 0.08}
+#
+# The source files are loaded once. A job loads them again only if one
+# of them (other than extra-students.txt) or the effective date has
+# changed; otherwise it only replaces the extra students with the ones
+# in the given file, which is what makes a preview quick.
+
+import argparse
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+
+import district
+import easybridge
+import fingerprint
+import metrics
+import sourcecache
+
+# The files the extra students show up in
+PREVIEW_WRITERS = ['writeStudentFile', 'writeSectionStudentFile']
+MAX_PREVIEW_LINES = 200
+
+class Worker(object):
+    def __init__(self, options):
+        self.options = options
+        if options.district:
+            self.district = district.District.load(options.district)
+        else:
+            self.district = district.District()
+        self.uploader = None
+        self.loaded_inputs = None
+        self.baseline = None
+
+    def newUploader(self, effective_date):
+        state_dir = self.options.state_dir or self.district.state_dir
+        return easybridge.EasyBridgeUploader(source_dir=self.options.source_dir,
+            output_dir=self.options.output_dir, autosend=self.options.autosend or self.district.autosend,
+            effective_date=effective_date, state_dir=state_dir, district_config=self.district,
+            cache=sourcecache.SourceCache(os.path.join(state_dir, 'cache')))
+
+    def previewWriters(self):
+        return [getattr(self.uploader, name) for name in PREVIEW_WRITERS]
+
+    # Returns True if the source files had to be loaded
+    def ensureLoaded(self):
+        effective_date = datetime.date.today()
+        if self.options.effective_date:
+            effective_date = easybridge.parseDate(self.options.effective_date)
+        uploader = self.newUploader(effective_date)
+        inputs = uploader.fingerprintInputs()
+        files = dict(inputs.files)
+        files.pop('extra-students.txt', None)
+        key = fingerprint.hashBytes(json.dumps([files, inputs.settings], sort_keys=True))
+        if self.uploader is not None and key == self.loaded_inputs:
+            self.uploader.metrics = metrics.Metrics()
+            return False
+        uploader.loadData()
+        self.uploader = uploader
+        self.loaded_inputs = key
+        # What the extra students in the source directory produce, for
+        # previews to compare against
+        self.baseline = uploader.renderFiles(self.previewWriters())
+        return True
+
+    # Without a file, the extra students in the source directory
+    def applyExtraStudents(self, extra_students):
+        self.uploader.reloadExtraStudents(extra_students or 'extra-students.txt')
+
+    def load(self):
+        return {'reloaded': self.ensureLoaded()}
+
+    # Lines of STUDENT and PIF_SECTION_STUDENT that the extra students
+    # in extra_students add or remove
+    def preview(self, extra_students=None):
+        reloaded = self.ensureLoaded()
+        self.applyExtraStudents(extra_students)
+        files = { }
+        for file_name, data in sorted(self.uploader.renderFiles(self.previewWriters()).items()):
+            old_lines = set(self.baseline[file_name].splitlines())
+            new_lines = set(data.splitlines())
+            added = sorted(new_lines - old_lines)
+            removed = sorted(old_lines - new_lines)
+            files[file_name] = {
+                'rows': len(new_lines) - 1,
+                'added': added[:MAX_PREVIEW_LINES],
+                'removed': removed[:MAX_PREVIEW_LINES],
+                'added_count': len(added),
+                'removed_count': len(removed),
+            }
+        return {'reloaded': reloaded, 'files': files}
+
+    def build(self, extra_students=None):
+        reloaded = self.ensureLoaded()
+        self.applyExtraStudents(extra_students)
+        built = easybridge.build(self.uploader, in_memory=False)
+        return {'reloaded': reloaded, 'zip_file': built.zip_path, 'zip_bytes': built.zip_bytes}
+
+    # After a successful upload the extra students file is copied to
+    # publish_to, normally the one in the source directory, so the
+    # nightly run sends the same students
+    def upload(self, extra_students=None, publish_to=None):
+        reloaded = self.ensureLoaded()
+        self.applyExtraStudents(extra_students)
+        connection = easybridge.connect(self.uploader, self.options.sftp_host, self.options.username,
+            self.options.password, self.options.sftp_port, self.options.known_hosts)
+        connection.connectInBackground()
+        try:
+            built = easybridge.build(self.uploader)
+            uploaded = easybridge.upload(self.uploader, built, connection=connection)
+        finally:
+            connection.close()
+        if not uploaded:
+            raise RuntimeError('upload failed')
+        if extra_students and publish_to:
+            shutil.copyfile(extra_students, publish_to)
+        return {'reloaded': reloaded, 'zip_bytes': built.zip_bytes}
+
+    # Anything the job prints, such as warnings about teachers, goes in
+    # the reply's log
+    def handle(self, request):
+        start = time.time()
+        log = io.BytesIO()
+        stdout = sys.stdout
+        sys.stdout = log
+        try:
+            op = request.pop('op')
+            if op not in ('load', 'preview', 'build', 'upload'):
+                raise ValueError('unknown op %r' % op)
+            reply = {'ok': True, 'result': getattr(self, op)(**request)}
+        except Exception as e:
+            traceback.print_exc(file=log)
+            reply = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+        finally:
+            sys.stdout = stdout
+        reply['log'] = log.getvalue().splitlines()
+        reply['phases'] = [phase.asDict() for phase in self.uploader.metrics.phases] if self.uploader else [ ]
+        reply['seconds'] = time.time() - start
+        return reply
+
+    def serve(self, requests, replies):
+        for line in iter(requests.readline, ''):
+            reply = self.handle(json.loads(line))
+            replies.write(json.dumps(reply) + '\n')
+            replies.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run easybridge jobs for flaskapp.')
+    parser.add_argument('--district', help='district settings file (default: Kentfield)')
+    parser.add_argument('-a', '--autosend', action='store_true')
+    parser.add_argument('-t', '--effective-date', help='(default: the day of each job)')
+    parser.add_argument('-s', '--source_dir')
+    parser.add_argument('-o', '--output_dir')
+    parser.add_argument('--state_dir')
+    parser.add_argument('-u', '--username')
+    parser.add_argument('-p', '--password')
+    parser.add_argument('--sftp-host')
+    parser.add_argument('--sftp-port', type=int)
+    parser.add_argument('--known-hosts')
+    options = parser.parse_args()
+
+    # Replies go to the real stdout; anything else printed goes to
+    # stderr, or to a reply's log while a job is running
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout = sys.stderr
+    Worker(options).serve(sys.stdin, replies)
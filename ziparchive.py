@@ -0,0 +1,177 @@
+# Zip archive writer with a choice of compression and level, which
+# compresses its members in worker threads.
+#
+# Python 2's zipfile always deflates at the default level, and only
+# compresses a member while it is being written, one after another.
+# Here writestr() hands each member to a thread pool as soon as it is
+# written, so members compress while the next output file is still being
+# written (zlib releases the GIL), and close() writes them into the
+# archive in the order they were given.
+#
+# writefile() adds a member from a file instead, for one too large to
+# hold in memory. It is read and compressed a chunk at a time by
+# close(), straight into the archive, and its local header is written
+# again once its size and CRC are known, so the target must be seekable.
+#
+# The archive layout is the plain (not zip64) one, using the header
+# formats from zipfile, so members must stay under 4 GB.
+
+import io
+import multiprocessing
+import multiprocessing.pool
+import struct
+import time
+import zipfile
+import zlib
+
+STORED = 'stored'
+DEFLATE = 'deflate'
+COMPRESSIONS = [STORED, DEFLATE]
+DEFAULT_LEVEL = 6
+MAX_THREADS = 8
+CHUNK_SIZE = 1 << 20
+
+COMPRESS_TYPES = {STORED: zipfile.ZIP_STORED, DEFLATE: zipfile.ZIP_DEFLATED}
+ZIP_VERSION = 20
+CREATE_SYSTEM = zipfile.ZipInfo().create_system
+# -rw-------, as zipfile.writestr gives its members
+EXTERNAL_ATTR = 0600 << 16
+
+# Runs in a worker thread; returns (crc, compressed data, seconds)
+def _compress(data, compression, level):
+    start = time.time()
+    crc = zlib.crc32(data) & 0xffffffff
+    if compression == DEFLATE:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, data, time.time() - start
+
+# Streams path into f; returns (crc, compressed size, size, seconds)
+def _compressFile(path, f, compression, level):
+    start = time.time()
+    crc = 0
+    size = compressed_size = 0
+    compressor = None
+    if compression == DEFLATE:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            f.write(chunk)
+            compressed_size += len(chunk)
+    if compressor is not None:
+        chunk = compressor.flush()
+        f.write(chunk)
+        compressed_size += len(chunk)
+    return crc & 0xffffffff, compressed_size, size, time.time() - start
+
+def dosDateTime(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11 | minute << 5 | second // 2), ((year - 1980) << 9 | month << 5 | day)
+
+# compress_seconds adds up the time spent compressing each member;
+# close_seconds is how long close() took, mostly waiting for members that
+# were still being compressed
+class ZipStats(object):
+    def __init__(self, members, input_bytes, output_bytes, compress_seconds, close_seconds):
+        self.members = members
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.compress_seconds = compress_seconds
+        self.close_seconds = close_seconds
+
+    @property
+    def ratio(self):
+        return float(self.output_bytes) / self.input_bytes if self.input_bytes else 1.0
+
+    def __str__(self):
+        return '%d files, %.1f MB -> %.1f MB (%.1f%%), %.2fs compressing, %.2fs to finish' % (
+            self.members, self.input_bytes / 1048576.0, self.output_bytes / 1048576.0,
+            self.ratio * 100, self.compress_seconds, self.close_seconds)
+
+class ZipBuilder(object):
+    # target is a path or a writable file object
+    def __init__(self, target, compression=DEFLATE, level=DEFAULT_LEVEL, threads=0):
+        if compression not in COMPRESSIONS:
+            raise ValueError('unknown zip compression %r' % compression)
+        self.target = target
+        self.compression = compression
+        self.level = level
+        threads = threads or min(MAX_THREADS, multiprocessing.cpu_count())
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        self.members = [ ]
+        self.stats = None
+
+    # date_time defaults to now; runarchive gives the original one to
+    # build a restored zip file byte for byte
+    def writestr(self, name, data, date_time=None):
+        date_time = date_time or time.localtime(time.time())[:6]
+        result = self.pool.apply_async(_compress, (data, self.compression, self.level))
+        self.members.append((name, date_time, len(data), result))
+
+    # The file must be left in place until close()
+    def writefile(self, name, path, date_time=None):
+        date_time = date_time or time.localtime(time.time())[:6]
+        self.members.append((name, date_time, None, path))
+
+    # Write the archive once every member is compressed; returns ZipStats
+    def close(self):
+        start = time.time()
+        try:
+            if isinstance(self.target, basestring):
+                with open(self.target, 'wb') as f:
+                    stats = self.writeArchive(f)
+            else:
+                stats = self.writeArchive(self.target)
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+        stats.close_seconds = time.time() - start
+        self.stats = stats
+        return stats
+
+    def writeArchive(self, f):
+        compress_type = COMPRESS_TYPES[self.compression]
+        central = io.BytesIO()
+        offset = 0
+        input_bytes = 0
+        compress_seconds = 0.0
+        base = f.tell()
+        for name, date_time, size, result in self.members:
+            dos_time, dos_date = dosDateTime(date_time)
+            if size is None:
+                # A file member: a header with no sizes, then the data,
+                # then the header again
+                f.write(struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                    ZIP_VERSION, 0, 0, compress_type, dos_time, dos_date, 0, 0, 0, len(name), 0))
+                f.write(name)
+                crc, compressed_size, size, seconds = _compressFile(result, f, self.compression, self.level)
+                f.seek(base + offset)
+                f.write(struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                    ZIP_VERSION, 0, 0, compress_type, dos_time, dos_date,
+                    crc, compressed_size, size, len(name), 0))
+                f.seek(0, io.SEEK_END)
+            else:
+                crc, data, seconds = result.get()
+                compressed_size = len(data)
+                f.write(struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                    ZIP_VERSION, 0, 0, compress_type, dos_time, dos_date,
+                    crc, compressed_size, size, len(name), 0))
+                f.write(name)
+                f.write(data)
+            input_bytes += size
+            compress_seconds += seconds
+            central.write(struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir,
+                ZIP_VERSION, CREATE_SYSTEM, ZIP_VERSION, 0, 0, compress_type, dos_time, dos_date,
+                crc, compressed_size, size, len(name), 0, 0, 0, 0, EXTERNAL_ATTR, offset))
+            central.write(name)
+            offset += struct.calcsize(zipfile.structFileHeader) + len(name) + compressed_size
+        directory = central.getvalue()
+        f.write(directory)
+        f.write(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, len(self.members), len(self.members), len(directory), offset, 0))
+        return ZipStats(len(self.members), input_bytes,
+            offset + len(directory) + struct.calcsize(zipfile.structEndArchive), compress_seconds, 0.0)